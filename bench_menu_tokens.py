@@ -0,0 +1,50 @@
+# bench_menu_tokens.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Compara tokens del menú en cada prompt: json.dumps de la lista (antes) vs compilar_menu (después).
+# Usa tiktoken si está instalado; si no, estima 1 token cada 4 caracteres.
+# Uso: python bench_menu_tokens.py [menu.json]
+
+import json
+import sys
+
+# (prompt, cómo se serializaba antes, nivel de detalle que usa ahora)
+# pedido_incompleto_dynamic ya enviaba solo nombres y se deja igual
+PROMPTS = [
+    ("mapear_pedido_al_menu", "json", "completo"),
+    ("responder_pregunta_menu_chatgpt", "json", "completo"),
+    ("clasificar_pregunta_menu_chatgpt", "json", "basico"),
+    ("enviar_menu_digital", "json", "basico"),
+    ("generar_mensaje_confirmacion_modificacion_pedido", "json", "basico"),
+    ("generar_mensaje_sin_intencion", "json", "basico"),
+    ("clasificar_confirmación_general", "json", "nombres"),
+    ("clasificar_negacion_general", "json", "nombres"),
+]
+
+def contador_tokens():
+    try:
+        import tiktoken
+        codificador = tiktoken.get_encoding("o200k_base")
+        return (lambda texto: len(codificador.encode(texto))), "tiktoken o200k_base"
+    except ImportError:
+        return (lambda texto: (len(texto) + 3) // 4), "estimado (caracteres / 4)"
+
+def main():
+    ruta = sys.argv[1] if len(sys.argv) > 1 else "menu_muestra.json"
+    with open(ruta, "r", encoding="utf-8") as f:
+        items = json.load(f)
+
+    from utils_menu import compilar_menu, version_menu
+
+    contar, metodo = contador_tokens()
+    serializado_antes = {
+        "json": json.dumps(items, ensure_ascii=False),
+    }
+    print(f"{len(items)} items, version {version_menu(items)}, tokens: {metodo}")
+    print(f"{'prompt':<50}{'nivel':<10}{'antes':>8}{'despues':>9}{'ahorro':>8}")
+    for prompt, formato_antes, nivel in PROMPTS:
+        antes = contar(serializado_antes[formato_antes])
+        despues = contar(compilar_menu(items, nivel))
+        print(f"{prompt:<50}{nivel:<10}{antes:>8}{despues:>9}{1 - despues / antes:>8.0%}")
+
+if __name__ == "__main__":
+    main()
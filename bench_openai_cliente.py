@@ -0,0 +1,78 @@
+# bench_openai_cliente.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Micro-benchmark: cliente OpenAI nuevo por llamada vs cliente compartido (utils_openai)
+# contra un servidor stub local. Cuenta conexiones TCP abiertas (= handshakes) y latencia.
+# Uso: python bench_openai_cliente.py [llamadas]
+
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RESPUESTA = {
+    "id": "chatcmpl-stub",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "gpt-4.1-mini",
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": "ok"}, "finish_reason": "stop"}],
+    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}
+}
+
+class StubOpenAI(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    conexiones = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        with StubOpenAI.lock:
+            StubOpenAI.conexiones += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        cuerpo = json.dumps(RESPUESTA).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, *args):
+        pass
+
+def medir(nombre, obtener_cliente, llamadas):
+    StubOpenAI.conexiones = 0
+    tiempos = []
+    for _ in range(llamadas):
+        inicio = time.perf_counter()
+        cliente = obtener_cliente()
+        cliente.chat.completions.create(model="gpt-4.1-mini", messages=[{"role": "user", "content": "hola"}])
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    print(f"{nombre:<22} conexiones={StubOpenAI.conexiones:<5} "
+          f"p50={statistics.median(tiempos):.2f}ms promedio={statistics.mean(tiempos):.2f}ms")
+
+def main():
+    llamadas = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    servidor = ThreadingHTTPServer(("127.0.0.1", 0), StubOpenAI)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    os.environ["OPENAI_API_KEY"] = "sk-bench"
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{servidor.server_address[1]}/v1"
+
+    from openai import OpenAI
+    from utils_openai import obtener_cliente_openai
+
+    def cliente_nuevo():
+        # Comportamiento anterior: un OpenAI() por llamada (pool y handshake nuevos)
+        return OpenAI()
+
+    print(f"{llamadas} llamadas a chat.completions contra {os.environ['OPENAI_BASE_URL']}")
+    medir("cliente por llamada", cliente_nuevo, llamadas)
+    medir("cliente compartido", obtener_cliente_openai, llamadas)
+    print("Con TLS real cada conexión nueva suma además un handshake TLS (1-2 RTT a api.openai.com).")
+    servidor.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# eval_preclasificador.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Evaluación offline del preclasificador: reproduce mensajes etiquetados por el LLM (get_classifier)
+# y reporta cobertura, precisión y recall por intención.
+# Uso: python eval_preclasificador.py [archivo.jsonl] [--sedes "Caobos,Virrey,Galerias"]
+# Cada línea: {"texto": "...", "paso": "medio_pago" | null, "intent": "<intent del LLM>"}
+
+import argparse
+import json
+from collections import defaultdict
+from typing import Any, Dict, List
+
+def cargar_muestras(ruta: str) -> List[Dict[str, Any]]:
+    muestras = []
+    with open(ruta, "r", encoding="utf-8") as f:
+        for linea in f:
+            if linea.strip():
+                muestras.append(json.loads(linea))
+    return muestras
+
+def evaluar(muestras: List[Dict[str, Any]], sedes: List[str]) -> Dict[str, Any]:
+    from utils_preclasificador import preclasificar
+
+    filas_sedes = [{"nombre": s} for s in sedes]
+    por_intent: Dict[str, Dict[str, int]] = defaultdict(lambda: {"total": 0, "predichos": 0, "aciertos": 0})
+    errores = []
+    resueltos = 0
+    for m in muestras:
+        esperado = m["intent"]
+        resultado = preclasificar(m["texto"], m.get("paso"), sedes=filas_sedes)
+        por_intent[esperado]["total"] += 1
+        if resultado is None:
+            continue
+        resueltos += 1
+        predicho = resultado[0]
+        por_intent[predicho]["predichos"] += 1
+        if predicho == esperado:
+            por_intent[esperado]["aciertos"] += 1
+        else:
+            errores.append({"texto": m["texto"], "paso": m.get("paso"), "esperado": esperado, "predicho": predicho})
+    aciertos = sum(v["aciertos"] for v in por_intent.values())
+    return {
+        "muestras": len(muestras),
+        "cobertura": resueltos / len(muestras) if muestras else 0.0,
+        "precision": aciertos / resueltos if resueltos else 0.0,
+        "recall": aciertos / len(muestras) if muestras else 0.0,
+        "por_intent": dict(por_intent),
+        "errores": errores
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("archivo", nargs="?", default="preclasificador_muestras.jsonl")
+    parser.add_argument("--sedes", default="Caobos,Virrey,Galerias,Centro Mayor")
+    args = parser.parse_args()
+
+    reporte = evaluar(cargar_muestras(args.archivo), [s.strip() for s in args.sedes.split(",") if s.strip()])
+    print(f"muestras={reporte['muestras']} cobertura={reporte['cobertura']:.1%} "
+          f"precision={reporte['precision']:.1%} recall={reporte['recall']:.1%}")
+    print(f"{'intent':<24}{'total':>7}{'predichos':>11}{'precision':>11}{'recall':>9}")
+    for intent, v in sorted(reporte["por_intent"].items()):
+        precision = v["aciertos"] / v["predichos"] if v["predichos"] else 0.0
+        recall = v["aciertos"] / v["total"] if v["total"] else 0.0
+        print(f"{intent:<24}{v['total']:>7}{v['predichos']:>11}{precision:>11.1%}{recall:>9.1%}")
+    for e in reporte["errores"]:
+        print(f"ERROR paso={e['paso']} esperado={e['esperado']} predicho={e['predicho']}: {e['texto']!r}")
+
+if __name__ == "__main__":
+    main()
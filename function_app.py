@@ -7,16 +7,25 @@ import logging
 import os
 import json
 from utils import obtener_datos_cliente_por_telefono, send_pdf_response, send_text_response,  log_message, get_client_database, handle_create_client, get_client_name_database,validate_duplicated_message,obtener_nombre_sede
-from utils_chatgpt import get_classifier, get_openai_key,get_direction,get_name, resumen_conversacion
+from utils_chatgpt import get_classifier,get_direction,get_name, resumen_conversacion
 from utils_subflujos import manejar_dialogo
 from utils_google import orquestador_ubicacion_exacta,calcular_distancia_entre_sede_y_cliente,geocode_and_assign,buscar_sede_mas_cercana
 from utils_registration import  update_dir_primera_vez, update_nombre_bool, validate_nombre_bool,  validate_direction_first_time
-from utils_database import execute_query
+from utils_concurrencia import en_paralelo
+from utils_database import consultas_contadas, execute_query, fijar_deadline, iniciar_conteo_consultas
 from typing import Any, Dict, Optional, List
 
-import io
-from utils_contexto import set_sender,crear_conversacion, actualizar_conversacion,obtener_contexto_conversacion
-import random
+from utils_contexto import actualizar_perfil_cliente, set_sender,crear_conversacion, actualizar_conversacion,obtener_contexto_conversacion, obtener_estado_pedido
+from utils_coalescencia import obtener_coalescedor, registrar_turno_fusionado
+from utils_cola import agrupar_mensajes_por_remitente, drenar_cola, evento_de_remitente, obtener_cola
+from utils_despachador import obtener_despachador
+from utils_logs import vaciar_logs
+from utils_idempotencia import liberar_mensaje, mantener_particiones_mensajes, migrar_tabla_mensajes
+from utils_llm import iniciar_presupuesto_llm
+from utils_menu import estadisticas_cache_menu
+from utils_preclasificador import preclasificar
+from utils_transcripcion import AudioRechazado, transcribir_audio
+from utils_metricas import incrementar, obtener_metricas
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
@@ -24,6 +33,11 @@ app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 VERIFY_TOKEN: str = os.getenv("META_VERIFY_TOKEN") 
 ACCESS_TOKEN: str = os.getenv("WABA_TOKEN")
 ID_RESTAURANTE: str = os.getenv("ID_RESTAURANTE", "5")
+MODO_WEBHOOK: str = os.getenv("MODO_WEBHOOK", "sincrono")  # "sincrono" | "cola"
+COLA_CRON: str = os.getenv("COLA_CRON", "*/2 * * * * *")
+COLA_TIEMPO_MAX_DRENADO: float = float(os.getenv("COLA_TIEMPO_MAX_DRENADO", "50"))
+IDEMPOTENCIA_CRON: str = os.getenv("IDEMPOTENCIA_CRON", "0 15 3 * * *")  # mantenimiento diario de particiones
+TURNO_DEADLINE_SEGUNDOS: float = float(os.getenv("TURNO_DEADLINE_SEGUNDOS", "120"))  # límite de reintentos de BD por turno
 
 #PHONE_ID:str = os.getenv["PHONE_NUMBER_ID"] 
 
@@ -58,251 +72,327 @@ def _process_message(req: func.HttpRequest) -> func.HttpResponse:
         """Procesa los mensajes recibidos desde WhatsApp Business API."""
         req_body: Dict[str, Any] = json.loads(req.get_body().decode("utf-8"))
         logging.info(f"Cuerpo recibido: {json.dumps(req_body, indent=2)}")
-        entry: Dict[str, Any] = req_body.get("entry", [{}])[0]
-        change: Dict[str, Any] = entry.get("changes", [{}])[0]
-        value: Dict[str, Any] = change.get("value", {})
-        messages: Optional[List[Dict[str, Any]]] = value.get("messages")
-        if not messages:
-            logging.info("No hay mensajes en el evento. Puede ser una notificación de estado.")
-            return func.HttpResponse("Sin mensajes para procesar", status_code=200)
-        message: Dict[str, Any] = messages[0]
-        tipo_general = message["type"]
-        logging.info(f"Tipo de mensaje recibido: {tipo_general}")
-        message_id = message["id"]
-        mensaje = True
-        if validate_duplicated_message(message_id):
-             logging.info(f"Mensaje duplicado: {message_id}")
-             return func.HttpResponse("Mensaje duplicado", status_code=200)
-        sender: str = message["from"]
-        set_sender(sender)
-        nombre_cliente: str
-        ####################################
-        ############ CLIENTE NUEVO  ############
-        ####################################
-        if not get_client_database(sender, ID_RESTAURANTE):
-            log_message("Cliente nuevo detectado", "INFO")
-            datos: str = None
-            nombre_temp: str = handle_create_client(sender, datos, ID_RESTAURANTE, False)
-            log_message(f"Cliente creado en base de datos: {nombre_temp}", "INFO")
-            if tipo_general == "text":
-                text: str = message.get("text", {}).get("body", "")
-                conversacion = crear_conversacion(text)
-                log_message(f"Conversación iniciada: {conversacion}", "INFO")  
-                if not text:
-                    logging.warning("⚠️ Mensaje recibido sin texto.")
-                    return func.HttpResponse("Mensaje vacío", status_code=200)
-            elif message["type"] == "audio":
-                audio_id = message["audio"]["id"]
-                mime_type = message["audio"]["mime_type"]
-                logging.info(f"Audio recibido de {sender}: ID {audio_id}, Tipo {mime_type}")
-                log_message("Llega mensaje de audio", "INFO")
-                headers = {"Authorization": f"Bearer {ACCESS_TOKEN}"}
-                media_url = f"https://graph.facebook.com/v17.0/{audio_id}?fields=url"
-                import requests
-                response = requests.get(media_url, headers=headers)
-                media_info = response.json()
-                if "url" not in media_info:
-                    logging.error(f"No se encontró la URL del audio: {media_info}")
-                    return func.HttpResponse("No se pudo obtener el audio", status_code=500)
-                file_url = media_info["url"]
-                audio_response = requests.get(file_url, headers=headers)
-                audio_data = io.BytesIO(audio_response.content)
-                files = {"file": ("audio.ogg", audio_data, mime_type)}
-                from openai import OpenAI
-                client = OpenAI(api_key=get_openai_key())
-                transcript = client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=files["file"]
-                )
-                text = transcript.text
-                logging.info(f"Transcripción recibida: {text}")
-                log_message(f"Mensaje transcrito {text}", "INFO")
-                conversacion = crear_conversacion(text)
-                log_message(f"Conversación iniciada: {conversacion}", "INFO")
-            send_text_response(sender,"¡Hola! al continuar la conversación entendemos que aceptas el tratamiento de tus datos. \nPuedes saber mas de la política de aqui: https://www.funcionpublica.gov.co/eva/gestornormativo/norma.php?i=49981")
-            #send_text_response(sender, "Recuerda que hablas con un asistente virtual 😊 Durante toda la conversación, procura enviar tus solicitudes en un solo mensaje para poder ayudarte mejor.\nPara continuar, envíame:\n• Tu nombre\n• Tu dirección")
-            send_text_response(sender, "Para continuar, envíame:\n• Tu nombre\n• Tu dirección (Recuerda mencionar tu barrio y cualquier referencia adicional que facilite la ubicación)")
-            return func.HttpResponse("Cliente no registrado, esperando datos", status_code=200)
-        ####################################
-        ########### CLIENTE EXISTENTE ######
-        ####################################
+        if MODO_WEBHOOK == "cola":
+            return _encolar_evento(req_body)
+        grupos: Dict[str, List[Dict[str, Any]]] = agrupar_mensajes_por_remitente(req_body)
+        if not grupos:
+            return _procesar_evento(req_body)
+        # Los mensajes esperan la ventana de coalescencia del remitente; un solo turno a la vez
+        # por teléfono y teléfonos distintos en paralelo
+        coalescedor = obtener_coalescedor()
+        despachador = obtener_despachador()
+        for sender, mensajes in grupos.items():
+            coalescedor.agregar(sender, mensajes)
+        futuros = [
+            despachador.enviar(sender, _procesar_turno_coalescido, sender)
+            for sender in grupos
+        ]
+        respuesta: func.HttpResponse = func.HttpResponse("EVENT_RECEIVED", status_code=200)
+        for futuro in futuros:
+            respuesta = futuro.result()
+        return respuesta
+    except Exception as e:
+        log_message(f'Error al hacer uso de función <ProcessMessage>: {e}.', 'ERROR')
+        logging.error(f"⚠️ Error procesando POST: {e}")
+        return func.HttpResponse("Error", status_code=400)
+
+def _encolar_evento(req_body: Dict[str, Any]) -> func.HttpResponse:
+    """Persiste el evento crudo en la cola y responde a Meta sin esperar el procesamiento."""
+    grupos: Dict[str, List[Dict[str, Any]]] = agrupar_mensajes_por_remitente(req_body)
+    if not grupos:
+        logging.info("No hay mensajes en el evento. Puede ser una notificación de estado.")
+        return func.HttpResponse("Sin mensajes para procesar", status_code=200)
+    # Un evento por remitente: el worker conserva el orden por teléfono y paraleliza entre teléfonos
+    cola = obtener_cola()
+    for sender, mensajes in grupos.items():
+        cola.encolar(sender, evento_de_remitente(mensajes))
+    return func.HttpResponse("EVENT_RECEIVED", status_code=200)
+
+def _procesar_evento(req_body: Dict[str, Any]) -> func.HttpResponse:
+    """Ejecuta el flujo completo para todos los mensajes de un evento de Meta, un turno por remitente."""
+    grupos: Dict[str, List[Dict[str, Any]]] = agrupar_mensajes_por_remitente(req_body)
+    if not grupos:
+        logging.info("No hay mensajes en el evento. Puede ser una notificación de estado.")
+        return func.HttpResponse("Sin mensajes para procesar", status_code=200)
+    respuesta: func.HttpResponse = func.HttpResponse("EVENT_RECEIVED", status_code=200)
+    for sender, mensajes in grupos.items():
+        respuesta = _procesar_grupo(sender, mensajes)
+    return respuesta
+
+def _procesar_turno_coalescido(sender: str) -> func.HttpResponse:
+    """Cierra la ventana de coalescencia del remitente y procesa lo acumulado como un turno."""
+    mensajes: List[Dict[str, Any]] = obtener_coalescedor().esperar_y_tomar(sender)
+    if not mensajes:
+        return func.HttpResponse("Mensajes agrupados en el turno anterior", status_code=200)
+    return _procesar_grupo(sender, mensajes)
+
+def _procesar_grupo(sender: str, mensajes: List[Dict[str, Any]]) -> func.HttpResponse:
+    """
+    Procesa como un solo turno los mensajes de un remitente que llegaron en el mismo evento:
+    dedup por mensaje (se deshace si el turno falla) y una sola obtención de contexto y
+    clasificación para todos los textos.
+    """
+    set_sender(sender)
+    fijar_deadline(TURNO_DEADLINE_SEGUNDOS)
+    iniciar_presupuesto_llm()
+    iniciar_conteo_consultas()
+    try:
+        nuevos: List[Dict[str, Any]] = []
+        for message in mensajes:
+            if validate_duplicated_message(message["id"], message.get("timestamp")):
+                logging.info(f"Mensaje duplicado: {message['id']}")
+                continue
+            nuevos.append(message)
+        if not nuevos:
+            return func.HttpResponse("Mensaje duplicado", status_code=200)
+        logging.info(f"Tipos de mensaje recibidos de {sender}: {[m['type'] for m in nuevos]}")
+        try:
+            ####################################
+            ############ CLIENTE NUEVO  ############
+            ####################################
+            if not get_client_database(sender, ID_RESTAURANTE):
+                return _procesar_cliente_nuevo(sender, nuevos)
+            ####################################
+            ########### CLIENTE EXISTENTE ######
+            ####################################
+            return _procesar_cliente_existente(sender, nuevos)
+        except Exception:
+            # El turno falló: sin liberar los ids, el reintento de la cola (o de Meta) se tomaría como duplicado
+            for message in nuevos:
+                liberar_mensaje(message["id"], message.get("timestamp"))
+            raise
+    finally:
+        consultas: int = consultas_contadas()
+        incrementar("turno.turnos")
+        incrementar("turno.consultas_bd", consultas)
+        logging.info(f"Consultas a BD en el turno de {sender}: {consultas}")
+
+def _transcribir_audio(sender: str, message: Dict[str, Any]) -> Optional[str]:
+    """Transcribe el audio de Meta (ver utils_transcripcion). Retorna None si no hay audio utilizable."""
+    log_message("Llega mensaje de audio", "INFO")
+    audio_id = message["audio"]["id"]
+    mime_type = message["audio"].get("mime_type", "")
+    logging.info(f"Audio recibido de {sender}: ID {audio_id}, Tipo {mime_type}")
+    try:
+        text = transcribir_audio(audio_id, mime_type, ACCESS_TOKEN)
+    except AudioRechazado as e:
+        log_message(f"Audio rechazado ({e.motivo}): {e}", "WARN")
+        send_text_response(sender, "Tu audio es muy largo para procesarlo 🙏 ¿Me lo puedes enviar más corto o escribirme tu mensaje?")
+        return None
+    if text:
+        logging.info(f"Transcripción recibida: {text}")
+        log_message(f"Mensaje transcrito {text}", "INFO")
+    return text
+
+def _texto_de_mensaje(sender: str, message: Dict[str, Any]) -> Optional[str]:
+    """Texto de un mensaje de texto o audio; None si el mensaje no trae texto utilizable."""
+    if message["type"] == "text":
+        text: str = message.get("text", {}).get("body", "")
+        if not text:
+            logging.warning("⚠️ Mensaje recibido sin texto.")
+            return None
+        return text
+    if message["type"] == "audio":
+        return _transcribir_audio(sender, message)
+    return None
+
+def _procesar_cliente_nuevo(sender: str, mensajes: List[Dict[str, Any]]) -> func.HttpResponse:
+    log_message("Cliente nuevo detectado", "INFO")
+    datos: str = None
+    nombre_temp: str = handle_create_client(sender, datos, ID_RESTAURANTE, False)
+    log_message(f"Cliente creado en base de datos: {nombre_temp}", "INFO")
+    conversacion_creada: bool = False
+    for message in mensajes:
+        text: Optional[str] = _texto_de_mensaje(sender, message)
+        if not text:
+            continue
+        if conversacion_creada:
+            conversacion = actualizar_conversacion(text, sender, "usuario")
         else:
-            log_message("Cliente existente detectado", "INFO")
-            nombre_cliente = get_client_name_database(sender, ID_RESTAURANTE)
-            if tipo_general == "text":
-                text: str = message.get("text", {}).get("body", "")
-                conversacion = actualizar_conversacion(text,sender,"usuario")
-                if not text:
-                    logging.warning("⚠️ Mensaje recibido sin texto.")
-                    return func.HttpResponse("Mensaje vacío", status_code=200)
-            elif message["type"] == "audio":
-                    log_message("Llega mensaje de audio", "INFO")
-                    from openai import OpenAI
-                    import requests
-                    client = OpenAI(api_key=get_openai_key())
-                    audio_id = message["audio"]["id"]
-                    mime_type = message["audio"]["mime_type"]
-                    logging.info(f"Audio recibido de {sender}: ID {audio_id}, Tipo {mime_type}")
-                    headers = {"Authorization": f"Bearer {ACCESS_TOKEN}"}
-                    media_url = f"https://graph.facebook.com/v17.0/{audio_id}?fields=url"
-                    response = requests.get(media_url, headers=headers)
-                    media_info = response.json()
-                    if "url" not in media_info:
-                        logging.error(f"No se encontró la URL del audio: {media_info}")
-                        return func.HttpResponse("No se pudo obtener el audio", status_code=500)
-                    file_url = media_info["url"]
-                    audio_response = requests.get(file_url, headers=headers)
-                    audio_data = io.BytesIO(audio_response.content)
-                    files = {"file": ("audio.ogg", audio_data, mime_type)}
-                    transcript = client.audio.transcriptions.create(
-                        model="whisper-1",
-                        file=files["file"]
-                    )
-                    text = transcript.text
-                    conversacion = actualizar_conversacion(text,sender,"usuario")
-                    logging.info(f"Transcripción recibida: {text}")
-                    log_message(f"Mensaje transcrito {text}", "INFO")
-            elif tipo_general == "location" and validate_direction_first_time(sender, ID_RESTAURANTE) is False:
-                latitude_temp = message["location"]["latitude"]
-                longitude_temp = message["location"]["longitude"]
-                log_message(f"Ubicación recibida: lat {latitude_temp}, lon {longitude_temp}", "INFO")
-                calcular_distancia_entre_sede_y_cliente(sender, latitude_temp, longitude_temp, ID_RESTAURANTE, nombre_cliente)
-                update_dir_primera_vez(sender, ID_RESTAURANTE, True)
-                return func.HttpResponse("EVENT_RECEIVED", status_code=200)
-            elif tipo_general == "location" and validate_direction_first_time(sender, ID_RESTAURANTE) is True:
-                latitude_temp = message["location"]["latitude"]
-                longitude_temp = message["location"]["longitude"]
-                log_message(f"Ubicación recibida: lat {latitude_temp}, lon {longitude_temp}", "INFO")
-                orquestador_ubicacion_exacta(sender, latitude_temp, longitude_temp, ID_RESTAURANTE, nombre_cliente)    
-            elif tipo_general == "image":
-                # No procesamos el contenido de la imagen; la tratamos como comprobante
-                image_id = message["image"].get("id")
-                mime_type = message["image"].get("mime_type", "")
-                log_message(f"Imagen recibida de {sender}: ID {image_id}, Tipo {mime_type}", "INFO")
-                # Guardar un registro sencillo en la base y clasificar como "validacion_pago"
-                # Llamar al manejador de diálogo como si el usuario pidiera validar pago
-                manejar_dialogo(
-                    sender=sender,
-                    clasificacion_mensaje="validacion_pago",
-                    nombre_cliente=nombre_cliente,
-                    entidades_text={},
-                    pregunta_usuario="[imagen_pago]",
-                    bandera_externo=False,
-                    id_ultima_intencion="",
-                    nombre_local="Sierra Nevada",
-                    type_text = "image"
-                )
-                return func.HttpResponse("EVENT_RECEIVED", status_code=200)
-            else:
-                logging.warning(f"⚠️ Tipo de mensaje no soportado: {tipo_general}")
-                send_text_response(sender, "Por el momento solo puedo procesar mensajes de texto.Intenta de nuevo con un mensaje escrito o de voz.")
-                return func.HttpResponse("Tipo de mensaje no soportado", status_code=200)
-                # Clasificación con modelo OpenAI
-            log_message(f"Empieza a clasificar con text {text}", "INFO")
+            conversacion = crear_conversacion(text)
+            conversacion_creada = True
+        log_message(f"Conversación iniciada: {conversacion}", "INFO")
+    send_text_response(sender,"¡Hola! al continuar la conversación entendemos que aceptas el tratamiento de tus datos. \nPuedes saber mas de la política de aqui: https://www.funcionpublica.gov.co/eva/gestornormativo/norma.php?i=49981")
+    send_text_response(sender, "Para continuar, envíame:\n• Tu nombre\n• Tu dirección (Recuerda mencionar tu barrio y cualquier referencia adicional que facilite la ubicación)")
+    return func.HttpResponse("Cliente no registrado, esperando datos", status_code=200)
+
+def _procesar_cliente_existente(sender: str, mensajes: List[Dict[str, Any]]) -> func.HttpResponse:
+    log_message("Cliente existente detectado", "INFO")
+    nombre_cliente: str = get_client_name_database(sender, ID_RESTAURANTE)
+    textos: List[str] = []
+    for message in mensajes:
+        tipo_general = message["type"]
+        if tipo_general in ("text", "audio"):
+            text: Optional[str] = _texto_de_mensaje(sender, message)
             if text:
-                if not validate_direction_first_time(sender, ID_RESTAURANTE) or not validate_nombre_bool(sender, ID_RESTAURANTE):
-                    direccion_json = get_direction(text)
-                    direccion = None
-                    observaciones = None
-                    if isinstance(direccion_json, dict):
-                        log_message(f'Dirección en formato JSON recibida: {direccion_json}', 'INFO')
-                        direccion = direccion_json.get("direccion")
-                        observaciones = direccion_json.get("observaciones")
-                    else:
-                        direccion = direccion_json
-                    nombre=get_name(text)
-                    booleano_dir: bool = True
-                    if direccion and not validate_direction_first_time(sender, ID_RESTAURANTE):
-                        #send_text_response(sender, "Gracias , voy a validar que estes en nuestra cobertura dame un par de minutos.")
-                        logging.info(f"Usuario {sender} proporcionó una dirección.")
-                        log_message(f"Usuario {sender} proporcionó una dirección.", "INFO")
-                        geocode_and_assign(sender, direccion, ID_RESTAURANTE)
-                        datos_cliente_temp: dict = obtener_datos_cliente_por_telefono(sender, ID_RESTAURANTE)
-                        latitud_cliente: float = datos_cliente_temp.get("latitud", 0.0)
-                        longitud_cliente: float = datos_cliente_temp.get("longitud", 0.0)
-                        resultado=calcular_distancia_entre_sede_y_cliente(sender,latitud_cliente, longitud_cliente,ID_RESTAURANTE, nombre_cliente)
-                        #sede=buscar_sede_mas_cercana_dentro_area(latitud_cliente,longitud_cliente,ID_RESTAURANTE)
-                        sede=buscar_sede_mas_cercana(latitud_cliente,longitud_cliente,ID_RESTAURANTE)
-                        id_sede = sede["id"] if sede and "id" in sede else None
-                        nombre_sede = sede["nombre"] if sede and "nombre" in sede else "Caobos"
-                        update_dir_primera_vez(sender, ID_RESTAURANTE, True)
-                        if resultado is None:
-                            execute_query("""
-                                            UPDATE clientes_whatsapp
-                                            SET direccion_google = %s, id_sede= %s
-                                            WHERE telefono = %s AND id_restaurante = %s;
-                                            """, (None, id_sede, sender, ID_RESTAURANTE))
-                            booleano_dir = False
-                            log_message('El cliente está fuera de cobertura.', 'INFO')
-                        else :
-                            execute_query("""
-                                            UPDATE clientes_whatsapp
-                                            SET observaciones_dir = %s, id_sede= %s
-                                            WHERE telefono = %s AND id_restaurante = %s;
-                                            """, (observaciones, id_sede, sender, ID_RESTAURANTE))
-                            log_message(f'observaciones creadas en la base .{observaciones}', 'INFO')
-                    if nombre and not validate_nombre_bool(sender, ID_RESTAURANTE):
-                        execute_query("""
-                                        UPDATE clientes_whatsapp
-                                        SET nombre = %s
-                                        WHERE telefono = %s AND id_restaurante = %s;
-                        """, (nombre,sender, ID_RESTAURANTE))
-                        log_message(f'Cliente creado o actualizado exitosamente.{nombre}', 'INFO')
-                        update_nombre_bool(sender, ID_RESTAURANTE, True)
-                    if not validate_direction_first_time(sender, ID_RESTAURANTE):
-                        send_text_response(sender, "Por favor, comparteme tu dirección para continuar con el pedido.")
-                    if not validate_nombre_bool(sender, ID_RESTAURANTE):
-                        send_text_response(sender, "Por favor, indícame tu nombre para continuar con el pedido.")
-                    if booleano_dir is False:
-                        send_text_response(sender, f"No estas dentro de nuestra area de operación, puedes hacer tu pedido para recoger en tienda, la sede mas cercana a ti es {nombre_sede} o tambien puedes usar otra direccion para la entrega")
-                    if validate_direction_first_time(sender, ID_RESTAURANTE) and validate_nombre_bool(sender, ID_RESTAURANTE):
-                        nombre_sede=obtener_nombre_sede(sender)
-                        send_text_response(sender,f"¡Gracias por la información! 😊 Bienvenido a sierra nevada la cima del sabor la sede mas cercana a ti es {nombre_sede}")
-                        send_pdf_response(sender)                 
-                    return func.HttpResponse("EVENT_RECEIVED", status_code=200)
-                mensajes= obtener_contexto_conversacion(sender)
-                text = str(mensajes)
-                if len(mensajes) > 2:
-                    ultimo = mensajes[-1][0]["rol"]
-                    penultimo = mensajes[-2][0]["rol"]
+                actualizar_conversacion(text, sender, "usuario")
+                textos.append(text)
+        elif tipo_general == "location" and validate_direction_first_time(sender, ID_RESTAURANTE) is False:
+            latitude_temp = message["location"]["latitude"]
+            longitude_temp = message["location"]["longitude"]
+            log_message(f"Ubicación recibida: lat {latitude_temp}, lon {longitude_temp}", "INFO")
+            calcular_distancia_entre_sede_y_cliente(sender, latitude_temp, longitude_temp, ID_RESTAURANTE, nombre_cliente)
+            update_dir_primera_vez(sender, ID_RESTAURANTE, True)
+        elif tipo_general == "location":
+            latitude_temp = message["location"]["latitude"]
+            longitude_temp = message["location"]["longitude"]
+            log_message(f"Ubicación recibida: lat {latitude_temp}, lon {longitude_temp}", "INFO")
+            orquestador_ubicacion_exacta(sender, latitude_temp, longitude_temp, ID_RESTAURANTE, nombre_cliente)
+        elif tipo_general == "image":
+            # No procesamos el contenido de la imagen; la tratamos como comprobante
+            image_id = message["image"].get("id")
+            mime_type = message["image"].get("mime_type", "")
+            log_message(f"Imagen recibida de {sender}: ID {image_id}, Tipo {mime_type}", "INFO")
+            # Llamar al manejador de diálogo como si el usuario pidiera validar pago
+            manejar_dialogo(
+                sender=sender,
+                clasificacion_mensaje="validacion_pago",
+                nombre_cliente=nombre_cliente,
+                entidades_text={},
+                pregunta_usuario="[imagen_pago]",
+                bandera_externo=False,
+                id_ultima_intencion="",
+                nombre_local="Sierra Nevada",
+                type_text = "image"
+            )
+        else:
+            logging.warning(f"⚠️ Tipo de mensaje no soportado: {tipo_general}")
+            send_text_response(sender, "Por el momento solo puedo procesar mensajes de texto.Intenta de nuevo con un mensaje escrito o de voz.")
+    if not textos:
+        return func.HttpResponse("EVENT_RECEIVED", status_code=200)
+    # Todos los textos del remitente forman un solo turno
+    registrar_turno_fusionado(len(textos))
+    return _procesar_texto(sender, nombre_cliente, "\n".join(textos))
 
-                    if ultimo == "usuario" and penultimo == "usuario":
-                        mensajes = [
-                            "Recuerda enviar tus solicitudes en un único mensaje.",
-                            "Por favor, envía todas tus solicitudes en un solo mensaje.",
-                            "Ten presente que debes enviar tus solicitudes en un único mensaje.",
-                            "Recuerda enviar tus solicitudes juntas en un solo mensaje.",
-                            "Importante: envía tus solicitudes en un único mensaje."
-                            ]
+def _procesar_texto(sender: str, nombre_cliente: str, text: str) -> func.HttpResponse:
+    """Onboarding (nombre/dirección) o clasificación + subflujos para el texto del turno."""
+    log_message(f"Empieza a clasificar con text {text}", "INFO")
+    if not validate_direction_first_time(sender, ID_RESTAURANTE) or not validate_nombre_bool(sender, ID_RESTAURANTE):
+        # Dirección y nombre se extraen del mismo texto y no dependen entre sí
+        extraidos = en_paralelo({"direccion": lambda: get_direction(text), "nombre": lambda: get_name(text)}, nombre="onboarding")
+        direccion_json = extraidos["direccion"]
+        direccion = None
+        observaciones = None
+        if isinstance(direccion_json, dict):
+            log_message(f'Dirección en formato JSON recibida: {direccion_json}', 'INFO')
+            direccion = direccion_json.get("direccion")
+            observaciones = direccion_json.get("observaciones")
+        else:
+            direccion = direccion_json
+        nombre = extraidos["nombre"]
+        booleano_dir: bool = True
+        if direccion and not validate_direction_first_time(sender, ID_RESTAURANTE):
+            #send_text_response(sender, "Gracias , voy a validar que estes en nuestra cobertura dame un par de minutos.")
+            logging.info(f"Usuario {sender} proporcionó una dirección.")
+            log_message(f"Usuario {sender} proporcionó una dirección.", "INFO")
+            geocode_and_assign(sender, direccion, ID_RESTAURANTE)
+            datos_cliente_temp: dict = obtener_datos_cliente_por_telefono(sender, ID_RESTAURANTE)
+            latitud_cliente: float = datos_cliente_temp.get("latitud", 0.0)
+            longitud_cliente: float = datos_cliente_temp.get("longitud", 0.0)
+            resultado=calcular_distancia_entre_sede_y_cliente(sender,latitud_cliente, longitud_cliente,ID_RESTAURANTE, nombre_cliente)
+            #sede=buscar_sede_mas_cercana_dentro_area(latitud_cliente,longitud_cliente,ID_RESTAURANTE)
+            sede=buscar_sede_mas_cercana(latitud_cliente,longitud_cliente,ID_RESTAURANTE)
+            id_sede = sede["id"] if sede and "id" in sede else None
+            nombre_sede = sede["nombre"] if sede and "nombre" in sede else "Caobos"
+            update_dir_primera_vez(sender, ID_RESTAURANTE, True)
+            if resultado is None:
+                execute_query("""
+                                UPDATE clientes_whatsapp
+                                SET direccion_google = %s, id_sede= %s
+                                WHERE telefono = %s AND id_restaurante = %s;
+                                """, (None, id_sede, sender, ID_RESTAURANTE))
+                actualizar_perfil_cliente(sender, {"direccion_google": None, "id_sede": id_sede})
+                booleano_dir = False
+                log_message('El cliente está fuera de cobertura.', 'INFO')
+            else :
+                execute_query("""
+                                UPDATE clientes_whatsapp
+                                SET observaciones_dir = %s, id_sede= %s
+                                WHERE telefono = %s AND id_restaurante = %s;
+                                """, (observaciones, id_sede, sender, ID_RESTAURANTE))
+                actualizar_perfil_cliente(sender, {"observaciones_dir": observaciones, "id_sede": id_sede})
+                log_message(f'observaciones creadas en la base .{observaciones}', 'INFO')
+        if nombre and not validate_nombre_bool(sender, ID_RESTAURANTE):
+            execute_query("""
+                            UPDATE clientes_whatsapp
+                            SET nombre = %s
+                            WHERE telefono = %s AND id_restaurante = %s;
+            """, (nombre,sender, ID_RESTAURANTE))
+            actualizar_perfil_cliente(sender, {"nombre": nombre})
+            log_message(f'Cliente creado o actualizado exitosamente.{nombre}', 'INFO')
+            update_nombre_bool(sender, ID_RESTAURANTE, True)
+        if not validate_direction_first_time(sender, ID_RESTAURANTE):
+            send_text_response(sender, "Por favor, comparteme tu dirección para continuar con el pedido.")
+        if not validate_nombre_bool(sender, ID_RESTAURANTE):
+            send_text_response(sender, "Por favor, indícame tu nombre para continuar con el pedido.")
+        if booleano_dir is False:
+            send_text_response(sender, f"No estas dentro de nuestra area de operación, puedes hacer tu pedido para recoger en tienda, la sede mas cercana a ti es {nombre_sede} o tambien puedes usar otra direccion para la entrega")
+        if validate_direction_first_time(sender, ID_RESTAURANTE) and validate_nombre_bool(sender, ID_RESTAURANTE):
+            nombre_sede=obtener_nombre_sede(sender)
+            send_text_response(sender,f"¡Gracias por la información! 😊 Bienvenido a sierra nevada la cima del sabor la sede mas cercana a ti es {nombre_sede}")
+            send_pdf_response(sender)                 
+        return func.HttpResponse("EVENT_RECEIVED", status_code=200)
+    classification: str
+    type_text: str
+    entities_text: Dict[str, Any]
+    estado = obtener_estado_pedido(sender, ID_RESTAURANTE)
+    local = preclasificar(text, estado.get("estado_actual") if estado else None)
+    mensajes = obtener_contexto_conversacion(sender)
+    contexto = str(mensajes)
+    log_message("Contexto de conversación obtenido", "INFO", contexto=contexto)
+    if local is not None:
+        # Mensaje trivial resuelto por reglas: no se llama al clasificador LLM
+        classification, type_text, entities_text = local
+        log_message("Clasificación local", "INFO", intent=classification, texto=text)
+    else:
+        classification, type_text, entities_text = get_classifier(contexto, sender)
+    logging.info(
+        f"Clasificación: {classification}, Tipo: {type_text}, Entidades: {entities_text}"
+    )
+    manejar_dialogo(
+        sender=sender,
+        clasificacion_mensaje=classification,
+        nombre_cliente=nombre_cliente,
+        entidades_text=entities_text,
+        pregunta_usuario=contexto,
+        bandera_externo=False,
+        id_ultima_intencion="",
+        nombre_local="Sierra Nevada",
+        type_text = type_text
+    )
+    return func.HttpResponse("EVENT_RECEIVED", status_code=200)
 
-                        mensaje = random.choice(mensajes)
-                        send_text_response(sender, mensaje)   
-                        return func.HttpResponse("EVENT_RECEIVED", status_code=200)
-                log_message(f"Contexto de conversación obtenido: {text}", "INFO")
-                classification: str
-                type_text: str
-                entities_text: Dict[str, Any]
-                classification, type_text, entities_text = get_classifier(text, sender)
-                logging.info(
-                    f"Clasificación: {classification}, Tipo: {type_text}, Entidades: {entities_text}"
-                )
-                # Guardar mensaje en base de datos
-                manejar_dialogo(
-                    sender=sender,
-                    clasificacion_mensaje=classification,
-                    nombre_cliente=nombre_cliente,
-                    entidades_text=entities_text,
-                    pregunta_usuario=text,
-                    bandera_externo=False,
-                    id_ultima_intencion="",
-                    nombre_local="Sierra Nevada",
-                    type_text = type_text
-                )
-                return func.HttpResponse("EVENT_RECEIVED", status_code=200)
+@app.function_name(name="wpp_worker")
+@app.timer_trigger(schedule=COLA_CRON, arg_name="timer", run_on_startup=False, use_monitor=False)
+def wpp_worker(timer: func.TimerRequest) -> None:
+    """
+    Worker de la cola de eventos (MODO_WEBHOOK=cola):
+    drena los eventos persistidos por /wpp y ejecuta el flujo completo respetando el orden por remitente.
+    """
+    if MODO_WEBHOOK != "cola":
+        return
+    procesados: int = drenar_cola(_procesar_evento, tiempo_max=COLA_TIEMPO_MAX_DRENADO)
+    if procesados:
+        logging.info(f"Worker de cola procesó {procesados} eventos.")
+        log_message(f"Métricas del worker: {obtener_metricas()}", "INFO", cache_menu=estadisticas_cache_menu())
+    # La invocación del timer puede ser la última antes de que el host se recicle
+    vaciar_logs()
+
+@app.function_name(name="mantenimiento_idempotencia")
+@app.timer_trigger(schedule=IDEMPOTENCIA_CRON, arg_name="timer", run_on_startup=True, use_monitor=True)
+def mantenimiento_idempotencia(timer: func.TimerRequest) -> None:
+    """
+    Migra id_whatsapp_messages si hace falta (también al arrancar el host), crea las particiones
+    diarias de los próximos días y borra las vencidas.
+    """
+    try:
+        migrar_tabla_mensajes()
+        borradas: int = mantener_particiones_mensajes()
+        log_message(f"Mantenimiento de idempotencia: {borradas} particiones borradas.", "INFO")
     except Exception as e:
-        log_message(f'Error al hacer uso de función <ProcessMessage>: {e}.', 'ERROR')
-        logging.error(f"⚠️ Error procesando POST: {e}")
-        return func.HttpResponse("Error", status_code=400)
+        log_message(f"Error en mantenimiento de idempotencia: {e}", "ERROR")
+        logging.error(f"Error en mantenimiento de idempotencia: {e}")
+    vaciar_logs()
 
 @app.function_name(name="health_check")
 @app.route(route="health", auth_level=func.AuthLevel.ANONYMOUS, methods=["GET", "POST"])
@@ -0,0 +1,33 @@
+# indexar_embeddings.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Job offline: embebe los items activos en items.embedding (pgvector, índice HNSW). Solo recalcula
+# los items cuyo texto o modelo cambió; correrlo después de cambios al catálogo.
+# Uso: python indexar_embeddings.py [--forzar] [--probar "frase del cliente" [--k 10]]
+# Con EMBEDDINGS_BACKEND=local usa embeddings deterministas sin llamar a OpenAI.
+
+import argparse
+import time
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--forzar", action="store_true", help="recalcula todos los items")
+    parser.add_argument("--probar", default="", help="frase para mostrar los items más cercanos")
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    from utils_embeddings import buscar_items_similares, indexar_items, nombre_modelo
+
+    inicio = time.perf_counter()
+    resultado = indexar_items(forzar=args.forzar)
+    print(f"modelo={nombre_modelo()} revisados={resultado['revisados']} actualizados={resultado['actualizados']} "
+          f"tiempo={time.perf_counter() - inicio:.1f}s")
+    if args.probar:
+        buscar_items_similares(args.probar, k=args.k)  # calienta el embedding de la frase
+        inicio = time.perf_counter()
+        cercanos = buscar_items_similares(args.probar, k=args.k)
+        print(f"busqueda={(time.perf_counter() - inicio) * 1000:.1f}ms")
+        for iditem, similitud in cercanos:
+            print(f"{iditem:>8} {similitud:.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,18 @@
+# instalar_notificaciones_menu.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Job de despliegue: crea la función y los triggers que publican NOTIFY menu_cambios al cambiar
+# items o disponibilidad_items. Sin ellos el caché de menú por sede solo se invalida por TTL.
+# Uso: python instalar_notificaciones_menu.py (idempotente; correrlo una vez por despliegue)
+
+import sys
+
+def main():
+    from utils_menu import instalar_notificaciones_menu
+
+    if not instalar_notificaciones_menu():
+        print("No se pudieron instalar los triggers de menu_cambios (ver log).")
+        sys.exit(1)
+    print("Triggers de menu_cambios instalados en items y disponibilidad_items.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+# tests/conftest.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Los módulos utils_*.py viven en la raíz del repositorio.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,84 @@
+# tests/test_coalescencia.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Ventana de coalescencia con RelojManual: fusión dentro de la ventana, reinicio con cada mensaje
+# nuevo y entrega del turno al vencer, sin esperas reales.
+
+from typing import Any, Dict, List
+import pytest
+from utils_coalescencia import CoalescedorMensajes, RelojManual
+from utils_cola import ColaArchivo, evento_de_remitente
+
+SENDER = "573000000000"
+
+def _mensaje(message_id: str, timestamp: int) -> Dict[str, Any]:
+    return {"from": SENDER, "id": message_id, "timestamp": str(timestamp), "type": "text", "text": {"body": message_id}}
+
+def _ids(mensajes: List[Dict[str, Any]]) -> List[str]:
+    return [m["id"] for m in mensajes]
+
+def test_mensajes_dentro_de_la_ventana_se_fusionan():
+    reloj = RelojManual()
+    coalescedor = CoalescedorMensajes(1.5, reloj)
+    coalescedor.agregar(SENDER, [_mensaje("hola", 1)])
+    reloj.avanzar(0.5)
+    coalescedor.agregar(SENDER, [_mensaje("quiero una hamburguesa", 2)])
+    reloj.avanzar(0.5)
+    coalescedor.agregar(SENDER, [_mensaje("con papas", 3)])
+    assert coalescedor.restante(SENDER) == 1.5
+    reloj.avanzar(1.5)
+    assert _ids(coalescedor.esperar_y_tomar(SENDER)) == ["hola", "quiero una hamburguesa", "con papas"]
+
+def test_mensaje_nuevo_reinicia_la_ventana():
+    reloj = RelojManual()
+    coalescedor = CoalescedorMensajes(1.5, reloj)
+    coalescedor.agregar(SENDER, [_mensaje("hola", 1)])
+    reloj.avanzar(1.4)
+    assert coalescedor.restante(SENDER) == pytest.approx(0.1)
+    coalescedor.agregar(SENDER, [_mensaje("quiero una sierra", 2)])
+    assert coalescedor.restante(SENDER) == 1.5
+    reloj.avanzar(1.0)
+    assert coalescedor.restante(SENDER) == pytest.approx(0.5)
+
+def test_mensaje_que_llega_durante_la_espera_entra_al_mismo_turno():
+    class RelojConMensaje(RelojManual):
+        def dormir(self, segundos: float) -> None:
+            # A mitad de la espera llega otro mensaje del remitente y reinicia la ventana
+            if not self.llegaron:
+                self.llegaron = True
+                self.avanzar(segundos / 2)
+                coalescedor.agregar(SENDER, [_mensaje("con papas", 2)])
+                return
+            super().dormir(segundos)
+
+    reloj = RelojConMensaje()
+    reloj.llegaron = False
+    coalescedor = CoalescedorMensajes(1.5, reloj)
+    coalescedor.agregar(SENDER, [_mensaje("una sierra", 1)])
+    assert _ids(coalescedor.esperar_y_tomar(SENDER)) == ["una sierra", "con papas"]
+    assert reloj.ahora() == 0.75 + 1.5
+
+def test_tomar_al_vencer_entrega_en_orden_y_vacia_el_buffer():
+    reloj = RelojManual()
+    coalescedor = CoalescedorMensajes(1.5, reloj)
+    coalescedor.agregar(SENDER, [_mensaje("segundo", 20)])
+    coalescedor.agregar(SENDER, [_mensaje("primero", 10)])
+    reloj.avanzar(2.0)
+    assert coalescedor.restante(SENDER) == 0.0
+    assert _ids(coalescedor.tomar(SENDER)) == ["primero", "segundo"]
+    # Otro turno que esperaba al mismo remitente no encuentra nada que procesar
+    assert coalescedor.esperar_y_tomar(SENDER) == []
+
+def test_cola_archivo_respeta_la_ventana(tmp_path):
+    reloj = RelojManual(1000.0)
+    cola = ColaArchivo(str(tmp_path), reloj=reloj, ventana=1.5)
+    cola.encolar(SENDER, evento_de_remitente([_mensaje("hola", 1)]))
+    reloj.avanzar(1.0)
+    assert cola.reclamar() == []
+    cola.encolar(SENDER, evento_de_remitente([_mensaje("con papas", 2)]))
+    reloj.avanzar(1.0)
+    # El segundo evento reinició la ventana del remitente
+    assert cola.reclamar() == []
+    reloj.avanzar(0.5)
+    eventos = cola.reclamar()
+    assert len(eventos) == 2
+    assert {e["telefono"] for e in eventos} == {SENDER}
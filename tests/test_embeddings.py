@@ -0,0 +1,70 @@
+# tests/test_embeddings.py
+# Last modified: 2026-10-17 Juan Agudelo
+# menu_relevante con EMBEDDINGS_BACKEND=local: pgvector se reemplaza por coseno sobre embedding_local.
+
+import json
+import os
+import re
+import pytest
+import utils_embeddings
+from utils_embeddings import embedding_local, menu_relevante, texto_item
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+with open(os.path.join(RAIZ, "menu_muestra.json"), encoding="utf-8") as f:
+    MENU = json.load(f)
+
+class PgvectorFalso:
+    """Reemplaza execute_query de utils_embeddings: ORDER BY embedding <=> %s::vector LIMIT k sobre MENU."""
+
+    def __init__(self) -> None:
+        self.vectores = {item["iditem"]: embedding_local(texto_item(item)) for item in MENU}
+        self.consultas = []
+
+    def __call__(self, query, params=(), fetchone=False, fuera_de_unidad=False):
+        self.consultas.append(query)
+        consulta = [float(v) for v in params[0].strip("[]").split(",")]
+        ids = params[1] if len(params) == 3 else list(self.vectores)
+        k = int(re.search(r"LIMIT (\d+)", query).group(1))
+        similitudes = [(iditem, sum(a * b for a, b in zip(consulta, self.vectores[iditem]))) for iditem in ids]
+        return sorted(similitudes, key=lambda s: -s[1])[:k]
+
+@pytest.fixture
+def pgvector(monkeypatch):
+    base = PgvectorFalso()
+    monkeypatch.setattr(utils_embeddings, "EMBEDDINGS_BACKEND", "local")
+    monkeypatch.setattr(utils_embeddings, "EMBEDDINGS_RECORTAR_MENU", True)
+    monkeypatch.setattr(utils_embeddings, "execute_query", base)
+    utils_embeddings._consultas.clear()
+    return base
+
+def test_embedding_local_es_determinista_y_normalizado():
+    vector = embedding_local("Sierra Picante con jalapeños", 64)
+    assert vector == embedding_local("Sierra Picante con jalapeños", 64)
+    assert len(vector) == 64
+    assert sum(v * v for v in vector) == pytest.approx(1.0)
+
+def test_recorta_a_top_k_mas_incluidos_en_orden_del_menu(pgvector):
+    texto = "algo picante con jalapeños y tocineta"
+    consulta = embedding_local(texto)
+    similitud = {iditem: sum(a * b for a, b in zip(consulta, v)) for iditem, v in pgvector.vectores.items()}
+    top_3 = sorted(similitud, key=lambda iditem: -similitud[iditem])[:3]
+    incluido = next(item["iditem"] for item in reversed(MENU) if item["iditem"] not in top_3)
+
+    recorte = menu_relevante(texto, MENU, incluir_ids=[incluido], k=3)
+
+    ids = [item["iditem"] for item in recorte]
+    assert set(ids) == set(top_3) | {incluido}
+    assert 102 in ids  # Sierra Picante: jalapeños y tocineta
+    assert ids == [item["iditem"] for item in MENU if item["iditem"] in ids]
+
+def test_menu_menor_que_k_usa_el_menu_completo(pgvector):
+    assert menu_relevante("hamburguesa", MENU, k=len(MENU)) is None
+    assert pgvector.consultas == []
+
+def test_error_en_la_busqueda_usa_el_menu_completo(pgvector, monkeypatch):
+    def falla(*_, **__):
+        raise RuntimeError("extensión vector no instalada")
+
+    monkeypatch.setattr(utils_embeddings, "execute_query", falla)
+    assert menu_relevante("hamburguesa", MENU, k=3) is None
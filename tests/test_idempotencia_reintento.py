@@ -0,0 +1,67 @@
+# tests/test_idempotencia_reintento.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Un turno que falla en el worker vuelve a la cola y su reintento no se descarta como duplicado.
+
+import time
+import pytest
+import function_app
+import utils_cola
+import utils_idempotencia
+from utils_coalescencia import RelojManual
+
+class BaseFalsa:
+    """Reemplaza execute_query de utils_idempotencia con las llaves (dia, id) en memoria."""
+
+    def __init__(self) -> None:
+        self.filas = set()
+
+    def __call__(self, query, params=(), fetchone=False, fuera_de_unidad=False):
+        if "INSERT INTO id_whatsapp_messages" in query:
+            llave = (params[1], params[0])
+            if llave in self.filas:
+                return None
+            self.filas.add(llave)
+            return (1,)
+        if "DELETE FROM id_whatsapp_messages" in query:
+            self.filas.discard(tuple(params))
+            return None
+        return (0,)
+
+@pytest.fixture
+def base(monkeypatch):
+    base = BaseFalsa()
+    monkeypatch.setattr(utils_idempotencia, "execute_query", base)
+    utils_idempotencia._vistos.clear()
+    return base
+
+@pytest.fixture
+def cola(monkeypatch, tmp_path):
+    cola = utils_cola.ColaArchivo(directorio=str(tmp_path), reloj=RelojManual(), ventana=0)
+    monkeypatch.setattr(utils_cola, "_cola", cola)
+    return cola
+
+AHORA = str(int(time.time()))
+
+def _mensaje(message_id: str) -> dict:
+    return {"from": "573000000000", "id": message_id, "timestamp": AHORA, "type": "text", "text": {"body": "hola"}}
+
+def test_turno_fallido_se_reintenta_y_luego_se_procesa(base, cola, monkeypatch):
+    turnos = []
+
+    def procesar(sender, mensajes):
+        turnos.append([m["id"] for m in mensajes])
+        if len(turnos) == 1:
+            raise RuntimeError("OpenAI no respondió")
+        return "EVENT_RECEIVED"
+
+    monkeypatch.setattr(function_app, "get_client_database", lambda *_: True)
+    monkeypatch.setattr(function_app, "_procesar_cliente_existente", procesar)
+    monkeypatch.setattr(utils_cola, "log_message", lambda *_, **__: None)
+    cola.encolar("573000000000", utils_cola.evento_de_remitente([_mensaje("wamid.1")]))
+
+    # fallar() devuelve el evento a 'pendiente' y el mismo drenado lo reclama otra vez
+    assert utils_cola.drenar_cola(function_app._procesar_evento) == 1
+    assert turnos == [["wamid.1"], ["wamid.1"]]
+    assert len(base.filas) == 1
+    # Ya procesado: una nueva entrega de Meta con el mismo id sí es duplicado
+    assert function_app.validate_duplicated_message("wamid.1", AHORA) is True
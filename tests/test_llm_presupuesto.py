@@ -0,0 +1,28 @@
+# tests/test_llm_presupuesto.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Timeout y reintentos del SDK salen del presupuesto restante: la llamada completa no lo excede.
+
+import pytest
+import utils_llm
+from utils_llm import LLM_ESPERA_MAXIMA_REINTENTO_SEGUNDOS, reparto_presupuesto
+
+def _peor_caso(timeout: float, reintentos: int) -> float:
+    esperas = sum(min(0.5 * 2 ** i, LLM_ESPERA_MAXIMA_REINTENTO_SEGUNDOS) for i in range(reintentos))
+    return (reintentos + 1) * timeout + esperas
+
+@pytest.mark.parametrize("restante", [3.0, 5.0, 8.0, 12.0, 30.0, 49.9, 60.0, 200.0])
+def test_llamada_con_reintentos_no_excede_el_presupuesto(restante):
+    timeout, reintentos = reparto_presupuesto(restante, 25.0)
+    assert timeout <= 25.0
+    assert _peor_caso(timeout, reintentos) <= restante + 1e-9
+
+def test_con_poco_presupuesto_no_hay_reintentos():
+    timeout, reintentos = reparto_presupuesto(5.0, 25.0)
+    assert (timeout, reintentos) == (5.0, 0)
+
+def test_con_presupuesto_amplio_se_usan_todos_los_reintentos(monkeypatch):
+    monkeypatch.setattr(utils_llm, "OPENAI_MAX_REINTENTOS", 2)
+    assert reparto_presupuesto(200.0, 25.0) == (25.0, 2)
+
+def test_sin_presupuesto_se_deja_el_cliente_por_defecto():
+    assert reparto_presupuesto(None, 25.0) == (25.0, None)
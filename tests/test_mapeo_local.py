@@ -0,0 +1,64 @@
+# tests/test_mapeo_local.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Atajo local de mapear_pedido_al_menu: solo se toma si el turno completo se resuelve sin sobrantes.
+
+import json
+import os
+from types import SimpleNamespace
+import pytest
+import utils_chatgpt
+import utils_llm
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+with open(os.path.join(RAIZ, "menu_muestra.json"), encoding="utf-8") as f:
+    MENU = json.load(f)
+
+RESPUESTA_LLM = {
+    "intent": "ADD_ITEM",
+    "intent_confidence": 0.95,
+    "target_items": [],
+    "order_complete": False,
+    "items": []
+}
+
+def _contexto(*mensajes_usuario: str) -> str:
+    """Contexto con la forma de obtener_contexto_conversacion: respuesta del bot y luego el turno."""
+    mensajes = [({"rol": "bot", "texto": "¿Qué te gustaría pedir?"},)]
+    mensajes += [({"rol": "usuario", "texto": m},) for m in mensajes_usuario]
+    return str(mensajes)
+
+@pytest.fixture
+def llm(monkeypatch):
+    """Reemplaza OpenAI por un endpoint local y registra los prompts enviados."""
+    prompts = []
+
+    def create(**kwargs):
+        prompts.append(kwargs.get("input"))
+        texto = json.dumps(RESPUESTA_LLM)
+        return SimpleNamespace(output_text=texto, output=[SimpleNamespace(content=[SimpleNamespace(text=texto)])], usage=None)
+
+    endpoint = SimpleNamespace(create=create)
+    monkeypatch.setattr(utils_llm, "obtener_cliente_openai", lambda **_: SimpleNamespace(responses=endpoint, chat=SimpleNamespace(completions=endpoint)))
+    monkeypatch.setattr(utils_chatgpt, "obtener_pedido_en_proceso", lambda *_: "")
+    monkeypatch.setattr(utils_chatgpt, "menu_relevante", lambda *_, **__: None)
+    monkeypatch.setattr(utils_chatgpt, "tiene_pedido_en_curso", lambda *_: False)
+    monkeypatch.setattr(utils_chatgpt, "log_message", lambda *_, **__: None)
+    return prompts
+
+def test_turno_de_varios_mensajes_va_al_llm_si_sobra_texto(llm):
+    # "hamburguesa" no nombra un producto: el atajo no puede devolver solo las papas
+    resultado = utils_chatgpt.mapear_pedido_al_menu(_contexto("quiero una hamburguesa", "con papas"), MENU, "573000000000")
+    assert len(llm) == 1
+    assert resultado["order_complete"] is False
+
+def test_turno_de_varios_mensajes_resuelto_completo_es_local(llm):
+    resultado = utils_chatgpt.mapear_pedido_al_menu(_contexto("quiero una sierra clasica", "unas papas a la francesa"), MENU, "573000000000")
+    assert llm == []
+    assert resultado["order_complete"] is True
+    assert [i["matched"]["name"] for i in resultado["items"]] == ["Sierra Clásica", "Papas a la francesa"]
+
+def test_pedido_en_curso_en_base_va_al_llm(llm, monkeypatch):
+    monkeypatch.setattr(utils_chatgpt, "tiene_pedido_en_curso", lambda *_: True)
+    utils_chatgpt.mapear_pedido_al_menu(_contexto("una coca"), MENU, "573000000000")
+    assert len(llm) == 1
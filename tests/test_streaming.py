@@ -0,0 +1,39 @@
+# tests/test_streaming.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Un stream que falla después de enviar el mensaje no produce un segundo texto al cliente.
+
+from types import SimpleNamespace
+import pytest
+import utils_chatgpt
+import utils_llm
+
+def _chunk(texto: str) -> SimpleNamespace:
+    return SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content=texto))])
+
+def _stream_que_se_corta():
+    yield _chunk('{"mensaje": "¡Juan, aquí tienes el menú!"')
+    raise ConnectionError("se cortó el stream")
+
+@pytest.fixture
+def enviados(monkeypatch):
+    endpoint = SimpleNamespace(create=lambda **kwargs: _stream_que_se_corta())
+    monkeypatch.setattr(utils_llm, "obtener_cliente_openai", lambda **_: SimpleNamespace(chat=SimpleNamespace(completions=endpoint)))
+    monkeypatch.setattr(utils_chatgpt, "log_message", lambda *_, **__: None)
+    return []
+
+def test_fallo_despues_del_envio_no_reenvia(enviados):
+    resultado = utils_chatgpt.enviar_menu_digital("Juan", "Sierra Nevada", [], None, al_mensaje=enviados.append)
+    assert enviados == ["¡Juan, aquí tienes el menú!"]
+    # Quien llama solo envía resultado["mensaje"] si no se envió en streaming
+    assert resultado["enviado"] is True
+
+def test_fallo_antes_del_envio_deja_el_respaldo(monkeypatch, enviados):
+    def _stream_vacio():
+        raise ConnectionError("sin conexión")
+        yield
+
+    endpoint = SimpleNamespace(create=lambda **kwargs: _stream_vacio())
+    monkeypatch.setattr(utils_llm, "obtener_cliente_openai", lambda **_: SimpleNamespace(chat=SimpleNamespace(completions=endpoint)))
+    resultado = utils_chatgpt.enviar_menu_digital("Juan", "Sierra Nevada", [], None, al_mensaje=enviados.append)
+    assert enviados == []
+    assert resultado["enviado"] is False
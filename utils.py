@@ -7,40 +7,47 @@ import os
 from heyoo import WhatsApp
 import re
 import ast
+import sys
 from utils_database import execute_query, execute_query_columns
-import inspect
+from utils_logs import formatear_campos, log_habilitado, registrar_log
 import traceback
 from typing import Dict, Any, List
 from datetime import datetime, date, time
 from zoneinfo import ZoneInfo
-import json
 import requests
-import difflib
-from utils_contexto import get_sender,actualizar_conversacion,get_id_sede
+from utils_contexto import get_sender,actualizar_conversacion,get_id_sede,obtener_perfil_cliente,invalidar_perfil_cliente
+from utils_menu import obtener_cache_menu
+from utils_indice_productos import obtener_indice
+from utils_salidas import reparar_json
+from utils_idempotencia import registrar_mensaje
 
 
 def register_log(mensaje: str, tipo: str, ambiente: str = "Whatsapp", idusuario: int = 1, archivoPy: str = "", function_name: str = "",line_number: int = 0) -> None:
     try:
-        """Registra un log en la base de datos."""
-        query: str = """
-        INSERT INTO logs (ambiente, tipo, mensaje, fecha, idusuario, "archivoPy", function, "lineNumber", telefono)
-        VALUES (%s, %s, %s, (NOW() AT TIME ZONE 'America/Bogota'), %s, %s, %s, %s, %s)
-        """
+        """Registra un log en la base de datos (encolado; lo inserta por lotes utils_logs)."""
         telefono = get_sender()
-        params: tuple = (ambiente, tipo, mensaje, idusuario, archivoPy, function_name, line_number, telefono)
-        execute_query(query, params)
+        registrar_log(ambiente, tipo, mensaje, idusuario, archivoPy, function_name, line_number, telefono)
     except Exception as e:
         logging.error(f'Error al hacer uso de función <RegisterLog>: {e}.')
 
-def log_message(message: str, tipo: str) -> None:
+def log_message(message: str, tipo: str, **campos: Any) -> None:
     try:
-        """Registra un mensaje en el log con nivel INFO."""
-        caller_frame = inspect.stack()[1]
-        filename = os.path.basename(caller_frame.filename)
-        function_name = caller_frame.function
-        line_no = caller_frame.lineno
-        tb_str = traceback.format_exc()
-        if tb_str and "NoneType: None" not in tb_str:
+        """
+        Registra un mensaje en la tabla logs si el nivel está habilitado para el módulo que llama.
+        Los objetos grandes se pasan como campos (ej: log_message("Menú", "DEBUG", items=items));
+        solo se serializan si el registro se guarda.
+        """
+        # sys._getframe es O(1); inspect.stack() leía el código fuente de toda la pila
+        caller_frame = sys._getframe(1)
+        filename = os.path.basename(caller_frame.f_code.co_filename)
+        if not log_habilitado(tipo, filename):
+            return
+        function_name = caller_frame.f_code.co_name
+        line_no = caller_frame.f_lineno
+        if campos:
+            message += formatear_campos(campos)
+        if sys.exc_info()[0] is not None:
+            tb_str = traceback.format_exc()
             message += f"\nTRACEBACK:\n{tb_str.strip()}"
         register_log(message, tipo, ambiente="WhatsApp", idusuario=1, archivoPy=filename, function_name=function_name, line_number=line_no)
     except Exception as e:
@@ -78,56 +85,26 @@ def send_text_response(to: str, message: str) -> str:
 
 def limpiar_respuesta_json(raw: str) -> str:
     """
-    Convierte la respuesta cruda del clasificador en un JSON válido.
-    - Soporta respuestas tipo tupla de Python.
-    - Limpia bloque triple ```json.
-    - Repara estructuras comunes rotas.
+    Convierte la respuesta cruda del clasificador en un JSON válido (ver utils_salidas.reparar_json).
+    Las funciones con salida estructurada usan utils_salidas.parsear_salida, que cuenta las reparaciones.
     """
-    text: str = raw.strip()
-    # Caso: respuesta como tupla Python
-    if text.startswith("(") and text.endswith(")"):
-        try:
-            intent: str
-            type_: str
-            entities: dict[str, Any]
-            intent, type_, entities = ast.literal_eval(text)
-            if not isinstance(entities, dict):
-                entities = {}
-            obj: dict[str, Any] = {"intent": intent, "type": type_, "entities": entities}
-            return json.dumps(obj)
-        except Exception:
-            pass
-    # Caso: respuesta con bloque ```json
-    s: str = re.sub(r"^```json\s*", "", text)
-    s = re.sub(r"\s*```$", "", s)
-    # Extraer desde la primera llave
-    idx: int = s.find("{")
-    if idx != -1:
-        s = s[idx:]
-    # Reparaciones comunes
-    s = re.sub(r',\s*([\]}])', r"\1", s)
-    s += "]" * (s.count("[") - s.count("]"))
-    s += "}" * (s.count("{") - s.count("}"))
-    logging.info(f"JSON limpiado: {s}")
     try:
-        json.loads(s)
-    except json.JSONDecodeError as e:
+        s: str = reparar_json(raw)
+    except ValueError as e:
         log_message(f"JSON inválido tras limpieza: {e}", 'ERROR')
         logging.error(f"JSON inválido tras limpieza: {e}")
         raise ValueError(f"JSON inválido tras limpieza: {e}")
+    logging.info(f"JSON limpiado: {s}")
     return s
 
-def validate_duplicated_message(message_id: str) -> bool:
+def validate_duplicated_message(message_id: str, timestamp: Any = None) -> bool:
     try:
-        """Valida si un mensaje de WhatsApp ya fue procesado usando su ID único."""
-        resultTemp = execute_query("""Select * from id_whatsapp_messages where id_messages = %s;""", (message_id,))
-        if len(resultTemp)>0:
-            logging.info('Mensaje ya registrado.')
-            return True
-        else:
+        """Valida si un mensaje de WhatsApp ya fue procesado usando su ID único (ver utils_idempotencia)."""
+        if registrar_mensaje(message_id, timestamp):
             logging.info('Mensaje no registrado.')
-            execute_query("""Insert into id_whatsapp_messages(id_messages) values (%s);""", (message_id,))
             return False
+        logging.info('Mensaje ya registrado.')
+        return True
     except Exception as e:
         log_message(f'Error al hacer uso de función <ValidarMensajeDuplicado>: {e}.', 'ERROR')
         logging.error(f'Error al hacer uso de función <ValidarMensajeDuplicado>: {e}.')
@@ -135,19 +112,10 @@ def validate_duplicated_message(message_id: str) -> bool:
 def get_client_database(numero_celular: str, id_restaurante: str) -> bool:
     try:
         """Verifica si un cliente existe en la base de datos por su número de celular y no es temporal."""
-        query = """
-            SELECT 1
-            FROM clientes_whatsapp
-            WHERE telefono = %s
-              AND id_restaurante = %s
-            LIMIT 1;
-        """
-        log_message(f'Consulta SQL: {query} con parámetros ({numero_celular}, {id_restaurante})', 'INFO')
-        resultado = execute_query(query, (numero_celular, id_restaurante))
-        logging.info(f"Resultado de la consulta: {resultado}")
-        log_message(f"Resultado de la consulta: {resultado}", "INFO")
-        # Devolver booleano seguro (maneja None y colecciones vacías)
-        return bool(resultado) and len(resultado) > 0
+        existe = obtener_perfil_cliente(numero_celular, id_restaurante) is not None
+        logging.info(f"Cliente {numero_celular} existe: {existe}")
+        log_message(f"Cliente {numero_celular} existe: {existe}", "INFO")
+        return existe
 
     except Exception as e:
         log_message(f'Error al hacer uso de función <get_client_database>: {e}.', 'ERROR')
@@ -175,6 +143,7 @@ def handle_create_client(sender: str, datos: str, id_restaurante: str, es_tempor
                 id_restaurante = EXCLUDED.id_restaurante,
                 id_sede = EXCLUDED.id_sede;
         """, (nombre, sender, id_restaurante, es_temporal,id_sede))
+        invalidar_perfil_cliente(sender)
 
         log_message(f'Cliente creado o actualizado exitosamente.{nombre}', 'INFO')
         return nombre.split()[0]  # Retorna el primer nombre
@@ -188,13 +157,9 @@ def get_client_name_database(sender: str, id_restaurante: str) -> str:
         """Obtiene el nombre del cliente en la base de datos"""
         logging.info(f'Buscando cliente con teléfono: {sender}')
         log_message(f"Busca nombre de cliente con {sender}", "INFO")
-        resultado = execute_query(
-            "SELECT nombre FROM clientes_whatsapp WHERE telefono = %s AND id_restaurante = %s LIMIT 1;",
-            (sender,id_restaurante),
-            fetchone=True
-        )
-        if resultado:
-            nombre = resultado[0].split()[0]
+        perfil = obtener_perfil_cliente(sender, id_restaurante)
+        if perfil and perfil.get("nombre"):
+            nombre = perfil["nombre"].split()[0]
         else:
             logging.info('No se encontró ningún cliente con ese número.', "INFO")
             log_message(f"No se encontró cliente con {sender}", "INFO")
@@ -363,41 +328,45 @@ def borrar_intencion_futura(telefono: str) -> bool:
         log_message(f"Error al eliminar registro para {telefono}: {e}", "ERROR")
         return False
 
+def _cargar_menu_sede(id_sede: Any) -> list[dict[str, Any]]:
+    query = """
+        SELECT
+            i.iditem,
+            i.nombre, 
+            i.tipo_comida, 
+            i.descripcion, 
+            i.observaciones, 
+            i.precio
+        FROM public.items i
+        INNER JOIN public.disponibilidad_items d
+            ON i.iditem = d.id_item
+        WHERE i.estado = true
+            AND d.disponible = true
+            AND d.id_sede = %s
+        ORDER BY i.tipo_comida, i.nombre;
+    """
+    items_data = execute_query(query, (id_sede,))
+    items = [
+        {   
+            "iditem": row[0],
+            "nombre": row[1],
+            "tipo_comida": row[2],
+            "descripcion": row[3],
+            "observaciones": row[4],
+            "precio": float(row[5]) if row[5] is not None else 0.0
+        }
+        for row in items_data
+        ]
+    log_message("Menú obtenido exitosamente.", "INFO", cantidad_items=len(items))
+    log_message("Menú", "DEBUG", items=items)
+    return items
+
 def obtener_menu() -> list[dict[str, Any]]:
+    """ Menú disponible de la sede actual; se sirve del caché por sede (utils_menu.CacheMenu). """
     try:
         id_sede=get_id_sede()
         log_message(f"ID sede para obtener menú: {id_sede}","INFO")
-        query = """
-            SELECT
-                i.iditem,
-                i.nombre, 
-                i.tipo_comida, 
-                i.descripcion, 
-                i.observaciones, 
-                i.precio
-            FROM public.items i
-            INNER JOIN public.disponibilidad_items d
-                ON i.iditem = d.id_item
-            WHERE i.estado = true
-                AND d.disponible = true
-                AND d.id_sede = %s
-            ORDER BY i.tipo_comida, i.nombre;
-        """
-        items_data = execute_query(query, (id_sede,))
-        items = [
-            {   
-                "iditem": row[0],
-                "nombre": row[1],
-                "tipo_comida": row[2],
-                "descripcion": row[3],
-                "observaciones": row[4],
-                "precio": float(row[5]) if row[5] is not None else 0.0
-            }
-            for row in items_data
-            ]
-        log_message("Menú obtenido exitosamente.", "INFO")
-        log_message(f"Menú: {items}", "INFO")
-        return items
+        return obtener_cache_menu().obtener(id_sede, lambda: _cargar_menu_sede(id_sede))
     except Exception as e:
         log_message(f"Error al obtener el menú: {e}", "ERROR")
         return []
@@ -406,13 +375,12 @@ def guardar_pedido_completo(sender: str, pedido_dict: dict, es_temporal: bool =
     try:
         """ Guarda un pedido completo en la BD y retorna: { "idpedido": X, "codigo_unico": "P-00015" } """
         # ------------------------------- # 1. Obtener id_whatsapp # -------------------------------
-        q_idw = "SELECT * FROM clientes_whatsapp WHERE telefono = %s"
-        res_idw = execute_query(q_idw, (sender,), fetchone=True)
-        log_message(f"[GuardarPedidoCompleto] Resultado consulta id_whatsapp: {res_idw}", "INFO")
-        id_whatsapp = res_idw[0] if res_idw else None
-        idsede = res_idw[11] if res_idw else 17
-        direccion = res_idw[5] if res_idw else None
-        observaciones = res_idw[19] if res_idw else None
+        perfil = obtener_perfil_cliente(sender) or {}
+        log_message(f"[GuardarPedidoCompleto] Resultado consulta id_whatsapp: {perfil}", "INFO")
+        id_whatsapp = perfil.get("id_whatsapp")
+        idsede = perfil.get("id_sede", 17)
+        direccion = perfil.get("direccion_google")
+        observaciones = perfil.get("observaciones_dir")
         if direccion is not None:
             direccion= direccion + (" | " + observaciones if observaciones else "")
         logging.info(f"[GuardarPedidoCompleto] id_whatsapp para {sender}: {id_whatsapp}")
@@ -593,9 +561,8 @@ def _price_of_item(it: Dict) -> float:
 def marcar_estemporal_true_en_pedidos(sender,codigo_unico) -> dict:
     """Marca es_temporal = FALSE en el pedido del cliente."""
     try:
-        q_idw = "SELECT id_whatsapp FROM clientes_whatsapp WHERE telefono = %s"
-        res_idw = execute_query(q_idw, (sender,), fetchone=True)
-        id_whatsapp = res_idw[0] if res_idw else None
+        perfil = obtener_perfil_cliente(sender)
+        id_whatsapp = perfil.get("id_whatsapp") if perfil else None
 
         if id_whatsapp is None:
             return {
@@ -655,9 +622,8 @@ def marcar_estemporal_true_en_pedidos(sender,codigo_unico) -> dict:
 def marcar_pedido_como_definitivo(sender: str, codigo_unico: str) -> dict:
     """MARCA UN PEDIDO COMO TRUE EN ES_TEMPORAL Y RETORNA INFO DEL PEDIDO ACTUALIZADO."""
     try:
-        q_idw = "SELECT id_whatsapp FROM clientes_whatsapp WHERE telefono = %s"
-        res_idw = execute_query(q_idw, (sender,), fetchone=True)
-        id_whatsapp = res_idw[0] if res_idw else None
+        perfil = obtener_perfil_cliente(sender)
+        id_whatsapp = perfil.get("id_whatsapp") if perfil else None
 
         if id_whatsapp is None:
             return {
@@ -691,9 +657,8 @@ def marcar_pedido_como_definitivo(sender: str, codigo_unico: str) -> dict:
     
 def obtener_pedido_por_codigo_orignal(sender: str, codigo_unico: str) -> dict:
     try:
-        q_idw = "SELECT id_whatsapp FROM clientes_whatsapp WHERE telefono = %s"
-        res_idw = execute_query(q_idw, (sender,), fetchone=True)
-        id_whatsapp = res_idw[0] if res_idw else None
+        perfil = obtener_perfil_cliente(sender)
+        id_whatsapp = perfil.get("id_whatsapp") if perfil else None
 
         if id_whatsapp is None:
             return {
@@ -767,16 +732,16 @@ def convert_decimals(obj):
     try:
         """Convierte objetos Decimal en float dentro de estructuras anidadas."""
         if isinstance(obj, dict):
-            log_message('Convirtiendo diccionario en <ConvertDecimals>.', 'INFO')
+            log_message('Convirtiendo diccionario en <ConvertDecimals>.', 'DEBUG')
             return {k: convert_decimals(v) for k, v in obj.items()}
         elif isinstance(obj, list):
-            log_message('Convirtiendo lista en <ConvertDecimals>.', 'INFO')
+            log_message('Convirtiendo lista en <ConvertDecimals>.', 'DEBUG')
             return [convert_decimals(i) for i in obj]
         elif isinstance(obj, Decimal):
-            log_message('Convirtiendo Decimal en <ConvertDecimals>.', 'INFO')
+            log_message('Convirtiendo Decimal en <ConvertDecimals>.', 'DEBUG')
             return float(obj)  # o str(obj) si prefieres exactitud
         else:
-            log_message('No se requiere conversión en <ConvertDecimals>.', 'INFO')
+            log_message('No se requiere conversión en <ConvertDecimals>.', 'DEBUG')
             return obj
     except Exception as e:
         log_message(f'Error en <ConvertDecimals>: {e}', 'ERROR')
@@ -846,9 +811,8 @@ def actualizar_total_productos(sender: str, codigo_unico: str, nuevo_total: floa
 
 def actualizar_medio_pago(sender: str, codigo_unico: str, metodo_pago: str) -> dict:
     try:
-        q_idw = "SELECT id_whatsapp FROM clientes_whatsapp WHERE telefono = %s"
-        res_idw = execute_query(q_idw, (sender,), fetchone=True)
-        id_whatsapp = res_idw[0] if res_idw else None
+        perfil = obtener_perfil_cliente(sender)
+        id_whatsapp = perfil.get("id_whatsapp") if perfil else None
 
         if id_whatsapp is None:
             return {
@@ -899,23 +863,10 @@ def obtener_pedido_por_codigo(codigo_unico: str) -> dict:
 
 # Helper: buscar producto en el menu (obtiene nombre oficial y precio)
 def match_item_to_menu(product_name: str, items_menu: List[dict]) -> dict:
-    # items_menu: lista de dicts; intentamos buscar por keys comunes 'name','price' o 'nombre','precio'
-    nombres = []
-    mapping = {}
-    for it in items_menu:
-        name = it.get("name") or it.get("nombre") or it.get("producto") or ""
-        price = it.get("price") or it.get("precio") or 0.0
-        nombres.append(name)
-        mapping[name] = price
-    # buscar coincidencia exacta (case-insensitive)
-    for n in nombres:
-        if n.lower() == product_name.lower():
-            return {"name": n, "price": float(mapping[n]), "found": True}
-    # fuzzy match
-    match = difflib.get_close_matches(product_name, nombres, n=1, cutoff=0.6)
-    if match:
-        n = match[0]
-        return {"name": n, "price": float(mapping[n]), "found": True}
+    # Índice por versión del menú (tokens normalizados, alias y trigramas); se construye una sola vez
+    producto = obtener_indice(items_menu).resolver(product_name)
+    if producto:
+        return {"name": producto["name"], "price": float(producto["price"]), "id": producto["id"], "found": True}
     # no encontrado
     return {"name": product_name, "price": 0.0, "found": False}
 
@@ -925,24 +876,18 @@ def obtener_datos_cliente_por_telefono(telefono: str, id_restaurante: str):
     Si no existe devuelve None.
     """
     try:
-        query = """
-            SELECT latitud, longitud, id_sede
-            FROM clientes_whatsapp
-            WHERE telefono = %s AND id_restaurante = %s;
-        """
-        
-        resultado = execute_query(query, (telefono, id_restaurante), fetchone=True)
-        log_message(f"Datos del cliente obtenidos para {telefono}: {resultado}", "INFO")
-        if not resultado:
+        perfil = obtener_perfil_cliente(telefono, id_restaurante)
+        if not perfil:
             log_message(f"No se encontró cliente con teléfono {telefono}", "INFO")
             return None
 
-        latitud, longitud, id_sede = resultado
-        return {
-            "latitud": latitud,
-            "longitud": longitud,
-            "id_sede": id_sede
+        datos = {
+            "latitud": perfil.get("latitud"),
+            "longitud": perfil.get("longitud"),
+            "id_sede": perfil.get("id_sede")
         }
+        log_message(f"Datos del cliente obtenidos para {telefono}: {datos}", "INFO")
+        return datos
     except Exception as e:
         log_message(f"Error en obtener_datos_cliente_por_telefono: {e}", "ERROR")
         return None
@@ -956,9 +901,8 @@ def obtener_pedido_pendiente_reciente(sender: str) -> dict:
     """
     try:
         # 1. Obtener id_whatsapp
-        q_idw = "SELECT id_whatsapp FROM clientes_whatsapp WHERE telefono = %s"
-        res_idw = execute_query(q_idw, (sender,), fetchone=True)
-        id_whatsapp = res_idw[0] if res_idw else None
+        perfil = obtener_perfil_cliente(sender)
+        id_whatsapp = perfil.get("id_whatsapp") if perfil else None
 
         if id_whatsapp is None:
             return {
@@ -1011,9 +955,8 @@ def actualizar_costos_y_tiempos_pedido(
     """
     try:
         # 1. Obtener id_whatsapp
-        q_idw = "SELECT id_whatsapp FROM clientes_whatsapp WHERE telefono = %s"
-        res_idw = execute_query(q_idw, (sender,), fetchone=True)
-        id_whatsapp = res_idw[0] if res_idw else None
+        perfil = obtener_perfil_cliente(sender)
+        id_whatsapp = perfil.get("id_whatsapp") if perfil else None
 
         if id_whatsapp is None:
             return {
@@ -1201,15 +1144,9 @@ def verify_hour_atettion_v2(sender: str) -> bool:
 
 def obtener_direccion(sender: str, id_restaurante: str) -> bool:
     try:
-        query = """
-            SELECT direccion_google
-            FROM public.clientes_whatsapp
-            WHERE telefono = %s AND id_restaurante = %s;
-        """
-        params = (sender, id_restaurante)
-        result = execute_query(query, params)
-        if result and result[0]:
-            direccion_google = result[0][0]
+        perfil = obtener_perfil_cliente(sender, id_restaurante)
+        if perfil:
+            direccion_google = perfil.get("direccion_google")
             return direccion_google
         return False
     except Exception as e:
@@ -1373,11 +1310,41 @@ def extraer_ultimo_mensaje(mensaje: str) -> str:
         log_message(f"Error en extraer_ultimo_mensaje: {e}", "ERROR")
         return ""
 
+def extraer_mensajes_turno(mensaje: str) -> str:
+    """
+    Texto del turno actual: los mensajes del usuario posteriores a la última respuesta del bot,
+    en orden y separados por salto de línea (con la coalescencia un turno puede traer varios:
+    "quiero una sierra clásica" + "y unas papas"). Si el contexto no tiene la estructura de
+    obtener_contexto_conversacion, retorna extraer_ultimo_mensaje(mensaje).
+    """
+    try:
+        import ast
+        parsed = ast.literal_eval(mensaje) if isinstance(mensaje, str) and mensaje.strip().startswith("[") else None
+    except Exception:
+        parsed = None
+    if not isinstance(parsed, (list, tuple)):
+        return extraer_ultimo_mensaje(mensaje)
+    entradas = []
+    for elem in parsed:
+        for c in (elem if isinstance(elem, (list, tuple)) else (elem,)):
+            if isinstance(c, dict):
+                entradas.append(c)
+    turno = []
+    for c in reversed(entradas):
+        role = str(c.get('rol') or c.get('role') or '').strip().lower()
+        if role not in ('usuario', 'user', 'cliente'):
+            break
+        texto = c.get('texto') or c.get('text') or c.get('mensaje')
+        if texto:
+            turno.append(str(texto).strip())
+    if not turno:
+        return extraer_ultimo_mensaje(mensaje)
+    return "\n".join(reversed(turno))
+
 def actualizar_medio_entrega(sender: str, codigo_unico: str, metodo_entrega: str) -> dict:
     try:
-        q_idw = "SELECT id_whatsapp FROM clientes_whatsapp WHERE telefono = %s"
-        res_idw = execute_query(q_idw, (sender,), fetchone=True)
-        id_whatsapp = res_idw[0] if res_idw else None
+        perfil = obtener_perfil_cliente(sender)
+        id_whatsapp = perfil.get("id_whatsapp") if perfil else None
 
         if id_whatsapp is None:
             return {
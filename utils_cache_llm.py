@@ -0,0 +1,214 @@
+# utils_cache_llm.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Caché determinista de respuestas del LLM para prompts de clasificación y mapeo (temperatura 0):
+# la clave es (modelo, prompt normalizado, versión del menú); un acierto evita la llamada a OpenAI.
+
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from typing import Callable, Optional
+from utils_coalescencia import Reloj
+from utils_database import execute_query
+from utils_metricas import incrementar
+
+CACHE_LLM_BACKEND: str = os.getenv("CACHE_LLM_BACKEND", "postgres")  # "postgres" | "sqlite" | "desactivado"
+CACHE_LLM_RUTA_SQLITE: str = os.getenv("CACHE_LLM_RUTA_SQLITE", "/tmp/cache_llm.sqlite3")
+CACHE_LLM_TTL_SEGUNDOS: int = int(os.getenv("CACHE_LLM_TTL_SEGUNDOS", "86400"))
+CACHE_LLM_MAX_ENTRADAS: int = int(os.getenv("CACHE_LLM_MAX_ENTRADAS", "5000"))  # por encima se desalojan las menos usadas
+CACHE_LLM_PODA_CADA: int = int(os.getenv("CACHE_LLM_PODA_CADA", "100"))  # escrituras entre podas (expiradas + LRU)
+
+DDL_CACHE_LLM: str = """
+    CREATE TABLE IF NOT EXISTS cache_llm (
+        clave CHAR(64) PRIMARY KEY,
+        funcion VARCHAR(60) NOT NULL,
+        valor TEXT NOT NULL,
+        expira TIMESTAMPTZ NOT NULL,
+        ultimo_uso TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+    CREATE INDEX IF NOT EXISTS idx_cache_llm_ultimo_uso ON cache_llm (ultimo_uso);
+"""
+
+DDL_CACHE_LLM_SQLITE: str = """
+    CREATE TABLE IF NOT EXISTS cache_llm (
+        clave TEXT PRIMARY KEY,
+        funcion TEXT NOT NULL,
+        valor TEXT NOT NULL,
+        expira REAL NOT NULL,
+        ultimo_uso REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_cache_llm_ultimo_uso ON cache_llm (ultimo_uso);
+"""
+
+def normalizar_prompt(prompt: str) -> str:
+    """Forma canónica del prompt para la clave: NFKC, minúsculas y espacios colapsados."""
+    texto = unicodedata.normalize("NFKC", prompt or "").casefold()
+    return re.sub(r"\s+", " ", texto).strip()
+
+def clave_cache_llm(modelo: str, prompt: str, version_menu: str = "") -> str:
+    """sha256 de (modelo, prompt normalizado, versión del menú)."""
+    contenido = json.dumps([modelo, normalizar_prompt(prompt), version_menu], ensure_ascii=False)
+    return hashlib.sha256(contenido.encode("utf-8")).hexdigest()
+
+class CachePostgres:
+    """Caché en la tabla cache_llm, compartida por todas las instancias de la función."""
+
+    def __init__(self, ttl: int = CACHE_LLM_TTL_SEGUNDOS, max_entradas: int = CACHE_LLM_MAX_ENTRADAS) -> None:
+        self.ttl = ttl
+        self.max_entradas = max_entradas
+        self._tabla_lista = False
+        self._escrituras = 0
+        self._lock = threading.Lock()
+
+    def _asegurar_tabla(self) -> None:
+        if not self._tabla_lista:
+            execute_query(DDL_CACHE_LLM, fuera_de_unidad=True)
+            self._tabla_lista = True
+
+    def obtener(self, clave: str) -> Optional[str]:
+        self._asegurar_tabla()
+        # Un solo viaje: lee la entrada vigente y marca el uso para el LRU
+        fila = execute_query("""
+            UPDATE cache_llm SET ultimo_uso = NOW()
+            WHERE clave = %s AND expira > NOW()
+            RETURNING valor;
+        """, (clave,), fetchone=True, fuera_de_unidad=True)
+        return fila[0] if fila else None
+
+    def guardar(self, clave: str, funcion: str, valor: str) -> None:
+        self._asegurar_tabla()
+        execute_query("""
+            INSERT INTO cache_llm (clave, funcion, valor, expira)
+            VALUES (%s, %s, %s, NOW() + make_interval(secs => %s))
+            ON CONFLICT (clave) DO UPDATE
+            SET valor = EXCLUDED.valor, expira = EXCLUDED.expira, ultimo_uso = NOW();
+        """, (clave, funcion, valor, self.ttl), fuera_de_unidad=True)
+        with self._lock:
+            self._escrituras += 1
+            podar = self._escrituras % CACHE_LLM_PODA_CADA == 0
+        if podar:
+            self.podar()
+
+    def podar(self) -> None:
+        """Elimina las entradas expiradas y, si sobran, las menos usadas recientemente."""
+        borradas = execute_query("""
+            DELETE FROM cache_llm
+            WHERE expira <= NOW()
+               OR clave IN (
+                   SELECT clave FROM cache_llm
+                   ORDER BY ultimo_uso DESC
+                   OFFSET %s
+               )
+            RETURNING clave;
+        """, (self.max_entradas,), fuera_de_unidad=True) or []
+        if borradas:
+            incrementar("cache_llm.desalojos", len(borradas))
+
+class CacheSQLite:
+    """
+    Caché en un archivo SQLite local (una instancia o ejecución local).
+    El reloj es inyectable (RelojManual) para probar TTL y LRU sin esperas reales.
+    """
+
+    def __init__(self, ruta: str = CACHE_LLM_RUTA_SQLITE, ttl: int = CACHE_LLM_TTL_SEGUNDOS,
+                 max_entradas: int = CACHE_LLM_MAX_ENTRADAS, reloj: Optional[Reloj] = None) -> None:
+        self.ttl = ttl
+        self.max_entradas = max_entradas
+        self.reloj = reloj or Reloj()
+        self._lock = threading.Lock()
+        self._escrituras = 0
+        self._conexion = sqlite3.connect(ruta, check_same_thread=False, isolation_level=None)
+        self._conexion.executescript(DDL_CACHE_LLM_SQLITE)
+
+    def obtener(self, clave: str) -> Optional[str]:
+        ahora = self.reloj.ahora()
+        with self._lock:
+            fila = self._conexion.execute(
+                "SELECT valor FROM cache_llm WHERE clave = ? AND expira > ?;", (clave, ahora)
+            ).fetchone()
+            if fila:
+                self._conexion.execute("UPDATE cache_llm SET ultimo_uso = ? WHERE clave = ?;", (ahora, clave))
+        return fila[0] if fila else None
+
+    def guardar(self, clave: str, funcion: str, valor: str) -> None:
+        ahora = self.reloj.ahora()
+        with self._lock:
+            self._conexion.execute("""
+                INSERT INTO cache_llm (clave, funcion, valor, expira, ultimo_uso)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (clave) DO UPDATE
+                SET valor = excluded.valor, expira = excluded.expira, ultimo_uso = excluded.ultimo_uso;
+            """, (clave, funcion, valor, ahora + self.ttl, ahora))
+            self._escrituras += 1
+            podar = self._escrituras % CACHE_LLM_PODA_CADA == 0
+        if podar:
+            self.podar()
+
+    def podar(self) -> None:
+        ahora = self.reloj.ahora()
+        with self._lock:
+            borradas = self._conexion.execute("""
+                DELETE FROM cache_llm
+                WHERE expira <= ?
+                   OR clave IN (
+                       SELECT clave FROM cache_llm
+                       ORDER BY ultimo_uso DESC
+                       LIMIT -1 OFFSET ?
+                   );
+            """, (ahora, self.max_entradas)).rowcount
+        if borradas:
+            incrementar("cache_llm.desalojos", borradas)
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def obtener_cache_llm():
+    """Retorna el backend configurado en CACHE_LLM_BACKEND (instancia única) o None si está desactivado."""
+    global _cache
+    with _cache_lock:
+        if _cache is None and CACHE_LLM_BACKEND != "desactivado":
+            _cache = CacheSQLite() if CACHE_LLM_BACKEND == "sqlite" else CachePostgres()
+        return _cache
+
+def configurar_cache_llm(cache) -> None:
+    """Reemplaza el backend del proceso (ej: CacheSQLite(":memory:", reloj=RelojManual()) en pruebas)."""
+    global _cache
+    with _cache_lock:
+        _cache = cache
+
+def respuesta_llm_cacheada(funcion: str, modelo: str, prompt: str, llamar: Callable[[], str],
+                           version_menu: str = "",
+                           es_valida: Optional[Callable[[str], bool]] = None) -> str:
+    """
+    Retorna la respuesta cruda del LLM para (modelo, prompt, version_menu) desde la caché o,
+    si no está, ejecuta llamar() y la guarda. Solo se guardan respuestas no vacías que pasen
+    es_valida. Un error de la caché nunca bloquea la llamada: se registra y se sigue sin caché.
+    """
+    cache = obtener_cache_llm()
+    if cache is None:
+        return llamar()
+    clave = clave_cache_llm(modelo, prompt, version_menu)
+    try:
+        valor = cache.obtener(clave)
+    except Exception as e:
+        incrementar("cache_llm.errores")
+        logging.error(f"Error leyendo cache LLM ({funcion}): {e}")
+        valor = None
+    if valor is not None:
+        incrementar("cache_llm.aciertos")
+        incrementar(f"cache_llm.aciertos.{funcion}")
+        return valor
+    incrementar("cache_llm.fallos")
+    incrementar(f"cache_llm.fallos.{funcion}")
+    valor = llamar()
+    if valor and (es_valida is None or es_valida(valor)):
+        try:
+            cache.guardar(clave, funcion, valor)
+        except Exception as e:
+            incrementar("cache_llm.errores")
+            logging.error(f"Error guardando en cache LLM ({funcion}): {e}")
+    return valor
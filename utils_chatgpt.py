@@ -1,20 +1,39 @@
 # utils_chatgpt.py
 # Last modified: 2025-21-12 Juan Agudelo
 
-import re
-from openai import OpenAI
 import logging
 from typing import Any,  Optional, Tuple, Dict
 import os
 import json
-from utils import send_text_response, limpiar_respuesta_json, log_message, to_json_safe,corregir_total_price_en_result
+from utils import send_text_response, log_message, to_json_safe,corregir_total_price_en_result, extraer_ultimo_mensaje, extraer_mensajes_turno
 from utils_database import execute_query
+from utils_llm import LLM_CONFIANZA_MINIMA, RESPUESTA_ENLATADA, cliente_llm
+from utils_cache_llm import respuesta_llm_cacheada
+from utils_mapeo import mapear_modo_pago_local, mapear_sede_local, obtener_sedes_activas
+from utils_prompts import registrar_plantilla
+from utils_menu import compilar_menu
+from utils_embeddings import menu_relevante
+from utils_streaming import STREAMING_ACTIVO, EnvioRastreado, consumir_stream
+from utils_salidas import (
+    CambiosResumen, Clasificacion, ClasificacionPregunta, ConfirmacionPedido, DatosPersonales, Direccion,
+    EleccionPromocion, Intencion, MapeoPedido, Mensaje, MensajeIntencion, MensajePromocion,
+    MensajeRecomendaciones, MetodoPago, PerfilCliente, RespuestaMenu, RespuestaQueja, RespuestaQuejaGrave,
+    SalidaInvalida, a_dict, convertir_salida, parsear_salida
+)
+from utils_indice_productos import obtener_indice, resolver_pedido_local, resolver_turno_local, tiene_modificadores
+from utils_metricas import incrementar
+from utils_contexto import actualizar_perfil_cliente, invalidar_perfil_cliente, obtener_perfil_cliente, tiene_pedido_en_curso
 from datetime import datetime, date
 from utils_registration import validate_personal_data
 from psycopg2.extras import Json
 
 ID_RESTAURANTE: str = os.getenv("ID_RESTAURANTE", "5")
 
+# Plantillas con prefijo estático + sufijo dinámico (subir la versión al cambiar el prefijo)
+PROMPT_CLASIFICADOR = registrar_plantilla("get_classifier", "2")
+PROMPT_PREGUNTA_MENU = registrar_plantilla("responder_pregunta_menu_chatgpt", "3")
+PROMPT_MAPEO_PEDIDO = registrar_plantilla("mapear_pedido_al_menu", "3")
+
 def get_openai_key() -> str:
     try:
         """Obtiene la clave API de OpenAI desde variables de entorno."""
@@ -189,20 +208,22 @@ Responde solo JSON válido."""
                 "content": msj
             }
         ]
-        client: OpenAI = OpenAI(api_key=get_openai_key())
+        # Sin cache_llm: msj trae los últimos mensajes con su fecha, así que la clave no se repetiría.
+        client = cliente_llm("get_classifier", salida=Clasificacion)
         respuesta: Any = client.chat.completions.create(
             model="gpt-4.1-mini",
             messages=messages,
             #max_tokens=700,
-            temperature=0
+            temperature=0,
+            **PROMPT_CLASIFICADOR.opciones()
         )
+        PROMPT_CLASIFICADOR.registrar_uso(respuesta)
         tokens_used = _extract_total_tokens(respuesta)
         if tokens_used is not None:
             log_message(f"[OpenAI] get_classifier tokens_used={tokens_used}", "DEBUG")
         raw_response: str = respuesta.choices[0].message.content.strip()
         logging.info(f"[Clasificador RAW] {raw_response!r}")
-        json_str: str = limpiar_respuesta_json(raw_response)
-        result: Dict[str, Any] = json.loads(json_str)
+        result: Dict[str, Any] = a_dict(parsear_salida("get_classifier", raw_response, Clasificacion))
         intent: Optional[str] = result.get("intent")
         type_: Optional[str] = result.get("type")
         entities: Dict[str, Any] = result.get("entities", {})
@@ -210,7 +231,7 @@ Responde solo JSON válido."""
             raise ValueError(f"Respuesta inválida, faltan claves: {result}")
         logging.info(f"Respuesta del clasificador: {result}")
         logging.info(f"Intent: {intent}, Type: {type_}, Entities: {entities}")
-        log_message(f'Respuesta del clasificador: {result}', 'INFO')
+        log_message('Respuesta del clasificador', 'INFO', result=result)
         return intent, type_, entities
     except Exception as e:
         log_message(f'Error al hacer uso de función <GetClassifier>: {e}.', 'ERROR')
@@ -224,7 +245,7 @@ def clasificar_pregunta_menu_chatgpt(pregunta_usuario: str, items, model: str =
     del negocio (hamburguesería) usando un modelo de lenguaje (ChatGPT).
     """
 
-    client: OpenAI = OpenAI()
+    client = cliente_llm("clasificar_pregunta_menu_chatgpt", salida=ClasificacionPregunta)
 
     prompt: str = f"""
     Eres un asistente que clasifica preguntas de clientes de una hamburguesería.
@@ -264,7 +285,7 @@ def clasificar_pregunta_menu_chatgpt(pregunta_usuario: str, items, model: str =
     🔟 "qué es Python?" → {{"clasificacion": "no_relacionada"}}
 
     Este es el menú completo si la pregunta incluye un producto del menu o se refiere a comidas o bebidas es relacionada:
-    {json.dumps(items, ensure_ascii=False)}
+    {compilar_menu(items, 'basico')}
     
     Ahora clasifica la siguiente pregunta del usuario:
     "{pregunta_usuario}"
@@ -279,36 +300,12 @@ def clasificar_pregunta_menu_chatgpt(pregunta_usuario: str, items, model: str =
             temperature=0
         )
         text_output = response.output[0].content[0].text.strip()
-        # limpiar posibles fences/triple-backticks u otros prefijos
-        try:
-            text_output = _clean_model_output(text_output)
-        except Exception:
-            pass
         tokens_used = _extract_total_tokens(response)
         if tokens_used is not None:
             log_message(f"[OpenAI] clasificar_pregunta_menu_chatgpt tokens_used={tokens_used}", "DEBUG")
-        # Extraer JSON dentro de fences ```json ... ``` o buscar primer objeto JSON
-        clean = text_output or ""
-        m = re.search(r"```(?:json)?\s*([\s\S]*?)\s*```", clean, flags=re.IGNORECASE)
-        if m:
-            clean = m.group(1).strip()
-        else:
-            clean = clean.strip()
-        if not clean.startswith('{'):
-            m2 = re.search(r"(\{[\s\S]*\})", clean)
-            if m2:
-                clean = m2.group(1)
+        return a_dict(client.parsear(text_output))
 
-        try:
-            result = json.loads(clean)
-            return result
-        except json.JSONDecodeError:
-            logging.error(f"Error al parsear JSON en clasificar_pregunta_menu_chatgpt: {clean!r}")
-            log_message(f'Error al parsear JSON en <ClasificarPreguntaMenuChatGPT>: {clean}', 'ERROR')
-            return {"clasificacion": "no_relacionada"}
-
-    except json.JSONDecodeError:
-        logging.error(f"Error al parsear JSON: {text_output}")
+    except SalidaInvalida:
         log_message(f'Error al parsear JSON en <ClasificarPreguntaMenuChatGPT>: {text_output}', 'ERROR')
         return {"clasificacion": "no_relacionada"}
     except Exception as e:
@@ -316,25 +313,6 @@ def clasificar_pregunta_menu_chatgpt(pregunta_usuario: str, items, model: str =
         log_message(f'Error en <ClasificarPreguntaMenuChatGPT>: {e}.', 'ERROR')
         return {"clasificacion": "no_relacionada"}
 
-def _clean_model_output(raw: str) -> str:
-    """
-    Limpia output que pueda venir en triple-backticks o con '```json' al inicio.
-    Devuelve el string JSON limpio (o el raw si no había marcas).
-    """
-    if not raw:
-        return ""
-    s = raw.strip()
-
-    # Si el modelo devolvió bloque con ```json ... ```
-    if s.startswith("```"):
-        # eliminar backticks al inicio y final
-        s = s.strip("`").strip()
-        # si aún tiene prefijo 'json' eliminarlo
-        if s.lower().startswith("json"):
-            s = s[len("json"):].lstrip("\r\n ").strip()
-
-    return s
-
 def _extract_text_from_response(response) -> str:
     """
     Extrae texto del objeto devuelto por client.responses.create de forma robusta.
@@ -380,19 +358,27 @@ def _extract_text_from_response(response) -> str:
     except Exception:
         return ""
 
-def responder_pregunta_menu_chatgpt(pregunta_usuario: str, items,sender: str, model: str = "gpt-4o") -> dict:
+def _cerrar_respuesta_menu(pregunta_usuario: str, respuesta: str) -> str:
+    """A respuestas sobre productos sin cierre les agrega la invitación a probar."""
+    pregunta_lower = pregunta_usuario.lower()
+    respuesta_txt = str(respuesta or "").strip()
+    if any(token in pregunta_lower for token in ["?", "tienen", "hay", "venden", "cuáles", "qué opciones", "me recomiendas", "qué hay"]):
+        if respuesta_txt and not respuesta_txt.endswith(("?", ".", "!", "😋", "😉", "😎")):
+            return respuesta_txt + " ¿Quieres probarla? 😋"
+    return respuesta_txt
+
+def responder_pregunta_menu_chatgpt(pregunta_usuario: str, items,sender: str, model: str = "gpt-4o", al_mensaje=None) -> dict:
     """
     Responde preguntas del usuario sobre el menú o servicios del restaurante Sierra Nevada 🍔.
     Incluye información sobre horarios, sedes y medios de pago.
+    Con al_mensaje (y STREAMING_ACTIVO) la respuesta se envía apenas el modelo cierra el campo
+    "respuesta" y el resultado trae "enviado": True.
     Devuelve: (result: dict, prompt: str)
     """
     # Obtener id_sede del cliente usando el teléfono
     telefono = sender  # Asumiendo que 'sender' es el teléfono
-    query_id_sede = f"SELECT id_sede FROM clientes_whatsapp WHERE telefono = '{telefono}'"
-    result_id_sede = execute_query(query_id_sede)
-    id_sede = None
-    if result_id_sede and len(result_id_sede) > 0:
-        id_sede = result_id_sede[0][0]
+    perfil = obtener_perfil_cliente(telefono)
+    id_sede = perfil.get("id_sede") if perfil else None
     direccion = None
     if id_sede:
         query_direccion = f"SELECT direccion FROM sedes WHERE id_sede = '{id_sede}'"
@@ -442,7 +428,14 @@ def responder_pregunta_menu_chatgpt(pregunta_usuario: str, items,sender: str, mo
     sedes_json = json.dumps(sedes_contexto, ensure_ascii=False, indent=2)
 
     print(sedes_json)
-    prompt = f"""
+    # Con EMBEDDINGS_RECORTAR_MENU solo va la parte del menú cercana a la pregunta, al final del prompt
+    relevantes = menu_relevante(extraer_ultimo_mensaje(pregunta_usuario), items)
+    if relevantes is None:
+        menu_prefijo, menu_sufijo = compilar_menu(items, 'completo'), ""
+    else:
+        menu_prefijo = "(Al final se incluye la parte del menú relevante para el mensaje del cliente.)"
+        menu_sufijo = f"Parte relevante del menú:\n{compilar_menu(relevantes, 'completo')}"
+    prefijo = f"""
         Eres PAKO, el asistente cálido y cercano de Sierra Nevada, La Cima del Sabor 🏔️🍔.
         Tu tarea es ayudar al cliente con información sobre el menú, horarios, sedes y servicios,
         siempre con el tono oficial de la marca: amable, natural y con un toque sabroso, sin exagerar.
@@ -455,11 +448,8 @@ def responder_pregunta_menu_chatgpt(pregunta_usuario: str, items,sender: str, mo
         - Si el cliente menciona que no le gusta un ingrediente dile que puede quitarlo del producto
         - Si preguntan por hamburguesas sierras diles que hubo un cambio en el menu
         
-        El cliente preguntó: "{pregunta_usuario}"
-        La sede asignada del cliente es: "{direccion if direccion else 'No asignada'}".
-        El resumen de la conversación con el cliente es: {resumen_str}
         Este es el menú completo:
-        {json.dumps(items, ensure_ascii=False)}
+        {menu_prefijo}
         PAUTAS DE TONO (OBLIGATORIAS):
         - Habla como un buen anfitrión bogotano: cálido, natural y claro.
         - Siempre cordial, sin sarcasmo, sin ironía y sin jerga barrial.
@@ -500,45 +490,59 @@ def responder_pregunta_menu_chatgpt(pregunta_usuario: str, items,sender: str, mo
             "productos": ["Sierra Picante", "Sierra BBQ"]
         }}
         """
+    # Lo que cambia en cada llamada va al final para no romper el prefijo cacheado
+    sufijo = f"""
+        El cliente preguntó: "{pregunta_usuario}"
+        La sede asignada del cliente es: "{direccion if direccion else 'No asignada'}".
+        El resumen de la conversación con el cliente es: {resumen_str}
+        {menu_sufijo}
+        """
+    prompt = PROMPT_PREGUNTA_MENU.armar(prefijo, sufijo)
+    envio = EnvioRastreado(al_mensaje) if al_mensaje else None
     try:
-        log_message(f"Prompt para ChatGPT preguntas generales: {prompt}", "DEBUG")
-        client = OpenAI()
-        response = client.responses.create(
-            model=model,
-            input=prompt
+        log_message("Prompt para ChatGPT preguntas generales", "DEBUG", prompt=prompt)
+        client = cliente_llm(
+            "responder_pregunta_menu_chatgpt",
+            salida=RespuestaMenu,
+            enlatada=json.dumps({"respuesta": RESPUESTA_ENLATADA, "recomendacion": False, "productos": []}, ensure_ascii=False)
         )
+        if envio and STREAMING_ACTIVO:
+            stream = client.responses.create(
+                model=model,
+                input=prompt,
+                stream=True,
+                **PROMPT_PREGUNTA_MENU.opciones()
+            )
+            raw_text, _, response = consumir_stream(
+                stream, "responder_pregunta_menu_chatgpt", envio,
+                transformar=lambda texto: _cerrar_respuesta_menu(pregunta_usuario, texto)
+            )
+        else:
+            response = client.responses.create(
+                model=model,
+                input=prompt,
+                **PROMPT_PREGUNTA_MENU.opciones()
+            )
+            raw_text = _extract_text_from_response(response)
+        PROMPT_PREGUNTA_MENU.registrar_uso(response)
         tokens_used = _extract_total_tokens(response)
         if tokens_used is not None:
             log_message(f"[OpenAI] responder_pregunta_menu_chatgpt tokens_used={tokens_used}", "DEBUG")
-        raw_text = _extract_text_from_response(response)
-        raw_text = _clean_model_output(raw_text)
         logging.info(f"[DEBUG] Texto crudo del modelo: {raw_text!r}")
 
         if not raw_text:
             raise ValueError("Respuesta vacía del modelo")
 
         try:
-            result = json.loads(raw_text)
-        except json.JSONDecodeError:
-            import re
-            m = re.search(r"(\{[\s\S]*\})", raw_text)
-            if m:
-                result = json.loads(m.group(1))
-            else:
-                result = {"respuesta": raw_text, "recomendacion": False, "productos": []}
-
-        if "productos" in result and isinstance(result["productos"], list):
-            result["productos"] = [p.replace('\u00a0', ' ').strip() for p in result["productos"]]
-
-        pregunta_lower = pregunta_usuario.lower()
-        if any(token in pregunta_lower for token in ["?", "tienen", "hay", "venden", "cuáles", "qué opciones", "me recomiendas", "qué hay"]):
-            respuesta_txt = str(result.get("respuesta", "")).strip()
-            if respuesta_txt and not respuesta_txt.endswith(("?", ".", "!", "😋", "😉", "😎")):
-                result["respuesta"] = respuesta_txt + " ¿Quieres probarla? 😋"
-
-        result.setdefault("productos", [])
-        result.setdefault("recomendacion", False)
-        log_message(f"Respuesta generada: {result}", "INFO")
+            result = a_dict(client.parsear(raw_text))
+        except SalidaInvalida:
+            # Texto libre: se responde tal cual
+            result = {"respuesta": raw_text.strip(), "recomendacion": False, "productos": []}
+
+        result["productos"] = [p.replace('\u00a0', ' ').strip() for p in result["productos"]]
+        result["respuesta"] = _cerrar_respuesta_menu(pregunta_usuario, result["respuesta"])
+        result["enviado"] = bool(envio and envio.enviado)
+        log_message("Respuesta generada", "INFO", result=result)
         return result
 
     except Exception as e:
@@ -547,16 +551,62 @@ def responder_pregunta_menu_chatgpt(pregunta_usuario: str, items,sender: str, mo
         return {
             "respuesta": "Lo siento 😔, tuve un problema para responder tu pregunta.",
             "recomendacion": False,
-            "productos": []
+            "productos": [],
+            "enviado": bool(envio and envio.enviado)
         }
 
+def _mapeo_confiable(raw: str) -> bool:
+    """Criterio de la cascada de mapear_pedido_al_menu: forma de MapeoPedido con intent_confidence suficiente."""
+    try:
+        mapeo, reparaciones = convertir_salida(raw, MapeoPedido)
+    except SalidaInvalida:
+        return False
+    return not reparaciones and mapeo.intent_confidence >= LLM_CONFIANZA_MINIMA
+
 def mapear_pedido_al_menu(contenido_clasificador: dict, menu_items: list,sender: str, model: str = "gpt-5.1") -> dict:
     """
     Mapear los items provenientes del clasificador AL MENÚ usando GPT.
+    Pasa primero por el modelo rápido de la cascada (LLM_CASCADAS) y solo escala a model si la
+    salida no es JSON válido o trae intent_confidence baja.
     """
-    client = OpenAI()
+    client = cliente_llm("mapear_pedido_al_menu", aceptar=_mapeo_confiable, salida=MapeoPedido)
     pedido=obtener_pedido_en_proceso(sender, ID_RESTAURANTE)
-    prompt = f"""
+    # Pre-resolución local con el índice del menú sobre el turno completo (con la coalescencia puede
+    # traer varios mensajes): un pedido nuevo sin modificadores cuyo texto se resuelve entero y sin
+    # ambigüedad no necesita LLM; si no, el LLM recibe lo resuelto y candidatos
+    texto_turno = extraer_mensajes_turno(contenido_clasificador if isinstance(contenido_clasificador, str) else str(contenido_clasificador))
+    indice = obtener_indice(menu_items)
+    items_locales = None if tiene_modificadores(texto_turno) else resolver_turno_local(texto_turno, indice)
+    # El pedido en curso se consulta en la base: el resumen se actualiza en segundo plano y puede ir atrasado
+    if items_locales and not tiene_pedido_en_curso(sender, ID_RESTAURANTE):
+        incrementar("mapeo_pedido.local")
+        result = corregir_total_price_en_result({
+            "intent": "ADD_ITEM",
+            "intent_confidence": 1.0,
+            "target_items": [],
+            "order_complete": True,
+            "items": items_locales
+        })
+        log_message('Pedido resuelto localmente en <MapearPedidoAlMenu>', 'INFO', result=result)
+        return result
+    incrementar("mapeo_pedido.llm")
+    resueltos, pendientes = resolver_pedido_local(texto_turno, indice)
+    pre_resolucion = ""
+    if resueltos or pendientes:
+        lineas = [f'- "{i["requested"]["producto"]}" -> {i["matched"]["name"]} (id {i["matched"]["id"]}, {i["matched"]["price"]:.0f}) x{i["cantidad"]}' for i in resueltos]
+        lineas += [
+            f'- "{p["fragmento"]}" sin resolver; candidatos: ' + ("; ".join(f'{c["name"]} (id {c["id"]}, {c["price"]:.0f})' for c in p["candidatos"]) or "ninguno")
+            for p in pendientes
+        ]
+        pre_resolucion = "PRE-RESOLUCIÓN LOCAL DEL TURNO (verifica contra el menú y el contexto):\n        " + "\n        ".join(lineas)
+    ids_locales = [i["matched"]["id"] for i in resueltos] + [c["id"] for p in pendientes for c in p["candidatos"]]
+    relevantes = menu_relevante(f"{texto_turno}\n{pedido}", menu_items, incluir_ids=ids_locales)
+    if relevantes is None:
+        menu_prefijo, menu_sufijo = compilar_menu(menu_items, 'completo'), ""
+    else:
+        menu_prefijo = "(Al final se incluye la parte del menú relevante para el mensaje del cliente.)"
+        menu_sufijo = f"PARTE RELEVANTE DEL MENÚ:\n{compilar_menu(relevantes, 'completo')}"
+    prefijo = f"""
         Eres un asistente encargado de interpretar mensajes de clientes para la toma y modificación de pedidos de domicilios.
         Tu función es:
         1) Clasificar la INTENCIÓN del mensaje del usuario.
@@ -788,24 +838,31 @@ def mapear_pedido_al_menu(contenido_clasificador: dict, menu_items: list,sender:
         Tono de la conversacion:
         -Directo,formal,cercano y amable
         MENÚ COMPLETO:
-        {json.dumps(menu_items, ensure_ascii=False)}
-
+        {menu_prefijo}
+        """
+    # Clasificador y pedido cambian en cada llamada: van después del prefijo estático (reglas + menú)
+    sufijo = f"""
         CLASIFICADOR:
         {json.dumps(contenido_clasificador, ensure_ascii=False)}
 
         PEDIDO ACTUAL EN PROCESO:
         {pedido if pedido else "No hay pedido en proceso"}
+        {menu_sufijo}
+        {pre_resolucion}
         DEVUELVE SOLO EL JSON.
         """
+    prompt = PROMPT_MAPEO_PEDIDO.armar(prefijo, sufijo)
 
     try:
-        log_message(f'Prompt generado en <MapearPedidoAlMenu>: {prompt}', 'DEBUG')
+        log_message('Prompt generado en <MapearPedidoAlMenu>', 'DEBUG', prompt=prompt)
         response = client.responses.create(
             model=model,
             input=prompt,
  #           max_completion_tokens = 500,
-            temperature=0
+            temperature=0,
+            **PROMPT_MAPEO_PEDIDO.opciones()
         )
+        PROMPT_MAPEO_PEDIDO.registrar_uso(response)
         
         text_output = response.output[0].content[0].text.strip()
         tokens_used = _extract_total_tokens(response)
@@ -814,19 +871,13 @@ def mapear_pedido_al_menu(contenido_clasificador: dict, menu_items: list,sender:
         log_message(f'Output crudo de modelo en <MapearPedidoAlMenu>: {text_output}', 'DEBUG')
         ##### Validacion costo
     
-        clean = text_output.strip()
-        clean = re.sub(r'^```json', '', clean, flags=re.IGNORECASE).strip()
-        clean = re.sub(r'^```', '', clean).strip()
-        clean = re.sub(r'^json', '', clean, flags=re.IGNORECASE).strip()
-        clean = re.sub(r'```$', '', clean).strip()
-
-        result = json.loads(clean)
+        result = a_dict(client.parsear(text_output))
 
-        log_message(f'Resultado parseado en <MapearPedidoAlMenu>: {result}', 'DEBUG')
+        log_message('Resultado parseado en <MapearPedidoAlMenu>', 'DEBUG', result=result)
         result = corregir_total_price_en_result(result)
         return result
 
-    except json.JSONDecodeError:
+    except SalidaInvalida:
         logging.error("Error al parsear JSON desde el modelo.")
         logging.error(text_output if 'text_output' in locals() else 'no output')
         log_message(f'Error al parsear JSON en <MapearPedidoAlMenu>: {text_output}', 'ERROR')
@@ -878,7 +929,11 @@ def saludo_dynamic(mensaje_usuario: str, nombre: str, nombre_local: str) -> dict
         No incluyas texto fuera del JSON.
         """
 
-        client = OpenAI()
+        client = cliente_llm(
+            "saludo_dynamic",
+            salida=MensajeIntencion,
+            enlatada=json.dumps({"mensaje": f"¡Hola {nombre}! Bienvenido a {nombre_local}. ¿Quieres ver el menú?", "intencion": "consulta_menu"}, ensure_ascii=False)
+        )
         prompt = PROMPT_SALUDO_DYNAMIC.format(
             nombre=nombre,
             nombre_local=nombre_local,
@@ -900,17 +955,15 @@ def saludo_dynamic(mensaje_usuario: str, nombre: str, nombre_local: str) -> dict
         if tokens_used is not None:
             log_message(f"[OpenAI] saludo_dynamic tokens_used={tokens_used}", "DEBUG")
         try:
-            data = json.loads(raw)
-        except:  # noqa: E722
+            data = a_dict(client.parsear(raw))
+        except SalidaInvalida:
             # fallback con tips incluidos
             data = {
                 "mensaje": f"¡Hola {nombre}! Bienvenido a {nombre_local}. ¿Te muestro el menú o las promociones?",
                 "intencion": "consulta_menu",
                 "tips": [
                     "Escribe mensajes claros y específicos",
-                    "Envía un mensaje a la vez",
                     "Sigue los pasos que te comparta el bot",
-                    "Espera mi respuesta antes de enviar otro mensaje",
                 ]
             }
 
@@ -924,9 +977,7 @@ def saludo_dynamic(mensaje_usuario: str, nombre: str, nombre_local: str) -> dict
             "intencion": "consulta_menu",
             "tips": [
                 "Escribe mensajes claros y específicos",
-                "Envía un mensaje a la vez",
                 "Sigue los pasos que te comparta el bot",
-                "Espera mi respuesta antes de enviar otro mensaje",
             ]
         }
     
@@ -977,7 +1028,7 @@ def respuesta_quejas_ia(mensaje_usuario: str, nombre: str, nombre_local: str) ->
             }
             Genera solo el JSON sin texto adicional.
             """
-        client = OpenAI()
+        client = cliente_llm("respuesta_quejas_ia", salida=RespuestaQueja)
         prompt = PROMPT_QUEJA_LEVE.format(
             mensaje_usuario=mensaje_usuario,
             nombre=nombre
@@ -1002,8 +1053,8 @@ def respuesta_quejas_ia(mensaje_usuario: str, nombre: str, nombre_local: str) ->
         if tokens_used is not None:
             log_message(f"[OpenAI] respuesta_quejas tokens_used={tokens_used}", "DEBUG")
         try:
-            data = json.loads(raw)
-        except:  # noqa: E722
+            data = a_dict(client.parsear(raw))
+        except SalidaInvalida:
             data = {
                 "respuesta_cordial": f"{nombre}, gracias por escribirnos. Lamentamos que tu experiencia en {nombre_local} no haya sido perfecta; estamos aquí para ayudarte 😊",
                 "resumen_queja": "Queja leve del cliente sobre su experiencia.",
@@ -1061,7 +1112,7 @@ def respuesta_quejas_graves_ia(mensaje_usuario: str, nombre: str, nombre_local:
                 "intencion": "queja_grave"
             }}
         """
-        client = OpenAI()
+        client = cliente_llm("respuesta_quejas_graves_ia", salida=RespuestaQuejaGrave)
         prompt = PROMPT_QUEJA_GRAVE.format(
             mensaje_usuario=mensaje_usuario,
             nombre=nombre
@@ -1080,8 +1131,8 @@ def respuesta_quejas_graves_ia(mensaje_usuario: str, nombre: str, nombre_local:
         if tokens_used is not None:
             log_message(f"[OpenAI] respuesta_quejas_graves_ia tokens_used={tokens_used}", "DEBUG")
         try:
-            data = json.loads(raw)
-        except:  # noqa: E722
+            data = a_dict(client.parsear(raw))
+        except SalidaInvalida:
             data = {
                 "respuesta_cordial": f"{nombre}, ya reviso lo ocurrido con tu experiencia en {nombre_local} y activo el seguimiento de inmediato.",
                 "resumen_queja": "Queja grave del cliente sobre servicio o pedido.",
@@ -1145,7 +1196,7 @@ def pedido_incompleto_dynamic(mensaje_usuario: str, menu: list, json_pedido: str
             menu_str=menu_str,
             json_pedido=json_pedido
         )
-        client = OpenAI()
+        client = cliente_llm("pedido_incompleto_dynamic", salida=MensajeRecomendaciones)
         response = client.chat.completions.create(
             model="gpt-5.1",
             messages=[
@@ -1160,8 +1211,8 @@ def pedido_incompleto_dynamic(mensaje_usuario: str, menu: list, json_pedido: str
         if tokens_used is not None:
             log_message(f"[OpenAI] pedido_incompleto_dynamic tokens_used={tokens_used}", "DEBUG")
         try:
-            data = json.loads(raw)
-        except Exception:
+            data = a_dict(client.parsear(raw))
+        except SalidaInvalida:
             recomendaciones_backup = [i["nombre"] for i in menu[:2]]
             data = {
                 "mensaje": "Puedo mostrarte el menú completo si deseas. ¿Quieres que te comparta las opciones?",
@@ -1240,7 +1291,7 @@ Estructura final:
   "mensaje": "texto aquí"
 }}
 """
-        client = OpenAI()
+        client = cliente_llm("solicitar_medio_pago", salida=Mensaje)
 
         response = client.chat.completions.create(
             model="gpt-4o-mini",   # O gpt-4o / gpt-5 / gpt-5.1
@@ -1258,8 +1309,8 @@ Estructura final:
         try:
             # Limpieza de escapes innecesarios que pueden romper el JSON
             clean_text = raw_text.replace('\\$', '$')
-            data = json.loads(clean_text)
-        except json.JSONDecodeError:
+            data = a_dict(client.parsear(clean_text))
+        except SalidaInvalida:
             # Fallback si GPT no devuelve JSON válido
             data = {
                 "mensaje": f"¡{nombre}, ese pedido está para antojar a cualquiera! 🤤 Tu orden ({codigo_unico}) en {nombre_local} quedó tremenda. ¿Qué medio de pago prefieres: efectivo o datafono ambos son contraentrega"
@@ -1273,7 +1324,9 @@ Estructura final:
             "mensaje": f"¡{nombre}, ese pedido está para antojar a cualquiera! 🤤 Tu orden ({codigo_unico}) en {nombre_local} quedó tremenda. ¿Qué medio de pago prefieres: efectivo, transferencia (Nequi/Daviplata/Bre-B), tarjeta débito o tarjeta crédito?"
         }
 
-def enviar_menu_digital(nombre: str, nombre_local: str, menu, promociones_list: list | None) -> dict:
+def enviar_menu_digital(nombre: str, nombre_local: str, menu, promociones_list: list | None, al_mensaje=None) -> dict:
+    """Mensaje alegre para acompañar el menú; con al_mensaje se envía en streaming ("enviado": True)."""
+    envio = EnvioRastreado(al_mensaje) if al_mensaje else None
     try:
         if promociones_list:
             hoy = date.today()
@@ -1329,7 +1382,7 @@ def enviar_menu_digital(nombre: str, nombre_local: str, menu, promociones_list:
             Nada fuera del JSON.
             """
         else:
-            menu_json = json.dumps(menu, ensure_ascii=False)
+            menu_json = compilar_menu(menu, "basico")
             PROMPT = f"""
             Eres la voz oficial de Sierra Nevada, La Cima del Sabor.
             El cliente {nombre} pidió el menú digital.
@@ -1351,33 +1404,52 @@ def enviar_menu_digital(nombre: str, nombre_local: str, menu, promociones_list:
             }}
             Nada fuera del JSON.
             """
-        client = OpenAI()
-        response = client.chat.completions.create(
-            model="gpt-4.1-mini",
-            messages=[
-                {"role": "system", "content": "Eres el generador oficial de mensajes alegres y de pago para Sierra Nevada."},
-                {"role": "user", "content": PROMPT}
-            ],
-            max_tokens=250,
-            temperature=0.95
+        client = cliente_llm(
+            "enviar_menu_digital",
+            salida=Mensaje,
+            enlatada=json.dumps({"mensaje": f"¡{nombre}, aquí tienes el menú de {nombre_local}! Cuéntame qué se te antoja 😋"}, ensure_ascii=False)
         )
-        raw = response.choices[0].message.content.strip()
+        mensajes = [
+            {"role": "system", "content": "Eres el generador oficial de mensajes alegres y de pago para Sierra Nevada."},
+            {"role": "user", "content": PROMPT}
+        ]
+        if envio and STREAMING_ACTIVO:
+            stream = client.chat.completions.create(
+                model="gpt-4.1-mini",
+                messages=mensajes,
+                max_tokens=250,
+                temperature=0.95,
+                stream=True,
+                stream_options={"include_usage": True}
+            )
+            raw, _, response = consumir_stream(stream, "enviar_menu_digital", envio)
+            raw = raw.strip()
+        else:
+            response = client.chat.completions.create(
+                model="gpt-4.1-mini",
+                messages=mensajes,
+                max_tokens=250,
+                temperature=0.95
+            )
+            raw = response.choices[0].message.content.strip()
         tokens_used = _extract_total_tokens(response)
         if tokens_used is not None:
             log_message(f"[OpenAI] enviar_menu_digital tokens_used={tokens_used}", "DEBUG")
         try:
-            data = json.loads(raw)
-        except Exception:
+            data = a_dict(client.parsear(raw))
+        except SalidaInvalida:
             data = {
                 "mensaje": f"¡{nombre}, tenemos promociones activas en {nombre_local}! 😋 ¡Aprovecha y pide ya!"
             }
 
+        data["enviado"] = bool(envio and envio.enviado)
         return data
     except Exception as e:
         log_message(f'Error en función <enviar_menu_digital>: {e}', 'ERROR')
         logging.error(f"Error en función <enviar_menu_digital>: {e}")
         return {
-            "mensaje": f"¡{nombre}, ¿qué esperas para pedir en {nombre_local}? ¡Cuéntame qué se te antoja hoy!"
+            "mensaje": f"¡{nombre}, ¿qué esperas para pedir en {nombre_local}? ¡Cuéntame qué se te antoja hoy!",
+            "enviado": bool(envio and envio.enviado)
         }
 
 def responder_sobre_pedido(pregunta_usuario, Tiempo_estimado, Costo_total) -> dict:
@@ -1418,7 +1490,7 @@ def responder_sobre_pedido(pregunta_usuario, Tiempo_estimado, Costo_total) -> di
         - Inventar palabras relacionadas al estado.
         - Solo usa la informacion que te di
         """
-        client = OpenAI()
+        client = cliente_llm("responder_sobre_pedido", salida=Mensaje)
         response = client.chat.completions.create(
             model="gpt-4.1-mini",
             messages=[
@@ -1432,7 +1504,7 @@ def responder_sobre_pedido(pregunta_usuario, Tiempo_estimado, Costo_total) -> di
         tokens_used = _extract_total_tokens(response)
         if tokens_used is not None:
             log_message(f"[OpenAI] responder_sobre_pedido tokens_used={tokens_used}", "DEBUG")
-        data = json.loads(raw)
+        data = a_dict(client.parsear(raw))
         mensaje = data["mensaje"]
         log_message(f'Respuesta cruda de GPT en <ResponderSobrePedido>: {mensaje}', 'DEBUG')
         return mensaje
@@ -1489,7 +1561,7 @@ def responder_sobre_promociones(nombre: str, nombre_local: str, promociones_info
         NINGÚN TEXTO por fuera del JSON.
         """
 
-        client = OpenAI()
+        client = cliente_llm("responder_sobre_promociones", salida=MensajePromocion)
         response = client.chat.completions.create(
             model="gpt-5.1",
             messages=[
@@ -1504,8 +1576,8 @@ def responder_sobre_promociones(nombre: str, nombre_local: str, promociones_info
         if tokens_used is not None:
             log_message(f"[OpenAI] responder_sobre_promociones tokens_used={tokens_used}", "DEBUG")
         try:
-            data = json.loads(raw)
-        except:  # noqa: E722
+            data = a_dict(client.parsear(raw))
+        except SalidaInvalida:
             data = {
                 "mensaje": f"{nombre}, aquí en {nombre_local} tengo varias promociones buenísimas. "
                            f"Si quieres, puedo mostrarte más o llevarte al menú.",
@@ -1562,7 +1634,7 @@ def interpretar_eleccion_promocion(pregunta_usuario: str, info_promociones_str:
         "motivo": "Explicación clara"
         }}
         """
-    client = OpenAI()
+    client = cliente_llm("interpretar_eleccion_promocion", salida=EleccionPromocion)
     response = client.responses.create(
         model="gpt-5.1",
         input=prompt,
@@ -1573,7 +1645,7 @@ def interpretar_eleccion_promocion(pregunta_usuario: str, info_promociones_str:
         tokens_used = _extract_total_tokens(response)
         if tokens_used is not None:
             log_message(f"[OpenAI] interpretar_eleccion_promocion tokens_used={tokens_used}", "DEBUG")
-        data = json.loads(raw)
+        data = a_dict(client.parsear(raw))
     except Exception as e:
         log_message(f"Error en <interpretar_eleccion_promocion>: {e}", "ERROR")
         data = {
@@ -1680,7 +1752,7 @@ def pedido_incompleto_dynamic_promocion(mensaje_usuario: str, promociones_lst: s
             promociones_str=promociones_str,
             json_pedido=json_pedido
         )
-        client = OpenAI()
+        client = cliente_llm("pedido_incompleto_dynamic_promocion", salida=MensajeRecomendaciones)
         response = client.chat.completions.create(
             model="gpt-5.1",
             messages=[
@@ -1694,8 +1766,8 @@ def pedido_incompleto_dynamic_promocion(mensaje_usuario: str, promociones_lst: s
         if tokens_used is not None:
             log_message(f"[OpenAI] pedido_incompleto_dynamic_promocion tokens_used={tokens_used}", "DEBUG")
         try:
-            data = json.loads(raw)
-        except Exception:
+            data = a_dict(client.parsear(raw))
+        except SalidaInvalida:
             data = {
                 "mensaje": "Por favor elige solo los productos de la promoción o inicia un pedido desde cero escribiendo 'menu' u 'hola'.",
                 "recomendaciones": [],
@@ -1713,7 +1785,13 @@ def pedido_incompleto_dynamic_promocion(mensaje_usuario: str, promociones_lst: s
 def mapear_modo_pago(respuesta_usuario: str) -> str:
     try:
         """Mapea la respuesta del usuario al método de pago estandarizado."""
-        client = OpenAI()
+        if respuesta_usuario:
+            # Sinónimos y errores de digitación se resuelven localmente; el LLM solo si no hay coincidencia única
+            metodo_local = mapear_modo_pago_local(extraer_ultimo_mensaje(respuesta_usuario))
+            if metodo_local:
+                log_message(f"mapear_modo_pago: metodo detectado localmente -> {metodo_local}", "DEBUG")
+                return metodo_local
+        client = cliente_llm("mapear_modo_pago", salida=MetodoPago)
         PROMPT_MAPEO_PAGO = f"""
         Eres un clasificador experto en interpretar el método de pago que un cliente escribe en WhatsApp, incluso cuando lo escribe con errores, abreviaciones o de forma muy informal.
 
@@ -1743,45 +1821,35 @@ def mapear_modo_pago(respuesta_usuario: str) -> str:
             return "desconocido"
 
         prompt = PROMPT_MAPEO_PAGO 
-        response = client.responses.create(
-            model="gpt-3.5-turbo",
-            input=prompt,
-            max_output_tokens=60,
-            temperature=0
-        )
-        raw = response.output_text
+
+        def _llamar() -> str:
+            response = client.responses.create(
+                model="gpt-3.5-turbo",
+                input=prompt,
+                max_output_tokens=60,
+                temperature=0
+            )
+            tokens_used = _extract_total_tokens(response)
+            if tokens_used is not None:
+                log_message(f"[OpenAI] mapear_modo_pago tokens_used={tokens_used}", "DEBUG")
+            return response.output_text
+
+        raw = respuesta_llm_cacheada("mapear_modo_pago", "gpt-3.5-turbo", prompt, _llamar)
         log_message(f'Raw response de <mapear_modo_pago>: {raw}', 'DEBUG')
-        tokens_used = _extract_total_tokens(response)
-        if tokens_used is not None:
-            log_message(f"[OpenAI] mapear_modo_pago tokens_used={tokens_used}", "DEBUG")
 
         try:
             clean = str(raw or "").strip()
-            clean = re.sub(r'^```json\s*', '', clean, flags=re.I)
-            clean = re.sub(r'^```', '', clean, flags=re.I).strip()
-            clean = re.sub(r'```$', '', clean, flags=re.I).strip()
 
             if not clean:
-                log_message("mapear_modo_pago: respuesta vacía después de sanear", "WARN")
+                log_message("mapear_modo_pago: respuesta vacía", "WARN")
                 return "desconocido"
 
             try:
-                data = json.loads(clean)
-            except Exception:
-                m = re.search(r'\{.*\}', clean, flags=re.DOTALL)
-                if m:
-                    try:
-                        data = json.loads(m.group(0))
-                    except Exception as e:
-                        log_message(f"mapear_modo_pago: fallo al parsear objeto JSON extraído: {e}", "ERROR")
-                        data = None
-                else:
-                    data = None
-
-            if data and isinstance(data, dict):
-                metodo = data.get("metodo", "desconocido")
+                metodo = client.parsear(clean).metodo
                 log_message(f"mapear_modo_pago: metodo detectado desde JSON -> {metodo}", "DEBUG")
                 return metodo
+            except SalidaInvalida:
+                pass
             # Fallback por keywords si no hay JSON parseable
             text = clean.lower()
             if "nequi" in text or "neki" in text:
@@ -1837,10 +1905,9 @@ FORMATO ESTRICTO:
 }}
 """
 
-        client = OpenAI()
+        client = cliente_llm("solicitar_metodo_recogida", salida=Mensaje)
         response = client.chat.completions.create(
             model="gpt-4o-mini",
-            response_format={"type": "json_object"},
             messages=[
                 {"role": "system", "content": "Eres PAKO y respondes siempre en JSON válido."},
                 {"role": "user", "content": prompt}
@@ -1851,19 +1918,11 @@ FORMATO ESTRICTO:
         tokens_used = _extract_total_tokens(response)
         if tokens_used is not None:
             log_message(f"[OpenAI] solicitar_metodo_recogida tokens_used={tokens_used}", "DEBUG")
-        # normalizar a str
-        if isinstance(raw, dict):
-            mensaje = raw.get("mensaje", "")
-        else:
-            raw_str = str(raw).strip()
-            try:
-                parsed = json.loads(raw_str)
-                if isinstance(parsed, dict):
-                    mensaje = parsed.get("mensaje", "")
-                else:
-                    mensaje = raw_str
-            except Exception:
-                mensaje = raw_str
+        raw_str = str(raw or "").strip()
+        try:
+            mensaje = client.parsear(raw_str).mensaje
+        except SalidaInvalida:
+            mensaje = raw_str
 
         mensaje = mensaje.strip() if isinstance(mensaje, str) else ""
         if not mensaje:
@@ -1884,17 +1943,20 @@ def generar_mensaje_confirmacion_modificacion_pedido(
         promociones_info: list = None,
         pedido_completo_promocion: dict = None,
         model: str = "gpt-5.1",
+        al_mensaje=None,
     ) -> dict:
     """
     Presenta el pedido al cliente y finaliza SIEMPRE con:
     “¿Desea modificar algo de su pedido?”
 
     No realiza confirmaciones ni preguntas adicionales.
+    Con al_mensaje el "mensaje" se envía en streaming apenas cierra ("enviado": True).
     """
     raw = ""
+    envio = EnvioRastreado(al_mensaje) if al_mensaje else None
 
     try:
-        client = OpenAI()
+        client = cliente_llm("generar_mensaje_confirmacion_modificacion_pedido", salida=ConfirmacionPedido)
         if not promocion:
             prompt = f"""
 Eres PAKO, asistente de WhatsApp del restaurante Sierra Nevada, La Cima del Sabor.
@@ -1903,7 +1965,7 @@ RECIBES un JSON de pedido validado:
 {json.dumps(pedido_json, ensure_ascii=False)}
 
 Y una lista de productos del menú:
-{json.dumps(items_menu, ensure_ascii=False)}
+{compilar_menu(items_menu, 'basico')}
 
 TU MISIÓN:
 1. Presentar el pedido al cliente:
@@ -1991,29 +2053,37 @@ REGLAS:
 - Tono cálido y profesional.
 """
 
-        response = client.responses.create(
-            model=model,
-            input=prompt,
-            temperature=0
-        )
-        log_message(f'prompt: {prompt}', 'DEBUG')
-        raw = response.output[0].content[0].text.strip()
+        log_message('prompt', 'DEBUG', prompt=prompt)
+        if envio and STREAMING_ACTIVO:
+            stream = client.responses.create(
+                model=model,
+                input=prompt,
+                temperature=0,
+                stream=True
+            )
+            raw, _, response = consumir_stream(stream, "generar_mensaje_confirmacion_modificacion_pedido", envio)
+            raw = raw.strip()
+        else:
+            response = client.responses.create(
+                model=model,
+                input=prompt,
+                temperature=0
+            )
+            raw = response.output[0].content[0].text.strip()
         tokens_used = _extract_total_tokens(response)
         if tokens_used is not None:
             log_message(f"[OpenAI] generar_mensaje_confirmacion_modificacion_pedido tokens_used={tokens_used}", "DEBUG")
-        clean = raw
-        clean = re.sub(r'^```json', '', clean, flags=re.I).strip()
-        clean = re.sub(r'^```', '', clean).strip()
-        clean = re.sub(r'```$', '', clean).strip()
-
-        return json.loads(clean)
+        data = a_dict(client.parsear(raw))
+        data["enviado"] = bool(envio and envio.enviado)
+        return data
 
     except Exception as e:
         log_message(f'Error en función <generar_mensaje_confirmacion_modificacion_pedido>: {e}', 'ERROR')
         return {
             "mensaje": "Hubo un error generando el mensaje.",
             "intencion_siguiente": "preguntar_modificacion",
-            "raw_output": raw
+            "raw_output": raw,
+            "enviado": bool(envio and envio.enviado)
         }
 
 def solicitar_confirmacion_direccion(cliente_nombre: str, sede_info: dict) -> dict:
@@ -2063,7 +2133,7 @@ def solicitar_confirmacion_direccion(cliente_nombre: str, sede_info: dict) -> di
             direccion_envio=sede_info.get("direccion_envio")
         )
 
-        client = OpenAI()
+        client = cliente_llm("solicitar_confirmacion_direccion", salida=Mensaje)
         response = client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
@@ -2079,8 +2149,8 @@ def solicitar_confirmacion_direccion(cliente_nombre: str, sede_info: dict) -> di
         if tokens_used is not None:
             log_message(f"[OpenAI] solicitar_confirmacion_direccion tokens_used={tokens_used}", "DEBUG")
         try:
-            data = json.loads(raw)
-        except:  # noqa: E722
+            data = a_dict(client.parsear(raw))
+        except SalidaInvalida:
             # fallback seguro
             data = {
                 "mensaje": (
@@ -2141,7 +2211,7 @@ Instrucciones del mensaje:
 - Siempre di el codigo del pedido, valor del domicilio y total del pedido
 - Di que estara en camino una vez se confirme el pago.
 """
-        client = OpenAI()
+        client = cliente_llm("generar_mensaje_invitar_pago")
         response = client.chat.completions.create(
             model=model,
             messages=[
@@ -2167,9 +2237,8 @@ def generar_mensaje_seleccion_sede(nombre_cliente: str,sender: str, model: str =
     """
     try:
         # Obtener id_sede más cercana y su info
-        query = """SELECT id_sede FROM clientes_whatsapp WHERE telefono = %s LIMIT 1"""
-        result = execute_query(query, (sender,))
-        id_sede_cercana = result[0][0] if result else None
+        perfil = obtener_perfil_cliente(sender)
+        id_sede_cercana = perfil.get("id_sede") if perfil else None
 
         query = """SELECT nombre, direccion FROM sedes WHERE id_sede = %s LIMIT 1"""
         result = execute_query(query, (id_sede_cercana,))
@@ -2208,7 +2277,7 @@ Instrucciones:
 - No saludes al cliente estas en medio de una conversacion
 - Haz el mensaje lo mas corto que puedas
 """
-        client = OpenAI()
+        client = cliente_llm("generar_mensaje_seleccion_sede")
         response = client.chat.completions.create(
             model=model,
             messages=[
@@ -2233,28 +2302,27 @@ def mapear_sede_cliente(texto_cliente: str):
     Usa ChatGPT 5.1 para identificar la sede mencionada por el cliente
     y retorna sus datos completos desde la BD.
     """
-    client = OpenAI()
-    # 1. Obtener sedes desde BD
-    sedes = execute_query("""
-        SELECT nombre, direccion, id_sede, latitud, longitud
-        FROM sedes
-        where estado = true
-    """)
+    client = cliente_llm("mapear_sede_cliente")
+    # 1. Obtener sedes activas (en memoria, se recargan periódicamente)
+    lista_sedes = obtener_sedes_activas()
 
-    if not sedes:
+    if not lista_sedes:
         return {"error": "No se encontraron sedes en la base de datos."}
 
-    # Construir un diccionario para ChatGPT
-    lista_sedes = [
-        {
-            "nombre": s[0],
-            "direccion": s[1],
-            "id_sede": s[2],
-            "latitud": s[3],
-            "longitud": s[4]
+    def _datos_sede(sede: dict) -> dict:
+        return {
+            "nombre_sede": sede["nombre"],
+            "direccion_sede": sede["direccion"],
+            "id_sede": sede["id_sede"],
+            "latitud_sede": sede["latitud"],
+            "longitud_sede": sede["longitud"]
         }
-        for s in sedes
-    ]
+
+    # Igualdad, distancia de edición o fonética contra los nombres; el LLM solo si no hay coincidencia única
+    sede_local = mapear_sede_local(extraer_ultimo_mensaje(texto_cliente), lista_sedes)
+    if sede_local:
+        log_message(f"mapear_sede_cliente: sede detectada localmente -> {sede_local['nombre']}", "DEBUG")
+        return _datos_sede(sede_local)
 
     # 2. Prompt para ChatGPT
     prompt = f"""
@@ -2275,32 +2343,33 @@ Sedes disponibles (datos reales):
         Devuelve SOLO el nombre EXACTO de la sede, sin explicaciones.
         """
 
-    completion = client.chat.completions.create(
-        model="gpt-5.1",
-        messages=[
-            {"role": "system", "content": "Eres un asistente preciso para mapear sedes de restaurantes."},
-            {"role": "user", "content": prompt}
-        ]
+    def _llamar() -> str:
+        completion = client.chat.completions.create(
+            model="gpt-5.1",
+            messages=[
+                {"role": "system", "content": "Eres un asistente preciso para mapear sedes de restaurantes."},
+                {"role": "user", "content": prompt}
+            ]
+        )
+        tokens_used = _extract_total_tokens(completion)
+        if tokens_used is not None:
+            log_message(f"[OpenAI] mapear_sede_cliente tokens_used={tokens_used}", "DEBUG")
+        return completion.choices[0].message.content
+
+    # La lista de sedes va dentro del prompt: si cambia una sede cambia la clave
+    nombres_validos = {sede["nombre"].lower() for sede in lista_sedes} | {"ninguna"}
+    nombre_predicho = respuesta_llm_cacheada(
+        "mapear_sede_cliente", "gpt-5.1", prompt, _llamar,
+        es_valida=lambda nombre: nombre.lower() in nombres_validos
     )
 
-    nombre_predicho = completion.choices[0].message.content
-    tokens_used = _extract_total_tokens(nombre_predicho)
-    if tokens_used is not None:
-        log_message(f"[OpenAI] mapear_sede_cliente tokens_used={tokens_used}", "DEBUG")
-
     if nombre_predicho.upper() == "NINGUNA":
         return {"error": "No se pudo identificar la sede mencionada."}
 
     # 4. Buscar la sede real en la tabla
     for sede in lista_sedes:
         if sede["nombre"].lower() == nombre_predicho.lower():
-            return {
-                "nombre_sede": sede["nombre"],
-                "direccion_sede": sede["direccion"],
-                "id_sede": sede["id_sede"],
-                "latitud_sede": sede["latitud"],
-                "longitud_sede": sede["longitud"]
-            }
+            return _datos_sede(sede)
 
     return {"error": "La IA mencionó una sede que no existe en la BD."}
 
@@ -2317,7 +2386,7 @@ def generar_mensaje_recogida_invitar_pago(
     Genera un mensaje amable para pedidos con recogida en sede.
     """
     try:
-        client = OpenAI()
+        client = cliente_llm("generar_mensaje_recogida_invitar_pago")
         prompt = f"""
 Eres PAKO, la voz oficial de Sierra Nevada, La Cima del Sabor.
 
@@ -2394,7 +2463,7 @@ Devuélvelo SOLO en formato JSON EXACTO, sin texto adicional, por ejemplo:
 }}
 Si no encuentras un campo coloca exactamente "No proporcionado" como valor para ese campo.
 """
-        client = OpenAI(api_key=get_openai_key())
+        client = cliente_llm("extraer_info_personal", salida=DatosPersonales)
         response = client.chat.completions.create(
             model="gpt-3.5-turbo",
             messages=[
@@ -2409,40 +2478,13 @@ Si no encuentras un campo coloca exactamente "No proporcionado" como valor para
         tokens_used = _extract_total_tokens(response)
         if tokens_used is not None:
             log_message(f"[OpenAI] extraer_info_personal tokens_used={tokens_used}", "DEBUG")
-        # Limpieza básica de bloques ```json``` o ``` alrededor
-        if raw.startswith("```"):
-            raw = raw.strip("`").strip()
-            if raw.lower().startswith("json"):
-                raw = raw[4:].lstrip()
-
-        # Intentar parsear JSON directo
         try:
-            parsed = json.loads(raw)
-        except Exception:
-            # intentar extraer first JSON object with regex
-            import re
-            m = re.search(r'(\{[\s\S]*\})', raw)
-            if m:
-                try:
-                    parsed = json.loads(m.group(1))
-                except Exception:
-                    parsed = None
-            else:
-                parsed = None
+            datos = client.parsear(raw)
+        except SalidaInvalida:
+            datos = DatosPersonales()
 
-        # Normalizar salida garantizando llaves requeridas
-        resultado = {
-            "tipo_documento": "No proporcionado",
-            "numero_documento": "No proporcionado",
-            "email": "No proporcionado",
-            "nombre": "No proporcionado"
-        }
-        if isinstance(parsed, dict):
-            for k in ["tipo_documento", "numero_documento", "email", "nombre"]:
-                val = parsed.get(k)
-                if val and isinstance(val, str) and val.strip():
-                    resultado[k] = val.strip()
-        return resultado
+        # Normalizar salida: campos vacíos quedan como "No proporcionado"
+        return {k: (v.strip() or "No proporcionado") for k, v in a_dict(datos).items()}
     except Exception as e:
         log_message(f"Error en extraer_info_personal: {e}", "ERROR")
         logging.error(f"Error en extraer_info_personal: {e}")
@@ -2458,12 +2500,9 @@ def direccion_bd(nombre_cliente: str, direccion_google: str, sender: str) -> str
     Genera un mensaje amable para confirmar la dirección guardada
     """
     try:
-        resultado=execute_query("""SELECT observaciones_dir 
-                                   FROM clientes_whatsapp
-                                   WHERE telefono= %s
-                                   LIMIT 1""", (sender,))
-        indicaciones=resultado[0][0] if resultado and resultado[0] and resultado[0][0] else ""
-        client = OpenAI()
+        perfil = obtener_perfil_cliente(sender)
+        indicaciones = perfil.get("observaciones_dir") if perfil and perfil.get("observaciones_dir") else ""
+        client = cliente_llm("direccion_bd")
         prompt = f"""
 Eres PAKO, la voz oficial de Sierra Nevada, La Cima del Sabor.
 
@@ -2515,7 +2554,7 @@ def get_direction(text: tuple) -> str | None:
     try:
         #if not text or not isinstance(text, str):
         #    return None
-        client = OpenAI(api_key=get_openai_key())
+        client = cliente_llm("get_direction", salida=Direccion)
         prompt = f"""Eres un asistente experto en extraer direcciones de texto libre en Colombia.
 
 Extrae SÓLO la dirección del siguiente texto y si no encuentras una dirección responde como "No presente".
@@ -2611,30 +2650,12 @@ Salida:
         if raw == "" or raw is None or raw == "No presente":
             return None
         # Intentar parsear el JSON devuelto
-        direccion = None
-        observaciones = None
         try:
-            # Limpieza básica de bloques ```json``` o ``` alrededor
-            raw_str = str(raw).strip().strip("`").strip()
-            if raw_str.lower().startswith("json"):
-                raw_str = raw_str[4:].lstrip()
-            # Intentar parsear JSON directo
-            data = json.loads(raw_str)
-            direccion = data.get("direccion")
-            observaciones = data.get("observaciones")
-        except Exception:
-            # fallback: intentar extraer primer objeto JSON con regex
-            import re
-            m = re.search(r'(\{[\s\S]*\})', str(raw))
-            if m:
-                try:
-                    data = json.loads(m.group(1))
-                    direccion = data.get("direccion")
-                    observaciones = data.get("observaciones")
-                except Exception:
-                    direccion = None
-            else:
-                direccion = None
+            data = a_dict(client.parsear(raw))
+        except SalidaInvalida:
+            return None
+        direccion = data["direccion"]
+        observaciones = data["observaciones"]
         if not direccion or direccion == "No presente":
             return None
         # Si la dirección no contiene "bogota", añadirlo
@@ -2656,7 +2677,7 @@ def corregir_direccion(direccion_almacedada: str, mensaje_cliente: str) -> str:
         if not direccion_almacedada or not mensaje_cliente:
             return direccion_almacedada
 
-        client = OpenAI(api_key=get_openai_key())
+        client = cliente_llm("corregir_direccion")
         prompt = f"""eres un experto en direcciones tu trabajo es corregir completar y revisar direcciones, debes comparar la que tenemos almacenada en nuestra base con el comentario proporcionado por el cliente y revisar si debes completar la direccion si es la misma o si debes cambiarla totalmente por ejemplo tenemos esta calle 1 #45 sur "esa direccion esta mal, por favor a esta "calle 45 23" debes cambiarla toda si tenemos calle 123 #53 sur y el cliente dice " es calle 123 #53 norte" debes modificarla y si tenemos calle 45 y el cliente dice falta sur oriente la completas como calle 45 sur oriente UNICAMENTE DEVUELVE LA DIRECCIÓN COMO RESPUESTA NO DES EXPLICACIONES NI AGREGUES NADA APARTE DE LA DIRECCION
 Esta es la Direccion almacenada: {direccion_almacedada} y este es el mensaje del cliente {mensaje_cliente}"""
 
@@ -2717,21 +2738,26 @@ Responde SOLO con una de las siguientes opciones:
 BAJO NINGUNA CIRCUSTANCIA PUEDES USAR ALGO DIFERENTE A ESTAS DOS RESPUESTAS Y NO DEBES AÑADIR NADA MAS.
 """
 
-        client = OpenAI()
-        response = client.chat.completions.create(
-            model="gpt-4.1-mini",
-            messages=[
-                {"role": "system", "content": "Eres PAKO, asistente experto en clasificación de mensajes."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0
+        def _llamar() -> str:
+            client = cliente_llm("clasificador_consulta_menu")
+            response = client.chat.completions.create(
+                model="gpt-4.1-mini",
+                messages=[
+                    {"role": "system", "content": "Eres PAKO, asistente experto en clasificación de mensajes."},
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=0
+            )
+            # Registrar consumo de tokens
+            tokens_used = _extract_total_tokens(response)
+            if tokens_used is not None:
+                log_message(f"[OpenAI] clasificador_consulta_menu tokens_used={tokens_used}", "DEBUG")
+            return response.choices[0].message.content.strip()
+
+        raw = respuesta_llm_cacheada(
+            "clasificador_consulta_menu", "gpt-4.1-mini", prompt, _llamar,
+            es_valida=lambda r: r in ("consulta_menu", "aclaracion_producto")
         )
-
-        raw = response.choices[0].message.content.strip()
-        # Registrar consumo de tokens
-        tokens_used = _extract_total_tokens(response)
-        if tokens_used is not None:
-            log_message(f"[OpenAI] clasificador_consulta_menu tokens_used={tokens_used}", "DEBUG")
         log_message(f'Respuesta de clasificación: {raw}', 'INFO')
         return raw
     except Exception as e:
@@ -2746,25 +2772,29 @@ def get_name(text: str) -> str | None:
     try:
         if not text or not isinstance(text, str):
             return None
-        client = OpenAI(api_key=get_openai_key())
+        client = cliente_llm("get_name")
         prompt = f"""Eres un asistente experto en extraer nombres de texto libre.
 Extrae SÓLO el nombre del siguiente texto y si no encuentras nombre responde como "No presente".
 Texto: "{text}"
 RESPONDE únicamente con el nombre, nada más."""
-        response = client.chat.completions.create(
-        model="gpt-5.1",
-            messages=[
-                {"role": "system", "content": "Eres un extractor preciso de nombres."},
-                {"role": "user", "content": prompt}
-            ],
- #           max_tokens=80,
-            temperature=0
-        )
-        raw = response.choices[0].message.content
-        # Registrar consumo de tokens
-        tokens_used = _extract_total_tokens(response)
-        if tokens_used is not None:
-            log_message(f"[OpenAI] get_direction tokens_used={tokens_used}", "DEBUG")
+
+        def _llamar() -> str:
+            response = client.chat.completions.create(
+            model="gpt-5.1",
+                messages=[
+                    {"role": "system", "content": "Eres un extractor preciso de nombres."},
+                    {"role": "user", "content": prompt}
+                ],
+     #           max_tokens=80,
+                temperature=0
+            )
+            # Registrar consumo de tokens
+            tokens_used = _extract_total_tokens(response)
+            if tokens_used is not None:
+                log_message(f"[OpenAI] get_direction tokens_used={tokens_used}", "DEBUG")
+            return response.choices[0].message.content
+
+        raw = respuesta_llm_cacheada("get_name", "gpt-5.1", prompt, _llamar)
         if raw == "" or raw is None or raw == "No presente":
             return None
         # normalizar a string y limpiar backticks
@@ -2785,7 +2815,7 @@ def clasificar_confirmación_general(pregunta_usuario: str, items, model: str =
     de la hamburguesería o no.
     """
 
-    client: OpenAI = OpenAI()
+    client = cliente_llm("clasificar_confirmación_general", salida=Intencion)
 
     prompt: str = f"""
     Eres un asistente que clasifica preguntas de clientes de una hamburguesería.
@@ -2816,7 +2846,7 @@ def clasificar_confirmación_general(pregunta_usuario: str, items, model: str =
     - "sin_intencion": Cuando no puedas detectar ninguna de las dos anteriores intenciones. 
 
     Este es el menú completo si la pregunta incluye un producto del menu o se refiere a comidas o bebidas es relacionada:
-    {json.dumps(items, ensure_ascii=False)}
+    {compilar_menu(items, 'nombres')}
     
     Ahora clasifica la siguiente pregunta del usuario:
     "{pregunta_usuario}"
@@ -2830,38 +2860,14 @@ def clasificar_confirmación_general(pregunta_usuario: str, items, model: str =
             input=prompt,
             temperature=0
         )
-        log_message(f'prompt: {prompt}', 'DEBUG')
+        log_message('prompt', 'DEBUG', prompt=prompt)
         text_output = response.output[0].content[0].text.strip()
-        # limpiar posibles fences/triple-backticks u otros prefijos
-        try:
-            text_output = _clean_model_output(text_output)
-        except Exception:
-            pass
         tokens_used = _extract_total_tokens(response)
         if tokens_used is not None:
             log_message(f"[OpenAI] clasificar_confirmacion_general_chatgpt tokens_used={tokens_used}", "DEBUG")
-        # Extraer JSON dentro de fences ```json ... ``` o buscar primer objeto JSON
-        clean = text_output or ""
-        m = re.search(r"```(?:json)?\s*([\s\S]*?)\s*```", clean, flags=re.IGNORECASE)
-        if m:
-            clean = m.group(1).strip()
-        else:
-            clean = clean.strip()
-        if not clean.startswith('{'):
-            m2 = re.search(r"(\{[\s\S]*\})", clean)
-            if m2:
-                clean = m2.group(1)
+        return a_dict(client.parsear(text_output))
 
-        try:
-            result = json.loads(clean)
-            return result
-        except json.JSONDecodeError:
-            logging.error(f"Error al parsear JSON en clasificar_pregunta_menu_chatgpt: {clean!r}")
-            log_message(f'Error al parsear JSON en <ClasificarPreguntaMenuChatGPT>: {clean}', 'ERROR')
-            return {"clasificacion": "no_relacionada"}
-
-    except json.JSONDecodeError:
-        logging.error(f"Error al parsear JSON: {text_output}")
+    except SalidaInvalida:
         log_message(f'Error al parsear JSON en <ClasificarPreguntaMenuChatGPT>: {text_output}', 'ERROR')
         return {"clasificacion": "no_relacionada"}
     except Exception as e:
@@ -2886,7 +2892,7 @@ Genera un mensaje CORTO, cálido y claro para un cliente.
 
 Datos:
 - Mensaje del cliente: {mensaje}
-- Menu {json.dumps(items, ensure_ascii=False)}
+- Menu {compilar_menu(items, 'basico')}
 Instrucciones del mensaje:
 - Resume los datos de manera natural.
 - No inventes información adicional.
@@ -2897,7 +2903,7 @@ Instrucciones del mensaje:
 - Si el cliente pregunta por domicilios si los tenemos siempre y cuando esten bajo el area de cobertura
 """
             
-        client = OpenAI()
+        client = cliente_llm("generar_mensaje_sin_intencion")
         response = client.chat.completions.create(
             model=model,
             messages=[
@@ -2907,7 +2913,7 @@ Instrucciones del mensaje:
             max_tokens=200,
             temperature=0.5
         )
-        log_message(f'prompt: {prompt}', 'DEBUG')
+        log_message('prompt', 'DEBUG', prompt=prompt)
         tokens_used = _extract_total_tokens(response)
         if tokens_used is not None:
             log_message(f"[OpenAI] generar_mensaje_invitar_pago tokens_used={tokens_used}", "DEBUG")
@@ -2924,7 +2930,7 @@ def get_tiempo_recogida(text: str) -> str | None:
     usando un LLM
     """
     try:
-        client = OpenAI(api_key=get_openai_key())
+        client = cliente_llm("get_tiempo_recogida")
         prompt = f"""Eres un asistente experto en extraer tiempos de recogida de texto libre.
 Extrae SÓLO el tiempo del siguiente texto y si no encuentras tiempo responde como "No presente".
 Si el usuario menciona una hora especifica regresa la hora en formato h:MM (ejemplo 2:30 )
@@ -2979,7 +2985,7 @@ def clasificar_negacion_general(pregunta_usuario: str, items, model: str = "gpt-
     de la hamburguesería o no.
     """
 
-    client: OpenAI = OpenAI()
+    client = cliente_llm("clasificar_negacion_general", salida=Intencion)
 
     prompt: str = f"""
     Eres un asistente que clasifica preguntas de clientes de una hamburguesería.
@@ -3003,7 +3009,7 @@ def clasificar_negacion_general(pregunta_usuario: str, items, model: str = "gpt-
     - "sin_intencion": Cuando no puedas detectar una confirmacion de pedido 
     - Si el cliente menciona que no le gusta un ingrediente dile que puede quitarlo del producto
     Este es el menú completo si la pregunta incluye un producto del menu o se refiere a comidas o bebidas es relacionada:
-    {json.dumps(items, ensure_ascii=False)}
+    {compilar_menu(items, 'nombres')}
     
     Ahora clasifica la siguiente pregunta del usuario:
     "{pregunta_usuario}"
@@ -3017,38 +3023,14 @@ def clasificar_negacion_general(pregunta_usuario: str, items, model: str = "gpt-
             input=prompt,
             temperature=0
         )
-        log_message(f'prompt: {prompt}', 'DEBUG')
+        log_message('prompt', 'DEBUG', prompt=prompt)
         text_output = response.output[0].content[0].text.strip()
-        # limpiar posibles fences/triple-backticks u otros prefijos
-        try:
-            text_output = _clean_model_output(text_output)
-        except Exception:
-            pass
         tokens_used = _extract_total_tokens(response)
         if tokens_used is not None:
             log_message(f"[OpenAI] clasificar_confirmacion_general_chatgpt tokens_used={tokens_used}", "DEBUG")
-        # Extraer JSON dentro de fences ```json ... ``` o buscar primer objeto JSON
-        clean = text_output or ""
-        m = re.search(r"```(?:json)?\s*([\s\S]*?)\s*```", clean, flags=re.IGNORECASE)
-        if m:
-            clean = m.group(1).strip()
-        else:
-            clean = clean.strip()
-        if not clean.startswith('{'):
-            m2 = re.search(r"(\{[\s\S]*\})", clean)
-            if m2:
-                clean = m2.group(1)
+        return a_dict(client.parsear(text_output))
 
-        try:
-            result = json.loads(clean)
-            return result
-        except json.JSONDecodeError:
-            logging.error(f"Error al parsear JSON en clasificar_pregunta_menu_chatgpt: {clean!r}")
-            log_message(f'Error al parsear JSON en <ClasificarPreguntaMenuChatGPT>: {clean}', 'ERROR')
-            return {"clasificacion": "no_relacionada"}
-
-    except json.JSONDecodeError:
-        logging.error(f"Error al parsear JSON: {text_output}")
+    except SalidaInvalida:
         log_message(f'Error al parsear JSON en <ClasificarPreguntaMenuChatGPT>: {text_output}', 'ERROR')
         return {"clasificacion": "no_relacionada"}
     except Exception as e:
@@ -3098,7 +3080,7 @@ def respuesta_transferencia(mensaje_usuario: str, nombre: str, nombre_local: str
                 "intencion": "queja_grave"
             }}
         """
-        client = OpenAI()
+        client = cliente_llm("respuesta_transferencia", salida=RespuestaQuejaGrave)
         prompt = PROMPT_QUEJA_GRAVE.format(
             mensaje_usuario=mensaje_usuario,
             nombre=nombre
@@ -3117,8 +3099,8 @@ def respuesta_transferencia(mensaje_usuario: str, nombre: str, nombre_local: str
         if tokens_used is not None:
             log_message(f"[OpenAI] respuesta_quejas_graves_ia tokens_used={tokens_used}", "DEBUG")
         try:
-            data = json.loads(raw)
-        except:  # noqa: E722
+            data = a_dict(client.parsear(raw))
+        except SalidaInvalida:
             data = {
                 "respuesta_cordial": f"{nombre}, ya reviso lo ocurrido con tu experiencia en {nombre_local} y activo el seguimiento de inmediato.",
                 "resumen_queja": "Queja grave del cliente sobre servicio o pedido.",
@@ -3160,7 +3142,7 @@ def extraer_resumen(mensajes , resumen ) -> dict:
         - Si no hay informacion no te preocupes por llenar los campos vacíos, es mejor dejarlos vacíos que inventar datos.
         - Se muy puntual y concreto en la información que extraes, no agregues explicaciones ni detalles adicionales.
         """
-        client = OpenAI()
+        client = cliente_llm("extraer_resumen", salida=PerfilCliente)
         prompt = PROMPT_SALUDO_DYNAMIC
         
         response = client.chat.completions.create(
@@ -3172,13 +3154,13 @@ def extraer_resumen(mensajes , resumen ) -> dict:
 #            max_tokens=350,
             temperature=0.1
         )
-        log_message(f'prompt: {prompt}', 'DEBUG')
+        log_message('prompt', 'DEBUG', prompt=prompt)
         raw = response.choices[0].message.content.strip()
         tokens_used = _extract_total_tokens(response)
         if tokens_used is not None:
             log_message(f"[OpenAI] extraer_resumen tokens_used={tokens_used}", "DEBUG")
         
-        data = json.loads(raw)
+        data = a_dict(client.parsear(raw))
         return data
     except Exception as e:
         log_message(f'Error en función <extraer_resumen>: {e}', 'ERROR')
@@ -3207,22 +3189,14 @@ def obtener_respuestas_mismo_dia(telefono: str) -> list:
 def obtener_resumen(telefono: str) -> list:
     log_message(f"Consultando resumen para {telefono}", "DEBUG")
     try:
-        query = """
-        SELECT resumen
-        FROM clientes_whatsapp
-        WHERE telefono = %s
-        AND id_restaurante = %s
-        LIMIT 1;
-        """
-
-        result = execute_query(query, (telefono, ID_RESTAURANTE,), fetchone=True)
+        perfil = obtener_perfil_cliente(telefono, ID_RESTAURANTE)
 
-        if not result:
+        if not perfil:
             log_message(f"No existe resumen previo para {telefono}", "INFO")
             return None
 
         log_message(f"Resumen obtenido para {telefono}", "DEBUG")
-        return result[0]
+        return perfil.get("resumen")
     except Exception as e:
         log_message(f"Error al obtener resumen para {telefono}: {e}", "ERROR")
         return None
@@ -3237,6 +3211,7 @@ def guardar_resumen(telefono: str, resumen: dict) -> None:
         """
 
         execute_query(query, (Json(resumen), telefono, ID_RESTAURANTE,))
+        actualizar_perfil_cliente(telefono, {"resumen": resumen})
         log_message(f"Resumen guardado para {telefono}", "DEBUG")
     except Exception as e:
         log_message(f"Error guardando resumen para {telefono}: {e}", "ERROR")
@@ -3267,23 +3242,12 @@ def resumen_conversacion(telefono: str) -> str:
         log_message(f"Error en resumen_conversacion para {telefono}: {e}", "ERROR")
         return None 
 
-import json
-from openai import OpenAI
-
 def extraer_resumen_corto(mensajes, telefono, id_restaurante):
     try:
         # 1️⃣ Obtener resumen actual desde clientes_whatsapp
-        query = """
-            SELECT resumen
-            FROM clientes_whatsapp
-            WHERE telefono = %s
-            AND id_restaurante = %s
-            LIMIT 1;
-        """
+        perfil = obtener_perfil_cliente(telefono, id_restaurante)
 
-        result = execute_query(query, (telefono, id_restaurante), fetchone=True)
-
-        resumen_actual = result[0] if result else {} if result else {}
+        resumen_actual = perfil.get("resumen") if perfil else {}
 
         if resumen_actual is None:
             resumen_actual = {}
@@ -3364,7 +3328,7 @@ Solo usar si es información crítica.
 Devuelve únicamente JSON válido.
 """
 
-        client = OpenAI()
+        client = cliente_llm("extraer_resumen_corto", salida=CambiosResumen)
 
         response = client.chat.completions.create(
             model="gpt-5.1",
@@ -3376,32 +3340,35 @@ Devuelve únicamente JSON válido.
         )
 
         raw = response.choices[0].message.content.strip()
-        raw = raw.replace("```json", "").replace("```", "").strip()
         tokens_used = _extract_total_tokens(response)
         if tokens_used is not None:
             log_message(f"[OpenAI] extraer_resumen tokens_used={tokens_used}", "DEBUG")
-        cambios = json.loads(raw)
-
-        # 3️⃣ Validación defensiva
-        if not isinstance(cambios, dict):
-            log_message("Respuesta del LLM no es dict", "ERROR")
+        try:
+            cambios = {k: v for k, v in a_dict(client.parsear(raw)).items() if v is not None}
+        except SalidaInvalida:
+            # 3️⃣ Validación defensiva
+            log_message("Respuesta del LLM no tiene la forma de CambiosResumen", "ERROR")
             return resumen_actual
 
         # 4️⃣ Merge controlado en backend
         resumen_actual.update(cambios)
+        if not cambios:
+            return resumen_actual
 
-        # 5️⃣ Guardar en jsonb (reemplazando el objeto final consolidado)
+        # 5️⃣ Merge en jsonb solo de las llaves cambiadas: corre en segundo plano y no debe pisar
+        # lo que el turno haya escrito en el resumen mientras tanto (ej: actualizar_resumen_parcial)
         update_query = """
             UPDATE clientes_whatsapp
-            SET resumen = %s::jsonb
+            SET resumen = COALESCE(resumen, '{}'::jsonb) || %s::jsonb
             WHERE telefono = %s
             AND id_restaurante = %s;
         """
 
         execute_query(
             update_query,
-            (json.dumps(resumen_actual, ensure_ascii=False), telefono, id_restaurante)
+            (json.dumps(cambios, ensure_ascii=False), telefono, id_restaurante)
         )
+        invalidar_perfil_cliente(telefono)
 
         return resumen_actual
 
@@ -3410,17 +3377,16 @@ Devuelve únicamente JSON válido.
         return None
     
 def obtener_pedido_en_proceso(telefono: str, id_restaurante: int) -> str:
-    query = """
-        SELECT COALESCE(NULLIF(resumen->>'pedido_en_proceso', ''), '')
-        FROM clientes_whatsapp
-        WHERE telefono = %s
-        AND id_restaurante = %s
-        LIMIT 1;
-    """
+    # El resumen lo escribe extraer_resumen_corto de forma diferida: puede ir atrasado hasta
+    # RESUMEN_CADA_MENSAJES mensajes o RESUMEN_CADA_SEGUNDOS segundos, y aquí eso se acepta
+    perfil = obtener_perfil_cliente(telefono, id_restaurante)
+    resumen = perfil.get("resumen") if perfil else None
 
-    result = execute_query(query, (telefono, id_restaurante), fetchone=True)
-
-    if not result:
+    if not isinstance(resumen, dict):
         return ""
 
-    return result[0] or ""
\ No newline at end of file
+    valor = resumen.get("pedido_en_proceso")
+    if not valor:
+        return ""
+    # Igual que resumen->>'pedido_en_proceso': texto tal cual, objetos como JSON
+    return valor if isinstance(valor, str) else json.dumps(valor, ensure_ascii=False)
\ No newline at end of file
@@ -0,0 +1,105 @@
+# utils_coalescencia.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Ventana de coalescencia por remitente: los mensajes que llegan seguidos ("hola", "quiero una
+# hamburguesa", "con papas") se fusionan en un solo turno antes de clasificar.
+
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+from utils_metricas import incrementar
+
+COALESCENCIA_VENTANA_SEGUNDOS: float = float(os.getenv("COALESCENCIA_VENTANA_SEGUNDOS", "1.5"))  # 0 desactiva
+
+class Reloj:
+    """Reloj real (segundos desde epoch). Se inyecta para poder reemplazarlo en pruebas."""
+
+    def ahora(self) -> float:
+        return time.time()
+
+    def dormir(self, segundos: float) -> None:
+        time.sleep(segundos)
+
+class RelojManual(Reloj):
+    """
+    Reloj determinista para pruebas: el tiempo solo avanza con avanzar() o dormir().
+    Ej: reloj = RelojManual(); c = CoalescedorMensajes(1.5, reloj); c.agregar(...); reloj.avanzar(1.0)
+    """
+
+    def __init__(self, inicio: float = 0.0) -> None:
+        self._ahora = inicio
+        self._lock = threading.Lock()
+
+    def ahora(self) -> float:
+        with self._lock:
+            return self._ahora
+
+    def avanzar(self, segundos: float) -> None:
+        with self._lock:
+            self._ahora += segundos
+
+    def dormir(self, segundos: float) -> None:
+        self.avanzar(segundos)
+
+class CoalescedorMensajes:
+    """
+    Buffer de mensajes por remitente con debounce.
+    Cada mensaje nuevo reinicia la ventana del remitente; cuando pasa la ventana sin mensajes
+    nuevos, tomar() entrega todo lo acumulado como un solo turno.
+    """
+
+    def __init__(self, ventana: float = COALESCENCIA_VENTANA_SEGUNDOS, reloj: Optional[Reloj] = None) -> None:
+        self.ventana = max(0.0, ventana)
+        self.reloj = reloj or Reloj()
+        self._lock = threading.Lock()
+        self._buffer: Dict[str, List[Dict[str, Any]]] = {}
+        self._ultimo: Dict[str, float] = {}
+
+    def agregar(self, sender: str, mensajes: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            self._buffer.setdefault(sender, []).extend(mensajes)
+            self._ultimo[sender] = self.reloj.ahora()
+
+    def restante(self, sender: str) -> float:
+        """Segundos que faltan para cerrar la ventana del remitente (0 si ya cerró o no hay mensajes)."""
+        with self._lock:
+            ultimo = self._ultimo.get(sender)
+            if ultimo is None:
+                return 0.0
+            return max(0.0, ultimo + self.ventana - self.reloj.ahora())
+
+    def tomar(self, sender: str) -> List[Dict[str, Any]]:
+        """Retira y retorna los mensajes acumulados del remitente, ordenados por timestamp."""
+        with self._lock:
+            mensajes = self._buffer.pop(sender, [])
+            self._ultimo.pop(sender, None)
+        if len(mensajes) > 1:
+            incrementar("coalescencia.mensajes_fusionados", len(mensajes) - 1)
+        return sorted(mensajes, key=lambda m: int(m.get("timestamp") or 0))
+
+    def esperar_y_tomar(self, sender: str) -> List[Dict[str, Any]]:
+        """
+        Espera a que se cierre la ventana del remitente y toma sus mensajes.
+        Si otro turno ya los tomó retorna []; el llamador no debe procesar nada.
+        """
+        espera = self.restante(sender)
+        while espera > 0:
+            self.reloj.dormir(espera)
+            espera = self.restante(sender)
+        return self.tomar(sender)
+
+def registrar_turno_fusionado(cantidad_textos: int) -> None:
+    """Cuenta las llamadas al clasificador evitadas al procesar varios textos como un solo turno."""
+    if cantidad_textos > 1:
+        incrementar("coalescencia.llamadas_llm_ahorradas", cantidad_textos - 1)
+
+_coalescedor = None
+_coalescedor_lock = threading.Lock()
+
+def obtener_coalescedor() -> CoalescedorMensajes:
+    """Retorna el coalescedor del proceso (instancia única)."""
+    global _coalescedor
+    with _coalescedor_lock:
+        if _coalescedor is None:
+            _coalescedor = CoalescedorMensajes()
+        return _coalescedor
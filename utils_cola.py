@@ -0,0 +1,292 @@
+# utils_cola.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Cola durable de eventos del webhook: /wpp persiste el evento crudo y un worker lo procesa después.
+
+import glob
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+from psycopg2.extras import Json
+from utils import log_message
+from utils_coalescencia import COALESCENCIA_VENTANA_SEGUNDOS, Reloj
+from utils_database import execute_query
+from utils_despachador import obtener_despachador
+from utils_metricas import incrementar
+
+COLA_BACKEND: str = os.getenv("COLA_BACKEND", "postgres")  # "postgres" | "archivo"
+COLA_DIRECTORIO: str = os.getenv("COLA_DIRECTORIO", ".cola_eventos")
+COLA_MAX_INTENTOS: int = int(os.getenv("COLA_MAX_INTENTOS", "3"))
+COLA_VISIBILIDAD_SEGUNDOS: int = int(os.getenv("COLA_VISIBILIDAD_SEGUNDOS", "300"))  # reclama eventos de workers caídos
+COLA_TAMANO_LOTE: int = int(os.getenv("COLA_TAMANO_LOTE", "20"))
+
+DDL_COLA_EVENTOS: str = """
+    CREATE TABLE IF NOT EXISTS cola_eventos (
+        id BIGSERIAL PRIMARY KEY,
+        telefono VARCHAR(20) NOT NULL,
+        payload JSONB NOT NULL,
+        estado VARCHAR(15) NOT NULL DEFAULT 'pendiente',
+        intentos INT NOT NULL DEFAULT 0,
+        error TEXT,
+        fecha_creacion TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        fecha_inicio TIMESTAMPTZ
+    );
+    CREATE INDEX IF NOT EXISTS idx_cola_eventos_estado_telefono
+        ON cola_eventos (estado, telefono, id);
+"""
+
+def agrupar_mensajes_por_remitente(payload: Dict[str, Any]) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Recorre todas las entradas, cambios y mensajes del evento y los agrupa por teléfono.
+    Cada grupo queda ordenado por timestamp de WhatsApp. Eventos de solo estados retornan {}.
+    """
+    grupos: Dict[str, List[Dict[str, Any]]] = {}
+    try:
+        for entry in payload.get("entry", []) or []:
+            for change in entry.get("changes", []) or []:
+                for message in change.get("value", {}).get("messages", []) or []:
+                    if message.get("from"):
+                        grupos.setdefault(message["from"], []).append(message)
+    except Exception as e:
+        logging.error(f"Error agrupando mensajes del evento: {e}")
+    for mensajes in grupos.values():
+        mensajes.sort(key=lambda m: int(m.get("timestamp") or 0))
+    return grupos
+
+def evento_de_remitente(mensajes: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Arma un evento con la misma forma del de Meta que contiene solo los mensajes dados."""
+    return {"entry": [{"changes": [{"value": {"messages": mensajes}}]}]}
+
+class ColaPostgres:
+    """
+    Cola sobre la tabla cola_eventos.
+    Garantiza orden por remitente: solo se reclama el evento más antiguo de cada teléfono
+    y únicamente si no hay otro evento de ese teléfono en proceso.
+    """
+
+    def __init__(self) -> None:
+        self._tabla_lista = False
+
+    def _asegurar_tabla(self) -> None:
+        if not self._tabla_lista:
+            execute_query(DDL_COLA_EVENTOS)
+            self._tabla_lista = True
+
+    def encolar(self, telefono: str, payload: Dict[str, Any]) -> None:
+        self._asegurar_tabla()
+        execute_query(
+            "INSERT INTO cola_eventos (telefono, payload) VALUES (%s, %s);",
+            (telefono, Json(payload))
+        )
+
+    def reclamar(self, limite: int = COLA_TAMANO_LOTE) -> List[Dict[str, Any]]:
+        """
+        Reclama todos los eventos pendientes de hasta `limite` remitentes.
+        Un remitente solo es elegible si lleva COALESCENCIA_VENTANA_SEGUNDOS sin eventos nuevos
+        y no tiene otro evento en proceso; sus eventos se atienden juntos como un turno.
+        """
+        self._asegurar_tabla()
+        query = """
+            WITH remitentes AS (
+                SELECT c.telefono
+                FROM cola_eventos c
+                WHERE c.estado = 'pendiente'
+                   OR (c.estado = 'procesando' AND c.fecha_inicio < NOW() - make_interval(secs => %s))
+                GROUP BY c.telefono
+                HAVING MAX(c.fecha_creacion) <= NOW() - make_interval(secs => %s)
+                   AND NOT EXISTS (
+                       SELECT 1
+                       FROM cola_eventos p
+                       WHERE p.telefono = c.telefono
+                         AND p.estado = 'procesando'
+                         AND p.fecha_inicio >= NOW() - make_interval(secs => %s)
+                   )
+                ORDER BY MIN(c.id)
+                LIMIT %s
+            ),
+            candidatos AS (
+                SELECT c.id
+                FROM cola_eventos c
+                JOIN remitentes r ON r.telefono = c.telefono
+                WHERE c.estado = 'pendiente'
+                   OR (c.estado = 'procesando' AND c.fecha_inicio < NOW() - make_interval(secs => %s))
+                FOR UPDATE OF c SKIP LOCKED
+            )
+            UPDATE cola_eventos e
+            SET estado = 'procesando', intentos = e.intentos + 1, fecha_inicio = NOW()
+            FROM candidatos
+            WHERE e.id = candidatos.id
+            RETURNING e.id, e.telefono, e.payload, e.intentos;
+        """
+        params = (
+            COLA_VISIBILIDAD_SEGUNDOS, COALESCENCIA_VENTANA_SEGUNDOS,
+            COLA_VISIBILIDAD_SEGUNDOS, limite, COLA_VISIBILIDAD_SEGUNDOS
+        )
+        rows = execute_query(query, params) or []
+        eventos = [
+            {"id": r[0], "telefono": r[1], "payload": r[2], "intentos": r[3]}
+            for r in rows
+        ]
+        return sorted(eventos, key=lambda e: e["id"])
+
+    def completar(self, id_evento: Any) -> None:
+        execute_query("DELETE FROM cola_eventos WHERE id = %s;", (id_evento,))
+
+    def fallar(self, id_evento: Any, error: str) -> None:
+        # Vuelve a 'pendiente' para conservar el orden del remitente; tras agotar intentos se descarta
+        execute_query("""
+            UPDATE cola_eventos
+            SET estado = CASE WHEN intentos >= %s THEN 'fallido' ELSE 'pendiente' END,
+                error = %s
+            WHERE id = %s;
+        """, (COLA_MAX_INTENTOS, error, id_evento))
+
+class ColaArchivo:
+    """
+    Sustituto de la cola basado en archivos para pruebas y ejecución local.
+    Cada evento es un archivo JSON; se renombra a .procesando mientras se atiende.
+    El reloj es inyectable (RelojManual) para probar la ventana de coalescencia sin esperas reales.
+    """
+
+    def __init__(self, directorio: str = COLA_DIRECTORIO, reloj: Optional[Reloj] = None,
+                 ventana: float = COALESCENCIA_VENTANA_SEGUNDOS) -> None:
+        self.directorio = directorio
+        self.reloj = reloj or Reloj()
+        self.ventana = ventana
+        self._lock = threading.Lock()
+        self._secuencia = itertools.count()
+        os.makedirs(directorio, exist_ok=True)
+
+    def _leer(self, ruta: str) -> Dict[str, Any]:
+        with open(ruta, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _escribir(self, ruta: str, data: Dict[str, Any]) -> None:
+        temporal = ruta + ".tmp"
+        with open(temporal, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(temporal, ruta)
+
+    def encolar(self, telefono: str, payload: Dict[str, Any]) -> None:
+        ahora = self.reloj.ahora()
+        nombre = f"{int(ahora * 1e9):020d}_{next(self._secuencia):06d}_{telefono}.json"
+        self._escribir(
+            os.path.join(self.directorio, nombre),
+            {"telefono": telefono, "payload": payload, "intentos": 0, "creado": ahora}
+        )
+
+    def reclamar(self, limite: int = COLA_TAMANO_LOTE) -> List[Dict[str, Any]]:
+        with self._lock:
+            archivos = sorted(
+                glob.glob(os.path.join(self.directorio, "*.json"))
+                + glob.glob(os.path.join(self.directorio, "*.procesando"))
+            )
+            ahora = self.reloj.ahora()
+            por_remitente: Dict[str, List[str]] = {}
+            for ruta in archivos:
+                telefono = os.path.basename(ruta).rsplit(".", 1)[0].split("_")[-1]
+                por_remitente.setdefault(telefono, []).append(ruta)
+            eventos = []
+            remitentes = 0
+            for telefono, rutas in por_remitente.items():
+                if remitentes >= limite:
+                    break
+                datos = {ruta: self._leer(ruta) for ruta in rutas}
+                en_proceso = [
+                    ruta for ruta in rutas
+                    if ruta.endswith(".procesando")
+                    and ahora - float(datos[ruta].get("inicio", 0)) < COLA_VISIBILIDAD_SEGUNDOS
+                ]
+                if en_proceso:
+                    continue
+                if ahora - max(float(d.get("creado", 0)) for d in datos.values()) < self.ventana:
+                    continue
+                remitentes += 1
+                for ruta in rutas:
+                    data = datos[ruta]
+                    data["intentos"] = int(data.get("intentos", 0)) + 1
+                    data["inicio"] = ahora
+                    ruta_proceso = ruta.rsplit(".", 1)[0] + ".procesando"
+                    self._escribir(ruta_proceso, data)
+                    if ruta != ruta_proceso:
+                        os.remove(ruta)
+                    eventos.append({
+                        "id": ruta_proceso,
+                        "telefono": telefono,
+                        "payload": data["payload"],
+                        "intentos": data["intentos"]
+                    })
+            return eventos
+
+    def completar(self, id_evento: Any) -> None:
+        try:
+            os.remove(id_evento)
+        except FileNotFoundError:
+            pass
+
+    def fallar(self, id_evento: Any, error: str) -> None:
+        with self._lock:
+            data = self._leer(id_evento)
+            data["error"] = error
+            if int(data.get("intentos", 0)) >= COLA_MAX_INTENTOS:
+                self._escribir(id_evento[: -len(".procesando")] + ".fallido", data)
+            else:
+                self._escribir(id_evento[: -len(".procesando")] + ".json", data)
+            os.remove(id_evento)
+
+_cola = None
+
+def obtener_cola():
+    """Retorna la cola configurada en COLA_BACKEND (instancia única por proceso)."""
+    global _cola
+    if _cola is None:
+        _cola = ColaArchivo() if COLA_BACKEND == "archivo" else ColaPostgres()
+    return _cola
+
+def _fusionar_eventos(telefono: str, eventos: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Une los mensajes de varios eventos del mismo remitente en un solo evento (un turno)."""
+    mensajes: List[Dict[str, Any]] = []
+    for evento in eventos:
+        mensajes.extend(agrupar_mensajes_por_remitente(evento["payload"]).get(telefono, []))
+    mensajes.sort(key=lambda m: int(m.get("timestamp") or 0))
+    return evento_de_remitente(mensajes)
+
+def drenar_cola(procesar: Callable[[Dict[str, Any]], Any], tiempo_max: float = 50.0) -> int:
+    """
+    Reclama y procesa eventos hasta vaciar la cola o agotar tiempo_max segundos.
+    Los eventos reclamados de un mismo remitente se fusionan en un turno y cada turno se
+    envía al despachador (paralelo entre teléfonos).
+    Retorna la cantidad de eventos procesados correctamente.
+    """
+    cola = obtener_cola()
+    despachador = obtener_despachador()
+    inicio = time.monotonic()
+    procesados = 0
+    while time.monotonic() - inicio < tiempo_max:
+        eventos = cola.reclamar()
+        if not eventos:
+            break
+        grupos: Dict[str, List[Dict[str, Any]]] = {}
+        for evento in eventos:
+            grupos.setdefault(evento["telefono"], []).append(evento)
+        futuros = []
+        for telefono, grupo in grupos.items():
+            if len(grupo) > 1:
+                incrementar("coalescencia.eventos_fusionados", len(grupo) - 1)
+            futuros.append((grupo, despachador.enviar(telefono, procesar, _fusionar_eventos(telefono, grupo))))
+        for grupo, futuro in futuros:
+            ids = [evento["id"] for evento in grupo]
+            try:
+                futuro.result()
+                for id_evento in ids:
+                    cola.completar(id_evento)
+                procesados += len(ids)
+            except Exception as e:
+                log_message(f"Error procesando eventos {ids} de la cola: {e}", "ERROR")
+                logging.error(f"Error procesando eventos {ids} de la cola: {e}")
+                for id_evento in ids:
+                    cola.fallar(id_evento, str(e))
+    return procesados
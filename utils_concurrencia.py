@@ -0,0 +1,211 @@
+# utils_concurrencia.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Abanico de llamadas independientes (LLM, HTTP) dentro de un turno: se lanzan en un pool de hilos
+# compartido con copia de los contextvars (deadline, conteo de queries), se esperan hasta el deadline
+# del turno y se registra la latencia del camino crítico frente a la suma secuencial. También tareas
+# diferidas con antirrebote por remitente para el trabajo que no necesita bloquear la respuesta.
+
+import contextvars
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+from utils_database import segundos_restantes
+from utils_metricas import incrementar, observar
+
+CONCURRENCIA_MAX_HILOS: int = int(os.getenv("CONCURRENCIA_MAX_HILOS", "8"))
+CONCURRENCIA_TIMEOUT_SEGUNDOS: float = float(os.getenv("CONCURRENCIA_TIMEOUT_SEGUNDOS", "30"))  # si el turno no fija deadline
+DIFERIDAS_MAX_HILOS: int = int(os.getenv("DIFERIDAS_MAX_HILOS", "2"))  # pool propio: el fondo no compite con el abanico
+
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+_cancelado: contextvars.ContextVar[Optional[threading.Event]] = contextvars.ContextVar("cancelado", default=None)
+
+def _obtener_pool() -> ThreadPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=CONCURRENCIA_MAX_HILOS, thread_name_prefix="abanico")
+        return _pool
+
+_pool_diferidas: Optional[ThreadPoolExecutor] = None
+
+def _obtener_pool_diferidas() -> ThreadPoolExecutor:
+    global _pool_diferidas
+    with _pool_lock:
+        if _pool_diferidas is None:
+            _pool_diferidas = ThreadPoolExecutor(max_workers=max(1, DIFERIDAS_MAX_HILOS), thread_name_prefix="diferidas")
+        return _pool_diferidas
+
+def lanzar(funcion: Callable[..., Any], *args: Any, **kwargs: Any) -> Future:
+    """
+    Ejecuta funcion en el pool con una copia del contexto actual: hereda el deadline del turno y el
+    conteo de queries. duracion_ms(futuro) da lo que tardó la función una vez terminada.
+    """
+    contexto = contextvars.copy_context()
+    medicion = [0.0]
+
+    def _ejecutar() -> Any:
+        inicio = time.perf_counter()
+        try:
+            return contexto.run(funcion, *args, **kwargs)
+        finally:
+            medicion[0] = (time.perf_counter() - inicio) * 1000
+
+    futuro: Future = _obtener_pool().submit(_ejecutar)
+    futuro.medicion = medicion
+    return futuro
+
+def duracion_ms(futuro: Future) -> float:
+    medicion = getattr(futuro, "medicion", None)
+    return medicion[0] if medicion else 0.0
+
+def cancelacion_solicitada() -> bool:
+    """True dentro de una tarea de en_paralelo cuyo abanico ya venció: conviene retornar cuanto antes."""
+    evento = _cancelado.get()
+    return bool(evento and evento.is_set())
+
+def _limite(timeout: Optional[float]) -> float:
+    restante = segundos_restantes()
+    limite = CONCURRENCIA_TIMEOUT_SEGUNDOS if timeout is None else timeout
+    return limite if restante is None else min(limite, restante)
+
+def en_paralelo(tareas: Dict[str, Callable[[], Any]], nombre: str = "abanico", timeout: Optional[float] = None, por_defecto: Any = None) -> Dict[str, Any]:
+    """
+    Ejecuta las tareas (nombre -> función sin argumentos) a la vez y retorna nombre -> resultado.
+    Espera hasta timeout o el deadline del turno, lo que llegue primero. Una tarea que falla o no
+    termina a tiempo queda con por_defecto; las que no alcanzaron a empezar se cancelan y las que
+    siguen corriendo ven cancelacion_solicitada() en True.
+    Métricas: concurrencia.<nombre>.camino_critico_ms (tarea más lenta), .total_ms y .secuencial_ms (suma).
+    """
+    if not tareas:
+        return {}
+    evento = threading.Event()
+    inicio = time.perf_counter()
+
+    def _con_cancelacion(funcion: Callable[[], Any]) -> Callable[[], Any]:
+        def _tarea() -> Any:
+            _cancelado.set(evento)
+            return funcion()
+        return _tarea
+
+    futuros = {clave: lanzar(_con_cancelacion(funcion)) for clave, funcion in tareas.items()}
+    terminados, pendientes = wait(futuros.values(), timeout=_limite(timeout))
+    if pendientes:
+        evento.set()
+        for futuro in pendientes:
+            futuro.cancel()
+        incrementar(f"concurrencia.{nombre}.vencidas", len(pendientes))
+        logging.error(f"en_paralelo {nombre}: {len(pendientes)} tarea(s) sin terminar al vencer el deadline")
+    resultados: Dict[str, Any] = {}
+    for clave, futuro in futuros.items():
+        if futuro not in terminados:
+            resultados[clave] = por_defecto
+            continue
+        try:
+            resultados[clave] = futuro.result()
+        except Exception as e:
+            incrementar(f"concurrencia.{nombre}.errores")
+            logging.error(f"en_paralelo {nombre}: la tarea {clave} falló: {e}")
+            resultados[clave] = por_defecto
+    duraciones = [duracion_ms(f) for f in terminados]
+    observar(f"concurrencia.{nombre}.total_ms", (time.perf_counter() - inicio) * 1000)
+    if duraciones:
+        observar(f"concurrencia.{nombre}.camino_critico_ms", max(duraciones))
+        observar(f"concurrencia.{nombre}.secuencial_ms", sum(duraciones))
+    return resultados
+
+class TareaDiferida:
+    """
+    Corre funcion(clave) en segundo plano y fuera del turno (contexto limpio, sin su deadline), como
+    máximo una vez por clave cada cada_mensajes avisos o cada_segundos, lo primero que se cumpla.
+    Los avisos que no alcanzan el umbral se procesan con un temporizador al vencer cada_segundos.
+    Nunca corre dos veces a la vez para la misma clave. Usa un pool aparte (DIFERIDAS_MAX_HILOS) para
+    que una ráfaga de trabajo de fondo no deje sin hilos a en_paralelo en el camino crítico.
+    """
+
+    def __init__(self, nombre: str, funcion: Callable[[str], Any], cada_mensajes: int, cada_segundos: float,
+                 max_claves: int = 10000, reloj: Callable[[], float] = time.monotonic) -> None:
+        self.nombre = nombre
+        self.funcion = funcion
+        self.cada_mensajes = max(1, cada_mensajes)
+        self.cada_segundos = cada_segundos
+        self.max_claves = max_claves
+        self._reloj = reloj
+        self._lock = threading.Lock()
+        self._estado: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+    def avisar(self, clave: str) -> bool:
+        """Registra un mensaje de clave; retorna True si con este aviso se lanzó la tarea."""
+        with self._lock:
+            estado = self._estado.get(clave)
+            if estado is None:
+                estado = {"avisos": 0, "ultima": None, "corriendo": False, "temporizador": None}
+                self._estado[clave] = estado
+                while len(self._estado) > self.max_claves:
+                    self._estado.popitem(last=False)
+            self._estado.move_to_end(clave)
+            estado["avisos"] += 1
+            lanzar_ahora = self._evaluar(clave, estado)
+        if lanzar_ahora:
+            self._lanzar(clave)
+        else:
+            incrementar(f"diferidas.{self.nombre}.pospuestas")
+        return lanzar_ahora
+
+    def _evaluar(self, clave: str, estado: Dict[str, Any]) -> bool:
+        # Se llama con self._lock tomado
+        if estado["corriendo"] or not estado["avisos"]:
+            return False
+        transcurrido = None if estado["ultima"] is None else self._reloj() - estado["ultima"]
+        if transcurrido is None or estado["avisos"] >= self.cada_mensajes or transcurrido >= self.cada_segundos:
+            estado["corriendo"] = True
+            estado["avisos"] = 0
+            if estado["temporizador"] is not None:
+                estado["temporizador"].cancel()
+                estado["temporizador"] = None
+            return True
+        if estado["temporizador"] is None:
+            temporizador = threading.Timer(self.cada_segundos - transcurrido, self._al_vencer, args=(clave,))
+            temporizador.daemon = True
+            estado["temporizador"] = temporizador
+            temporizador.start()
+        return False
+
+    def _al_vencer(self, clave: str) -> None:
+        with self._lock:
+            estado = self._estado.get(clave)
+            if estado is None:
+                return
+            estado["temporizador"] = None
+            lanzar_ahora = self._evaluar(clave, estado)
+        if lanzar_ahora:
+            self._lanzar(clave)
+
+    def _lanzar(self, clave: str) -> None:
+        def _ejecutar() -> None:
+            inicio = time.perf_counter()
+            try:
+                self.funcion(clave)
+                incrementar(f"diferidas.{self.nombre}.ejecuciones")
+            except Exception as e:
+                incrementar(f"diferidas.{self.nombre}.errores")
+                logging.error(f"Tarea diferida {self.nombre} falló para {clave}: {e}")
+            finally:
+                observar(f"diferidas.{self.nombre}_ms", (time.perf_counter() - inicio) * 1000)
+                with self._lock:
+                    estado = self._estado.get(clave)
+                    if estado is not None:
+                        estado["corriendo"] = False
+                        estado["ultima"] = self._reloj()
+                        # Avisos que llegaron mientras corría quedan para el siguiente umbral
+                        lanzar_otra = self._evaluar(clave, estado)
+                    else:
+                        lanzar_otra = False
+                if lanzar_otra:
+                    self._lanzar(clave)
+
+        _obtener_pool_diferidas().submit(contextvars.Context().run, _ejecutar)
@@ -1,7 +1,10 @@
 # Last modified: 2025-21-12 Juan Agudelo
 import contextvars
-from typing import Optional
-from utils_database import execute_query
+import copy
+import logging
+from typing import Any, Dict, Optional
+from utils_database import execute_query, execute_query_columns
+from utils_metricas import incrementar
 from psycopg2.extras import Json
 import os
 # from utils import es_menor_24h
@@ -13,18 +16,59 @@ ID_RESTAURANTE: str = os.getenv("ID_RESTAURANTE", "5")
 
 _sender_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("sender", default=None)
 _id_cliente_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("id_cliente", default=None)
+# Cache del turno: teléfono -> fila completa de clientes_whatsapp (None si el cliente no existe)
+_perfiles_var: contextvars.ContextVar[Optional[Dict[str, Optional[Dict[str, Any]]]]] = contextvars.ContextVar("perfiles_cliente", default=None)
 
 def set_sender(sender: str) -> None:
     _sender_var.set(sender)
+    # Cada turno arranca con el cache de perfiles vacío
+    _perfiles_var.set({})
 
 def get_sender() -> Optional[str]:
     return _sender_var.get()
 
+def obtener_perfil_cliente(telefono: str, id_restaurante: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    Retorna la fila completa de clientes_whatsapp del teléfono como dict (None si no existe).
+    Dentro de un turno (después de set_sender) la fila se lee una sola vez y las siguientes
+    llamadas salen de memoria. Si se pasa id_restaurante y no coincide, retorna None.
+    """
+    cache = _perfiles_var.get()
+    if cache is not None and telefono in cache:
+        incrementar("perfil_cliente.aciertos")
+        perfil = cache[telefono]
+    else:
+        data, cols = execute_query_columns(
+            "SELECT * FROM clientes_whatsapp WHERE telefono = %s LIMIT 1;",
+            (telefono,), fetchone=True, return_columns=True
+        )
+        perfil = dict(zip(cols, data)) if data else None
+        incrementar("perfil_cliente.cargas")
+        if cache is not None:
+            cache[telefono] = perfil
+    if perfil is None:
+        return None
+    if id_restaurante is not None and str(perfil.get("id_restaurante")) != str(id_restaurante):
+        return None
+    # Copia para que el llamador no modifique el cache (ej: el jsonb resumen)
+    return copy.deepcopy(perfil)
+
+def actualizar_perfil_cliente(telefono: str, cambios: Dict[str, Any]) -> None:
+    """Write-through: refleja en el cache del turno las columnas que se acaban de actualizar en BD."""
+    cache = _perfiles_var.get()
+    if cache is not None and cache.get(telefono) is not None:
+        cache[telefono].update(copy.deepcopy(cambios))
+
+def invalidar_perfil_cliente(telefono: str) -> None:
+    """Descarta la fila cacheada; la próxima lectura del turno vuelve a la BD."""
+    cache = _perfiles_var.get()
+    if cache is not None:
+        cache.pop(telefono, None)
+
 def set_id_sede(sender: str) -> None:
     try:
-        query = """SELECT id_sede FROM clientes_whatsapp WHERE telefono = %s LIMIT 1"""
-        result = execute_query(query, (sender,))
-        id_sede = result[0][0] if result else None
+        perfil = obtener_perfil_cliente(sender)
+        id_sede = perfil.get("id_sede") if perfil else None
         print(f'ID sede obtenido: {id_sede}', 'INFO')
         _id_cliente_var.set(id_sede)
     except Exception as e:
@@ -144,6 +188,7 @@ def obtener_contexto_conversacion(telefono: str) -> list:
             query,
             (json.dumps(resumen_base), telefono, ID_RESTAURANTE)
         )
+        actualizar_perfil_cliente(telefono, {"resumen": resumen_base})
     return mensajes
 
 
@@ -187,6 +232,33 @@ def obtener_estado_pedido(telefono: str, id_restaurante: int):
         return None
     
 
+def tiene_pedido_en_curso(telefono: str, id_restaurante: int) -> bool:
+    """
+    True si el cliente tiene un pedido en curso según la base (paso activo en estado_pedido o pedido
+    temporal de la última hora). No depende del resumen, que se actualiza en segundo plano.
+    Ante un error retorna True: es más seguro pasar por el LLM que armar un pedido nuevo encima.
+    """
+    try:
+        query = """
+            SELECT EXISTS (
+                SELECT 1 FROM estado_pedido
+                WHERE telefono = %s AND id_restaurante = %s
+            ) OR EXISTS (
+                SELECT 1
+                FROM pedidos p
+                JOIN clientes_whatsapp c ON c.id_whatsapp = p.id_whatsapp
+                WHERE c.telefono = %s
+                  AND c.id_restaurante = %s
+                  AND p.es_temporal = TRUE
+                  AND p.fecha >= NOW() - INTERVAL '1 hour'
+            );
+        """
+        result = execute_query(query, (telefono, id_restaurante, telefono, id_restaurante), fetchone=True)
+        return bool(result and result[0])
+    except Exception as e:
+        logging.error(f"Error en tiene_pedido_en_curso: {e}")
+        return True
+
 def crear_estado_inicial(telefono: str, id_restaurante: int, estado: str ,num_pedido: str ):
     try:
         query = """
@@ -303,6 +375,7 @@ def actualizar_resumen_parcial(id_cliente: int, telefono: str, cambios: dict) ->
         valores.append(telefono)
 
         execute_query(query, tuple(valores))
+        invalidar_perfil_cliente(telefono)
 
         return True
 
@@ -311,14 +384,7 @@ def actualizar_resumen_parcial(id_cliente: int, telefono: str, cambios: dict) ->
         return False
     
 def obtener_resumen(id_cliente: int, telefono: str):
-    query = """
-        SELECT resumen
-        FROM clientes_whatsapp
-        WHERE id_cliente = %s
-        AND telefono = %s
-        LIMIT 1;
-    """
-
-    result = execute_query(query, (id_cliente, telefono), fetchone=True)
-
-    return result["resumen"] if result else None
\ No newline at end of file
+    perfil = obtener_perfil_cliente(telefono)
+    if not perfil or str(perfil.get("id_cliente")) != str(id_cliente):
+        return None
+    return perfil.get("resumen")
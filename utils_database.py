@@ -1,142 +1,321 @@
 # utils_database.py
-# Last modified: 2025-21-12 Juan Agudelo
+# Last modified: 2026-10-17 Juan Agudelo
 
 import os
-from psycopg2.extensions import connection, cursor
-from psycopg2.pool import ThreadedConnectionPool
+import contextvars
+import psycopg2
+from psycopg2 import InterfaceError, OperationalError
+from psycopg2.extensions import TRANSACTION_STATUS_INERROR, connection, cursor
+from psycopg2.pool import PoolError, ThreadedConnectionPool
 import logging
+import random
+import threading
 import time
+import traceback
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from utils_metricas import fijar, incrementar, observar
+
+DB_POOL_MIN: int = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX: int = int(os.getenv("DB_POOL_MAX", "20"))
+DB_POOL_TIMEOUT_SEGUNDOS: float = float(os.getenv("DB_POOL_TIMEOUT_SEGUNDOS", "10"))  # espera máxima por una conexión libre
+DB_VALIDAR_INACTIVA_SEGUNDOS: float = float(os.getenv("DB_VALIDAR_INACTIVA_SEGUNDOS", "30"))  # ping solo si estuvo ociosa más de esto
+DB_FUGA_SEGUNDOS: float = float(os.getenv("DB_FUGA_SEGUNDOS", "30"))  # conexión retenida más de esto se reporta como fuga
+DB_REINTENTOS: int = int(os.getenv("DB_REINTENTOS", "3"))
+DB_BACKOFF_BASE_SEGUNDOS: float = float(os.getenv("DB_BACKOFF_BASE_SEGUNDOS", "0.2"))
+DB_BACKOFF_MAX_SEGUNDOS: float = float(os.getenv("DB_BACKOFF_MAX_SEGUNDOS", "2"))
+DB_DEADLINE_SEGUNDOS: float = float(os.getenv("DB_DEADLINE_SEGUNDOS", "20"))  # presupuesto por query si el turno no fija uno
+
+# Errores de conexión/red que vale la pena reintentar; los errores de SQL se propagan de una vez
+ERRORES_TRANSITORIOS: Tuple[type, ...] = (OperationalError, InterfaceError, PoolError)
+
 _pool = None
+_pool_lock = threading.Lock()
+_cupos: Optional[threading.BoundedSemaphore] = None
+_prestadas: Dict[int, Tuple[float, str]] = {}
+_ultimo_uso: Dict[int, float] = {}
+_prestadas_lock = threading.Lock()
+_ultima_revision_fugas: float = 0.0
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("deadline_db", default=None)
+_unidad: contextvars.ContextVar[Optional[connection]] = contextvars.ContextVar("unidad_de_trabajo", default=None)
+_conteo_consultas: contextvars.ContextVar[Optional[List[int]]] = contextvars.ContextVar("conteo_consultas", default=None)
+
+def fijar_deadline(segundos: float) -> None:
+    """Fija el tiempo límite (desde ahora) para todas las queries del turno/contexto actual."""
+    _deadline.set(time.monotonic() + segundos)
+
+def segundos_restantes() -> Optional[float]:
+    """Segundos que quedan del deadline fijado con fijar_deadline (None si no hay uno)."""
+    deadline = _deadline.get()
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+def iniciar_conteo_consultas() -> None:
+    """Empieza a contar las queries del contexto actual (ej: un turno de conversación)."""
+    _conteo_consultas.set([0])
+
+def consultas_contadas() -> int:
+    """Queries ejecutadas desde iniciar_conteo_consultas() en este contexto."""
+    conteo = _conteo_consultas.get()
+    return conteo[0] if conteo else 0
+
+def _deadline_efectivo() -> float:
+    deadline = _deadline.get()
+    por_query = time.monotonic() + DB_DEADLINE_SEGUNDOS
+    return por_query if deadline is None else min(deadline, por_query)
+
+def _parametros_conexion() -> Dict[str, str]:
+    dbname: str = os.getenv("DB_NAME", "")
+    user: str = os.getenv("DB_USER", "")
+    password: str = os.getenv("DB_PASSWORD", "")
+    host: str = os.getenv("DB_HOST", "")
+    port: str = os.getenv("DB_PORT", "5432")
+    if not all([dbname, user, password, host]):
+        raise ValueError("Faltan variables de entorno para la conexión a la base de datos.")
+    return {
+        "dbname": dbname,
+        "user": user,
+        "password": password,
+        "host": host,
+        "port": port,
+        "sslmode": "require",
+        "application_name": "whatsapp_bot"
+    }
+
+def _crear_pool() -> ThreadedConnectionPool:
+    return ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, **_parametros_conexion())
+
+def conexion_dedicada(autocommit: bool = True) -> connection:
+    """
+    Conexión propia, fuera del pool, para usos de larga duración (ej: LISTEN en un hilo).
+    Quien la pide es responsable de cerrarla.
+    """
+    conn = psycopg2.connect(**_parametros_conexion())
+    conn.autocommit = autocommit
+    return conn
+
+def _conexion_viva(conn: connection) -> bool:
+    """Valida la conexión al sacarla del pool; solo hace ping si estuvo ociosa un buen rato."""
+    if conn.closed:
+        return False
+    ultimo_uso = _ultimo_uso.get(id(conn))
+    if ultimo_uso is None or time.monotonic() - ultimo_uso < DB_VALIDAR_INACTIVA_SEGUNDOS:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1;")
+        conn.rollback()
+        return True
+    except Exception as e:
+        logging.warning(f"Conexión inválida descartada del pool: {e}")
+        return False
+
+def _descartar(conn: connection) -> None:
+    """Cierra la conexión y la saca del pool para que no se vuelva a entregar."""
+    incrementar("db.pool.conexiones_descartadas")
+    _ultimo_uso.pop(id(conn), None)
+    try:
+        if _pool is not None:
+            _pool.putconn(conn, close=True)
+        elif not conn.closed:
+            conn.close()
+    except Exception as e:
+        logging.error(f"Error al descartar conexión: {e}")
+
+def revisar_fugas() -> int:
+    """Reporta las conexiones retenidas más de DB_FUGA_SEGUNDOS junto con la pila de quien las pidió."""
+    global _ultima_revision_fugas
+    ahora = time.monotonic()
+    _ultima_revision_fugas = ahora
+    with _prestadas_lock:
+        fugas = [(ahora - inicio, pila) for inicio, pila in _prestadas.values() if ahora - inicio > DB_FUGA_SEGUNDOS]
+    for retenida, pila in fugas:
+        logging.warning(f"Conexión retenida {retenida:.1f}s (posible fuga). Solicitada en:\n{pila}")
+    fijar("db.pool.fugas_activas", len(fugas))
+    return len(fugas)
 
 def connect_database() -> connection:
     """
-    Devuelve una conexión a la base de datos usando un pool global ThreadedConnectionPool.
-    Si el pool no está inicializado, lo crea con parámetros de entorno.
+    Devuelve una conexión validada del pool global ThreadedConnectionPool.
+    Si el pool no está inicializado, lo crea con parámetros de entorno (DB_POOL_MIN/DB_POOL_MAX).
+    Si no hay conexiones libres espera hasta DB_POOL_TIMEOUT_SEGUNDOS; las conexiones muertas se descartan.
+    Toda conexión obtenida aquí se devuelve con release_connection().
     """
-    global _pool
+    global _pool, _cupos
     try:
-        dbname: str = os.getenv("DB_NAME", "")
-        user: str = os.getenv("DB_USER", "")
-        password: str = os.getenv("DB_PASSWORD", "")
-        host: str = os.getenv("DB_HOST", "")
-        port: str = os.getenv("DB_PORT", "5432")
-        minconn = 1
-        maxconn = 20
-        if not all([dbname, user, password, host]):
-            raise ValueError("Faltan variables de entorno para la conexión a la base de datos.")
-        if _pool is None:
-            _pool = ThreadedConnectionPool(
-                minconn,
-                maxconn,
-                dbname=dbname,
-                user=user,
-                password=password,
-                host=host,
-                port=port,
-                sslmode='require',
-                application_name="whatsapp_bot"
-            )
-        conn: connection = _pool.getconn()
-        if conn is None:
-            raise Exception("No se pudo obtener conexión del pool.")
+        with _pool_lock:
+            if _pool is None:
+                _pool = _crear_pool()
+                _cupos = threading.BoundedSemaphore(DB_POOL_MAX)
+        if time.monotonic() - _ultima_revision_fugas > DB_FUGA_SEGUNDOS:
+            revisar_fugas()
+        inicio = time.monotonic()
+        if not _cupos.acquire(timeout=DB_POOL_TIMEOUT_SEGUNDOS):
+            incrementar("db.pool.timeouts")
+            raise PoolError(f"Sin conexiones libres tras {DB_POOL_TIMEOUT_SEGUNDOS}s (DB_POOL_MAX={DB_POOL_MAX}).")
+        observar("db.pool.espera_checkout_ms", (time.monotonic() - inicio) * 1000)
+        try:
+            conn: connection = _pool.getconn()
+            while not _conexion_viva(conn):
+                _descartar(conn)
+                conn = _pool.getconn()
+        except Exception:
+            _cupos.release()
+            raise
+        with _prestadas_lock:
+            _prestadas[id(conn)] = (time.monotonic(), "".join(traceback.format_stack(limit=8)[:-1]))
+            fijar("db.pool.en_uso", len(_prestadas))
         return conn
     except Exception as e:
         logging.error(f"Error al conectar a la base de datos (pool): {e}")
         raise
 
-def execute_query(query: str, params: tuple = (), fetchone: bool = False):
-    attempts = 3
-    last_exc = None
-    if params is None:
-        params = ()
-    global _pool
+def release_connection(conn: connection, descartar: bool = False) -> None:
+    """Devuelve al pool una conexión obtenida con connect_database(); si está rota o descartar=True la cierra."""
+    if conn is None:
+        return
+    with _prestadas_lock:
+        prestada = _prestadas.pop(id(conn), None)
+        fijar("db.pool.en_uso", len(_prestadas))
     try:
-        for attempt in range(1, attempts + 1):
-            conn: connection = None
-            cur: cursor = None
-            try:
-                conn = connect_database()
-                cur = conn.cursor()
-                cur.execute(query, params)
-                results = None
-                lowered = query.strip().lower()
-                if lowered.startswith("select") or "returning" in lowered or "with" in lowered:
-                    results = cur.fetchone() if fetchone else cur.fetchall()
-                conn.commit()
-                return results
-            except Exception as e:
-                logging.error(f"execute_query attempt {attempt} failed: {e}")
-                last_exc = e
-                # close resources and retry
-                try:
-                    if cur:
-                        cur.close()
-                except Exception:
-                    pass
-                try:
-                    if conn:
-                        if _pool is not None:
-                            _pool.putconn(conn)
-                        else:
-                            conn.close()
-                except Exception:
-                    pass
-                sleep_time = 2 ** attempt
-                logging.info(f"Reintentando en {sleep_time} segundos...")
-                time.sleep(sleep_time)
-                if attempt == attempts:
-                    logging.error("execute_query: agotados los reintentos")
-                    raise last_exc
+        if prestada is not None:
+            retenida = time.monotonic() - prestada[0]
+            observar("db.pool.tiempo_retenida_ms", retenida * 1000)
+            if retenida > DB_FUGA_SEGUNDOS:
+                incrementar("db.pool.fugas")
+                logging.warning(f"Conexión devuelta tras {retenida:.1f}s. Solicitada en:\n{prestada[1]}")
+        if descartar or conn.closed:
+            _descartar(conn)
+        elif _pool is not None:
+            _ultimo_uso[id(conn)] = time.monotonic()
+            _pool.putconn(conn)
+        else:
+            conn.close()
+    except Exception as e:
+        logging.error(f"Error al liberar conexión: {e}")
     finally:
-        try:
-            if cur and not cur.closed:
-                cur.close()
-        except Exception:
-            pass
-        try:
-            if conn and not conn.closed:
-                if _pool is not None:
-                    _pool.putconn(conn)
-                else:
-                    conn.close()
-        except Exception:
-            pass
+        if prestada is not None and _cupos is not None:
+            _cupos.release()
 
-def execute_query_columns(query: str, params: tuple = (), fetchone: bool = False, return_columns: bool = False):
-    global _pool
-    conn = None
-    cur = None
+def _espera_backoff(intento: int, deadline: float) -> Optional[float]:
+    """Backoff exponencial con jitter; None si la espera no cabe en el deadline."""
+    espera = min(DB_BACKOFF_MAX_SEGUNDOS, DB_BACKOFF_BASE_SEGUNDOS * (2 ** (intento - 1)))
+    espera = random.uniform(espera / 2, espera)
+    if time.monotonic() + espera >= deadline:
+        return None
+    return espera
+
+@contextmanager
+def unidad_de_trabajo() -> Iterator[connection]:
+    """
+    Agrupa todas las queries del bloque en una sola conexión y una sola transacción:
+    un commit al final si el bloque termina bien, rollback si lanza excepción.
+    Anidar unidades reutiliza la exterior. Dentro de la unidad no hay reintentos (un error
+    de conexión aborta la unidad completa); no incluir llamadas lentas (LLM, HTTP) en el bloque.
+    """
+    actual = _unidad.get()
+    if actual is not None:
+        yield actual
+        return
+    conn = connect_database()
+    token = _unidad.set(conn)
+    descartar = False
     try:
-        conn = connect_database()
-        cur = conn.cursor()
-        cur.execute(query, params)
-        data = None
-        cols = None
-        if cur.description:  # La query tiene columnas
-            cols = [desc[0] for desc in cur.description]
-        if fetchone:
-            data = cur.fetchone()
+        yield conn
+        if conn.get_transaction_status() == TRANSACTION_STATUS_INERROR:
+            # Alguna query falló y el llamador capturó la excepción: no se confirma nada
+            logging.error("unidad_de_trabajo: transacción abortada por un error previo, se revierte.")
+            conn.rollback()
+            incrementar("db.unidades_revertidas")
         else:
-            data = cur.fetchall()
-        conn.commit()
-        cur.close()
-        if return_columns:
-            return data, cols
-        return data
-    except Exception as e:
-        logging.error(f"Error en execute_query: {e}")
-        raise e
-    finally:
+            conn.commit()
+            incrementar("db.unidades_confirmadas")
+    except ERRORES_TRANSITORIOS:
+        descartar = True
+        incrementar("db.unidades_revertidas")
+        raise
+    except BaseException:
         try:
-            if cur and not cur.closed:
-                cur.close()
+            conn.rollback()
         except Exception:
-            pass
+            descartar = True
+        incrementar("db.unidades_revertidas")
+        raise
+    finally:
+        _unidad.reset(token)
+        release_connection(conn, descartar=descartar)
+
+def _leer_resultados(cur: cursor, query: str, fetchone: bool, con_columnas: bool) -> Tuple[Any, Any]:
+    results = None
+    cols = None
+    if con_columnas:
+        if cur.description:  # La query tiene columnas
+            cols = [desc[0] for desc in cur.description]
+        results = cur.fetchone() if fetchone else cur.fetchall()
+    else:
+        lowered = query.strip().lower()
+        if lowered.startswith("select") or "returning" in lowered or "with" in lowered:
+            results = cur.fetchone() if fetchone else cur.fetchall()
+    return results, cols
+
+def _ejecutar(query: str, params: tuple, fetchone: bool, con_columnas: bool, fuera_de_unidad: bool = False) -> Tuple[Any, Any]:
+    """
+    Ejecuta la query con reintentos para errores transitorios. Retorna (datos, columnas).
+    Si hay una unidad_de_trabajo activa usa su conexión y no confirma (lo hace la unidad),
+    salvo fuera_de_unidad=True (ej: logs, que deben persistir aunque la unidad se revierta).
+    """
+    if params is None:
+        params = ()
+    conteo = _conteo_consultas.get()
+    if conteo is not None:
+        conteo[0] += 1
+    unidad = None if fuera_de_unidad else _unidad.get()
+    if unidad is not None:
+        incrementar("db.consultas_en_unidad")
+        with unidad.cursor() as cur:
+            cur.execute(query, params)
+            return _leer_resultados(cur, query, fetchone, con_columnas)
+    deadline = _deadline_efectivo()
+    last_exc: Optional[Exception] = None
+    for attempt in range(1, DB_REINTENTOS + 1):
+        conn: connection = None
         try:
-            if conn and not conn.closed:
-                if _pool is not None:
-                    _pool.putconn(conn)
-                else:
-                    conn.close()
-        except Exception:
-            pass
\ No newline at end of file
+            conn = connect_database()
+            with conn.cursor() as cur:
+                cur.execute(query, params)
+                results, cols = _leer_resultados(cur, query, fetchone, con_columnas)
+            conn.commit()
+            release_connection(conn)
+            return results, cols
+        except ERRORES_TRANSITORIOS as e:
+            logging.error(f"execute_query attempt {attempt} failed: {e}")
+            last_exc = e
+            if conn is not None:
+                # Una conexión con error de red no vuelve al pool
+                release_connection(conn, descartar=True)
+            espera = _espera_backoff(attempt, deadline)
+            if attempt == DB_REINTENTOS or espera is None:
+                logging.error("execute_query: agotados los reintentos o el deadline")
+                raise
+            incrementar("db.reintentos")
+            logging.info(f"Reintentando en {espera:.2f} segundos...")
+            time.sleep(espera)
+        except Exception as e:
+            logging.error(f"Error en execute_query: {e}")
+            if conn is not None:
+                try:
+                    conn.rollback()
+                    release_connection(conn)
+                except Exception:
+                    release_connection(conn, descartar=True)
+            raise
+    raise last_exc
+
+def execute_query(query: str, params: tuple = (), fetchone: bool = False, fuera_de_unidad: bool = False):
+    results, _ = _ejecutar(query, params, fetchone, con_columnas=False, fuera_de_unidad=fuera_de_unidad)
+    return results
+
+def execute_query_columns(query: str, params: tuple = (), fetchone: bool = False, return_columns: bool = False):
+    data, cols = _ejecutar(query, params, fetchone, con_columnas=True)
+    if return_columns:
+        return data, cols
+    return data
@@ -0,0 +1,137 @@
+# utils_despachador.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Despachador por remitente: los eventos de un mismo teléfono se ejecutan en orden estricto
+# y los de teléfonos distintos en paralelo sobre un pool de hilos.
+
+import contextvars
+import logging
+import os
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterator, Tuple
+from utils_database import conexion_dedicada
+from utils_metricas import fijar, incrementar, observar
+
+DESPACHADOR_HILOS: int = int(os.getenv("DESPACHADOR_HILOS", "8"))
+DESPACHADOR_SHARDS: int = int(os.getenv("DESPACHADOR_SHARDS", "8"))
+# Con varias instancias de la Function App el orden solo se garantiza con un lock en Postgres
+DESPACHADOR_LOCK_POSTGRES: bool = os.getenv("DESPACHADOR_LOCK_POSTGRES", "false").lower() == "true"
+DESPACHADOR_LOCK_TIMEOUT_SEGUNDOS: float = float(os.getenv("DESPACHADOR_LOCK_TIMEOUT_SEGUNDOS", "60"))  # espera máxima por el lock del remitente
+
+_Tarea = Tuple[Callable[..., Any], tuple, dict, Future, float, contextvars.Context]
+
+@contextmanager
+def _bloqueo_postgres(sender: str) -> Iterator[None]:
+    """
+    Advisory lock de sesión por teléfono; serializa el remitente entre instancias.
+    Va en una conexión dedicada (no se le quita una al pool durante todo el turno) y la espera está
+    acotada por lock_timeout: si otra instancia no suelta el remitente, el turno falla y se reintenta.
+    """
+    conn = conexion_dedicada()
+    try:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SET lock_timeout = %s;", (f"{int(DESPACHADOR_LOCK_TIMEOUT_SEGUNDOS * 1000)}ms",))
+                cur.execute("SELECT pg_advisory_lock(hashtext(%s));", (sender,))
+        except Exception as e:
+            incrementar("despachador.lock_vencido")
+            logging.error(f"No se obtuvo el lock del remitente {sender}: {e}")
+            raise
+        # Al cerrar la conexión Postgres suelta el lock aunque falle el unlock
+        yield
+    finally:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_unlock(hashtext(%s));", (sender,))
+        except Exception as e:
+            logging.error(f"Error soltando el lock del remitente {sender}: {e}")
+        finally:
+            conn.close()
+
+class DespachadorRemitentes:
+    """
+    Cola FIFO por remitente sobre un ThreadPoolExecutor.
+    Cada remitente tiene como máximo un hilo drenando su cola, lo que garantiza el orden;
+    las métricas se agrupan por shard (hash del teléfono).
+    """
+
+    def __init__(self, max_hilos: int = DESPACHADOR_HILOS, num_shards: int = DESPACHADOR_SHARDS) -> None:
+        self._pool = ThreadPoolExecutor(max_workers=max_hilos, thread_name_prefix="despachador")
+        self._lock = threading.Lock()
+        self._colas: Dict[str, Deque[_Tarea]] = {}
+        self._num_shards = max(1, num_shards)
+        self._profundidad = [0] * self._num_shards
+
+    def _shard(self, sender: str) -> int:
+        return zlib.crc32(sender.encode("utf-8")) % self._num_shards
+
+    def enviar(self, sender: str, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Future:
+        """Encola fn para el remitente y retorna un Future con su resultado."""
+        futuro: Future = Future()
+        tarea: _Tarea = (fn, args, kwargs, futuro, time.monotonic(), contextvars.copy_context())
+        shard = self._shard(sender)
+        with self._lock:
+            cola = self._colas.get(sender)
+            nuevo = cola is None
+            if nuevo:
+                cola = deque()
+                self._colas[sender] = cola
+            cola.append(tarea)
+            self._profundidad[shard] += 1
+            fijar(f"despachador.shard_{shard}.profundidad", self._profundidad[shard])
+        if nuevo:
+            self._pool.submit(self._drenar, sender, shard)
+        return futuro
+
+    def ejecutar(self, sender: str, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Igual que enviar, pero espera el turno del remitente y retorna el resultado."""
+        return self.enviar(sender, fn, *args, **kwargs).result()
+
+    def _drenar(self, sender: str, shard: int) -> None:
+        while True:
+            with self._lock:
+                cola = self._colas.get(sender)
+                if not cola:
+                    self._colas.pop(sender, None)
+                    return
+                fn, args, kwargs, futuro, encolado, ctx = cola.popleft()
+                self._profundidad[shard] -= 1
+                fijar(f"despachador.shard_{shard}.profundidad", self._profundidad[shard])
+            if not futuro.set_running_or_notify_cancel():
+                continue
+            try:
+                if DESPACHADOR_LOCK_POSTGRES:
+                    with _bloqueo_postgres(sender):
+                        self._registrar_espera(shard, encolado)
+                        resultado = ctx.run(fn, *args, **kwargs)
+                else:
+                    self._registrar_espera(shard, encolado)
+                    resultado = ctx.run(fn, *args, **kwargs)
+                futuro.set_result(resultado)
+            except BaseException as e:
+                logging.error(f"Error en despachador para {sender}: {e}")
+                futuro.set_exception(e)
+
+    def _registrar_espera(self, shard: int, encolado: float) -> None:
+        espera_ms = (time.monotonic() - encolado) * 1000
+        observar("despachador.espera_lock_ms", espera_ms)
+        observar(f"despachador.shard_{shard}.espera_lock_ms", espera_ms)
+
+    def profundidad_shards(self) -> Dict[int, int]:
+        with self._lock:
+            return {i: p for i, p in enumerate(self._profundidad)}
+
+_despachador = None
+_despachador_lock = threading.Lock()
+
+def obtener_despachador() -> DespachadorRemitentes:
+    """Retorna el despachador del proceso (instancia única)."""
+    global _despachador
+    with _despachador_lock:
+        if _despachador is None:
+            _despachador = DespachadorRemitentes()
+        return _despachador
@@ -0,0 +1,175 @@
+# utils_embeddings.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Búsqueda semántica del menú con pgvector: un job offline guarda el embedding de cada item
+# (nombre + descripción) en items.embedding con índice HNSW, y menu_relevante() recorta el menú
+# que va en los prompts a los top-k items más cercanos al mensaje del cliente.
+
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from utils_database import execute_query
+from utils_metricas import incrementar, observar
+from utils_texto import normalizar_texto
+
+EMBEDDINGS_BACKEND: str = os.getenv("EMBEDDINGS_BACKEND", "openai").lower()  # openai | local (determinista, sin red)
+EMBEDDINGS_MODELO: str = os.getenv("EMBEDDINGS_MODELO", "text-embedding-3-small")
+EMBEDDINGS_DIMENSIONES: int = int(os.getenv("EMBEDDINGS_DIMENSIONES", "512"))  # debe coincidir con vector(N) de items
+EMBEDDINGS_LOTE: int = int(os.getenv("EMBEDDINGS_LOTE", "100"))  # textos por llamada en el job de indexación
+EMBEDDINGS_TOP_K: int = int(os.getenv("EMBEDDINGS_TOP_K", "15"))
+EMBEDDINGS_RECORTAR_MENU: bool = os.getenv("EMBEDDINGS_RECORTAR_MENU", "false").lower() == "true"
+EMBEDDINGS_CACHE_CONSULTAS: int = int(os.getenv("EMBEDDINGS_CACHE_CONSULTAS", "1000"))  # frases con embedding en memoria
+
+# Índice HNSW por distancia coseno; idempotente. La dimensión va fija en la columna.
+DDL_EMBEDDINGS: str = f"""
+    CREATE EXTENSION IF NOT EXISTS vector;
+    ALTER TABLE public.items ADD COLUMN IF NOT EXISTS embedding vector({EMBEDDINGS_DIMENSIONES});
+    ALTER TABLE public.items ADD COLUMN IF NOT EXISTS embedding_huella text;
+    CREATE INDEX IF NOT EXISTS idx_items_embedding_hnsw
+        ON public.items USING hnsw (embedding vector_cosine_ops);
+"""
+
+def nombre_modelo() -> str:
+    """Identifica backend, modelo y dimensión; embeddings de modelos distintos no se comparan."""
+    if EMBEDDINGS_BACKEND == "local":
+        return f"local-{EMBEDDINGS_DIMENSIONES}"
+    return f"{EMBEDDINGS_MODELO}-{EMBEDDINGS_DIMENSIONES}"
+
+def texto_item(item: Dict[str, Any]) -> str:
+    """Texto que se embebe por item: nombre, categoría y descripción."""
+    partes = [item.get("nombre") or "", item.get("tipo_comida") or "", item.get("descripcion") or ""]
+    return ". ".join(p.strip() for p in partes if p and str(p).strip())
+
+def embedding_local(texto: str, dimensiones: int = EMBEDDINGS_DIMENSIONES) -> List[float]:
+    """
+    Embedding determinista sin red (hashing de palabras y trigramas con signo, normalizado L2).
+    Solo captura similitud léxica; sirve para pruebas y ambientes sin OpenAI.
+    """
+    normalizado = normalizar_texto(texto)
+    rasgos = normalizado.split()
+    relleno = f" {normalizado} "
+    rasgos += [relleno[i:i + 3] for i in range(len(relleno) - 2)]
+    vector = [0.0] * dimensiones
+    for rasgo in rasgos:
+        digest = hashlib.sha1(rasgo.encode("utf-8")).digest()
+        posicion = int.from_bytes(digest[:4], "big") % dimensiones
+        vector[posicion] += 1.0 if digest[4] % 2 == 0 else -1.0
+    norma = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norma for v in vector]
+
+def generar_embeddings(textos: List[str]) -> List[List[float]]:
+    """Embeddings de textos con el backend configurado, en el mismo orden."""
+    if not textos:
+        return []
+    if EMBEDDINGS_BACKEND == "local":
+        return [embedding_local(t) for t in textos]
+    from utils_openai import obtener_cliente_openai
+
+    respuesta = obtener_cliente_openai().embeddings.create(
+        model=EMBEDDINGS_MODELO,
+        input=textos,
+        dimensions=EMBEDDINGS_DIMENSIONES
+    )
+    incrementar("embeddings.llamadas_api")
+    return [d.embedding for d in sorted(respuesta.data, key=lambda d: d.index)]
+
+def vector_sql(vector: Iterable[float]) -> str:
+    """Formato de texto de pgvector ('[0.1,0.2,...]'), para usar con %s::vector sin adaptadores."""
+    return "[" + ",".join(f"{v:.6f}" for v in vector) + "]"
+
+def _huella(texto: str) -> str:
+    return hashlib.sha256(f"{nombre_modelo()}\n{texto}".encode("utf-8")).hexdigest()
+
+def indexar_items(forzar: bool = False) -> Dict[str, int]:
+    """
+    Job offline: crea columna e índice si faltan y embebe los items activos cuyo texto (o modelo)
+    cambió desde la última corrida. Retorna cuántos se revisaron y cuántos se actualizaron.
+    """
+    execute_query(DDL_EMBEDDINGS, fuera_de_unidad=True)
+    filas = execute_query("""
+        SELECT iditem, nombre, tipo_comida, descripcion, embedding_huella
+        FROM public.items
+        WHERE estado = true
+    """) or []
+    pendientes: List[Tuple[Any, str, str]] = []
+    for iditem, nombre, tipo_comida, descripcion, huella_actual in filas:
+        texto = texto_item({"nombre": nombre, "tipo_comida": tipo_comida, "descripcion": descripcion})
+        huella = _huella(texto)
+        if forzar or huella != huella_actual:
+            pendientes.append((iditem, texto, huella))
+    actualizados = 0
+    for inicio in range(0, len(pendientes), EMBEDDINGS_LOTE):
+        lote = pendientes[inicio:inicio + EMBEDDINGS_LOTE]
+        vectores = generar_embeddings([texto for _, texto, _ in lote])
+        for (iditem, _, huella), vector in zip(lote, vectores):
+            execute_query("""
+                UPDATE public.items SET embedding = %s::vector, embedding_huella = %s WHERE iditem = %s
+            """, (vector_sql(vector), huella, iditem), fuera_de_unidad=True)
+            actualizados += 1
+    incrementar("embeddings.items_indexados", actualizados)
+    return {"revisados": len(filas), "actualizados": actualizados}
+
+_consultas: "OrderedDict[str, List[float]]" = OrderedDict()
+_consultas_lock = threading.Lock()
+
+def embedding_consulta(texto: str) -> List[float]:
+    """Embedding de una frase del cliente, con caché LRU en memoria (frases cortas se repiten mucho)."""
+    clave = f"{nombre_modelo()}\n{normalizar_texto(texto)}"
+    with _consultas_lock:
+        vector = _consultas.get(clave)
+        if vector is not None:
+            _consultas.move_to_end(clave)
+            incrementar("embeddings.cache_aciertos")
+            return vector
+    vector = generar_embeddings([texto])[0]
+    with _consultas_lock:
+        _consultas[clave] = vector
+        while len(_consultas) > EMBEDDINGS_CACHE_CONSULTAS:
+            _consultas.popitem(last=False)
+    return vector
+
+def buscar_items_similares(texto: str, ids_items: Optional[List[Any]] = None, k: int = EMBEDDINGS_TOP_K) -> List[Tuple[Any, float]]:
+    """
+    Top-k (iditem, similitud coseno) más cercanos a texto. El ORDER BY por distancia (<=>) es lo que
+    usa el índice HNSW. ids_items limita la búsqueda a un menú (ej: los items disponibles de la sede).
+    """
+    vector = vector_sql(embedding_consulta(texto))
+    filtro = "AND iditem = ANY(%s)" if ids_items is not None else ""
+    parametros: Tuple[Any, ...] = (vector, list(ids_items), vector) if ids_items is not None else (vector, vector)
+    inicio = time.perf_counter()
+    filas = execute_query(f"""
+        SELECT iditem, 1 - (embedding <=> %s::vector) AS similitud
+        FROM public.items
+        WHERE embedding IS NOT NULL
+            {filtro}
+        ORDER BY embedding <=> %s::vector
+        LIMIT {int(k)};
+    """, parametros) or []
+    observar("embeddings.busqueda_ms", (time.perf_counter() - inicio) * 1000)
+    incrementar("embeddings.consultas")
+    return [(fila[0], float(fila[1])) for fila in filas]
+
+def menu_relevante(texto: str, items: List[Dict[str, Any]], incluir_ids: Iterable[Any] = (), k: int = EMBEDDINGS_TOP_K) -> Optional[List[Dict[str, Any]]]:
+    """
+    Porción del menú (items de obtener_menu, en su orden) relevante para texto: los top-k por
+    embedding más los incluir_ids (ej: productos del pedido en curso). None = usar el menú completo:
+    recorte desactivado, menú pequeño, texto vacío o error en la búsqueda.
+    """
+    if not EMBEDDINGS_RECORTAR_MENU or not texto or not items or len(items) <= k:
+        return None
+    try:
+        ids = [item.get("iditem") for item in items]
+        cercanos = {iditem for iditem, _ in buscar_items_similares(texto, ids, k)}
+    except Exception as e:
+        incrementar("embeddings.errores")
+        logging.error(f"Error en búsqueda semántica del menú, se usa el menú completo: {e}")
+        return None
+    if not cercanos:
+        return None
+    cercanos |= set(incluir_ids)
+    incrementar("embeddings.menus_recortados")
+    return [item for item in items if item.get("iditem") in cercanos]
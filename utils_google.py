@@ -6,6 +6,7 @@ from googlemaps.exceptions import ApiError
 from utils import borrar_intencion_futura, guardar_intencion_futura, log_message, obtener_intencion_futura_observaciones, obtener_pedido_pendiente_reciente, send_text_response
 from utils_chatgpt import solicitar_confirmacion_direccion
 from utils_database import execute_query
+from utils_contexto import actualizar_perfil_cliente
 import os
 
 ID_RESTAURANTE: str = os.getenv("ID_RESTAURANTE", "5")
@@ -243,6 +244,7 @@ def set_sede_cliente(id_sede: str, numero_cliente, id_restaurante: str) -> bool:
             SET id_sede = %s
             WHERE telefono = %s AND id_restaurante = %s;
         """, (id_sede, numero_cliente, id_restaurante))
+        actualizar_perfil_cliente(numero_cliente, {"id_sede": id_sede})
         log_message("Sede asignada correctamente.", "INFO")
         return True
     except Exception as e:
@@ -258,6 +260,7 @@ def set_lat_lon(numero_cliente: str, latitud_client: float, longitud_client: flo
             SET latitud = %s, longitud = %s
             WHERE telefono = %s AND id_restaurante = %s;
         """, (latitud_client, longitud_client, numero_cliente, id_restaurante))
+        actualizar_perfil_cliente(numero_cliente, {"latitud": latitud_client, "longitud": longitud_client})
         log_message("Sede asignada correctamente.", "INFO")
         return True
     except Exception as e:
@@ -279,6 +282,7 @@ def set_direccion_cliente(numero_cliente: str, direccion: str, id_restaurante: s
         log_message(f"Executing SQL query: {query}", "DEBUG")
         log_message(f"SQL params: {params}", "DEBUG")
         execute_query(query, params)
+        actualizar_perfil_cliente(numero_cliente, {"direccion_google": direccion})
 
         log_message(f"Dirección actualizada a '{direccion}' para el cliente {numero_cliente}.", "INFO")
         return True
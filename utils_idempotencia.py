@@ -0,0 +1,208 @@
+# utils_idempotencia.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Control de mensajes duplicados de WhatsApp: un solo INSERT ... ON CONFLICT DO NOTHING RETURNING
+# decide atómicamente si el mensaje es nuevo, con un LRU en memoria para los reenvíos calientes.
+# La tabla está particionada por día y un timer borra las particiones vencidas.
+
+import logging
+import os
+import threading
+from collections import OrderedDict
+from datetime import date, datetime, timedelta, timezone
+from typing import Any
+from utils_database import execute_query
+from utils_metricas import incrementar
+
+IDEMPOTENCIA_RETENCION_DIAS: int = int(os.getenv("IDEMPOTENCIA_RETENCION_DIAS", "8"))  # Meta reintenta hasta 7 días
+IDEMPOTENCIA_DIAS_ADELANTE: int = int(os.getenv("IDEMPOTENCIA_DIAS_ADELANTE", "3"))  # particiones creadas por anticipado
+IDEMPOTENCIA_CACHE_MENSAJES: int = int(os.getenv("IDEMPOTENCIA_CACHE_MENSAJES", "5000"))  # ids ya vistos en memoria
+
+# La llave incluye el día del timestamp de WhatsApp (igual en cada reenvío), así la unicidad
+# por partición equivale a unicidad del mensaje. Migración idempotente que corre el timer de
+# mantenimiento (nunca el webhook): un lock de sesión la serializa entre instancias. Una tabla
+# id_whatsapp_messages sin particionar de versiones anteriores se renombra a
+# id_whatsapp_messages_legacy y sus ids de la ventana de retención se copian a las particiones,
+# para que los reenvíos de Meta justo después del despliegue sigan detectándose. Como esa tabla no
+# guarda el día del timestamp de WhatsApp, cada id se registra en todos los días de la ventana
+# (desaparecen con sus particiones). Con params, los % literales van como %%.
+DDL_IDEMPOTENCIA: str = """
+    SELECT pg_advisory_xact_lock(hashtext('id_whatsapp_messages'));
+
+    CREATE OR REPLACE FUNCTION mantener_id_whatsapp_messages(retencion_dias INT, dias_adelante INT)
+    RETURNS INT LANGUAGE plpgsql AS $$
+    DECLARE
+        hoy DATE := (NOW() AT TIME ZONE 'UTC')::date;
+        dia DATE;
+        particion RECORD;
+        borradas INT := 0;
+    BEGIN
+        PERFORM pg_advisory_xact_lock(hashtext('id_whatsapp_messages'));
+        FOR dia IN SELECT generate_series(hoy - retencion_dias, hoy + dias_adelante, INTERVAL '1 day')::date LOOP
+            EXECUTE 'CREATE TABLE IF NOT EXISTS ' || quote_ident('id_whatsapp_messages_p' || to_char(dia, 'YYYYMMDD'))
+                || ' PARTITION OF id_whatsapp_messages FOR VALUES FROM (' || quote_literal(dia)
+                || ') TO (' || quote_literal(dia + 1) || ')';
+        END LOOP;
+        FOR particion IN
+            SELECT c.relname
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'id_whatsapp_messages'::regclass
+              AND c.relname ~ '^id_whatsapp_messages_p[0-9]{8}$'
+              AND to_date(right(c.relname, 8), 'YYYYMMDD') < hoy - retencion_dias
+        LOOP
+            EXECUTE 'DROP TABLE ' || quote_ident(particion.relname);
+            borradas := borradas + 1;
+        END LOOP;
+        RETURN borradas;
+    END $$;
+
+    DO $$
+    DECLARE
+        retencion_dias INT := %s;
+        dias_adelante INT := %s;
+        hoy DATE := (NOW() AT TIME ZONE 'UTC')::date;
+        migrar BOOLEAN := EXISTS (
+            SELECT 1 FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE c.relname = 'id_whatsapp_messages' AND c.relkind = 'r' AND n.nspname = current_schema()
+        );
+        columna_fecha TEXT;
+        filtro TEXT := '';
+    BEGIN
+        IF migrar THEN
+            ALTER TABLE id_whatsapp_messages RENAME TO id_whatsapp_messages_legacy;
+        END IF;
+        CREATE TABLE IF NOT EXISTS id_whatsapp_messages (
+            id_messages VARCHAR(128) NOT NULL,
+            dia DATE NOT NULL,
+            fecha_registro TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            CONSTRAINT pk_id_whatsapp_messages_dia PRIMARY KEY (dia, id_messages)
+        ) PARTITION BY RANGE (dia);
+        PERFORM mantener_id_whatsapp_messages(retencion_dias, dias_adelante);
+        IF migrar THEN
+            -- Si la tabla anterior tiene una columna de fecha, solo se copian los ids recientes
+            SELECT column_name INTO columna_fecha
+            FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = 'id_whatsapp_messages_legacy'
+              AND data_type IN ('date', 'timestamp without time zone', 'timestamp with time zone')
+            ORDER BY ordinal_position
+            LIMIT 1;
+            IF columna_fecha IS NOT NULL THEN
+                filtro := format(' WHERE l.%%I >= NOW() - make_interval(days => %%s)', columna_fecha, retencion_dias + 1);
+            END IF;
+            EXECUTE 'INSERT INTO id_whatsapp_messages (id_messages, dia)
+                SELECT DISTINCT l.id_messages, d.dia::date
+                FROM id_whatsapp_messages_legacy l
+                CROSS JOIN generate_series($1::date - $2, $1::date, INTERVAL ''1 day'') AS d(dia)' || filtro || '
+                ON CONFLICT DO NOTHING'
+            USING hoy, retencion_dias;
+        END IF;
+    END $$;
+"""
+
+def mantener_particiones_mensajes() -> int:
+    """
+    Crea las particiones diarias de la ventana de retención y las de los próximos días, y borra
+    las vencidas (DROP de la partición, sin DELETE fila a fila). Retorna las particiones borradas.
+    """
+    fila = execute_query(
+        "SELECT mantener_id_whatsapp_messages(%s, %s);",
+        (IDEMPOTENCIA_RETENCION_DIAS, IDEMPOTENCIA_DIAS_ADELANTE),
+        fetchone=True,
+        fuera_de_unidad=True
+    )
+    borradas = int(fila[0]) if fila else 0
+    if borradas:
+        incrementar("idempotencia.particiones_borradas", borradas)
+        logging.info(f"Idempotencia: {borradas} particiones vencidas borradas.")
+    return borradas
+
+def migrar_tabla_mensajes() -> None:
+    """
+    Crea id_whatsapp_messages particionada (migrando la tabla anterior si existe), la función de
+    mantenimiento y las particiones de la ventana. Idempotente; lo corre mantenimiento_idempotencia
+    al arrancar el host, fuera del camino del webhook.
+    """
+    execute_query(DDL_IDEMPOTENCIA, (IDEMPOTENCIA_RETENCION_DIAS, IDEMPOTENCIA_DIAS_ADELANTE), fuera_de_unidad=True)
+
+_vistos: "OrderedDict[str, None]" = OrderedDict()
+_vistos_lock = threading.Lock()
+
+def _recordar(message_id: str) -> None:
+    with _vistos_lock:
+        _vistos[message_id] = None
+        _vistos.move_to_end(message_id)
+        while len(_vistos) > IDEMPOTENCIA_CACHE_MENSAJES:
+            _vistos.popitem(last=False)
+
+def _olvidar(message_id: str) -> None:
+    with _vistos_lock:
+        _vistos.pop(message_id, None)
+
+def _visto(message_id: str) -> bool:
+    with _vistos_lock:
+        if message_id in _vistos:
+            _vistos.move_to_end(message_id)
+            return True
+        return False
+
+def dia_mensaje(timestamp: Any = None) -> date:
+    """Día UTC del timestamp de WhatsApp (segundos epoch); sin timestamp, el día actual."""
+    try:
+        return datetime.fromtimestamp(int(timestamp), timezone.utc).date()
+    except (TypeError, ValueError, OverflowError, OSError):
+        return datetime.now(timezone.utc).date()
+
+def _dia_registro(timestamp: Any) -> date:
+    # Un timestamp en el futuro (reloj del teléfono) se registra en el día actual
+    return min(dia_mensaje(timestamp), datetime.now(timezone.utc).date())
+
+def registrar_mensaje(message_id: str, timestamp: Any = None) -> bool:
+    """
+    Registra el mensaje y retorna True si es la primera vez que se ve (hay que procesarlo).
+    Dos entregas concurrentes del mismo id: solo una obtiene la fila del RETURNING. El registro se
+    confirma fuera de la unidad de trabajo del turno para que las demás entregas lo vean de inmediato.
+    """
+    if _visto(message_id):
+        incrementar("idempotencia.aciertos_memoria")
+        return False
+    hoy = datetime.now(timezone.utc).date()
+    dia = _dia_registro(timestamp)
+    if dia < hoy - timedelta(days=IDEMPOTENCIA_RETENCION_DIAS):
+        # Fuera de la ventana no hay registro con qué comparar: un mensaje así de viejo no se atiende
+        incrementar("idempotencia.vencidos")
+        return False
+    query = """
+        INSERT INTO id_whatsapp_messages (id_messages, dia) VALUES (%s, %s)
+        ON CONFLICT DO NOTHING
+        RETURNING 1;
+    """
+    try:
+        fila = execute_query(query, (message_id, dia), fetchone=True, fuera_de_unidad=True)
+    except Exception as e:
+        # Lo usual es que falte la partición del día (el timer no ha corrido): se crea y se reintenta
+        logging.error(f"Idempotencia: error registrando {message_id}, se revisan particiones: {e}")
+        mantener_particiones_mensajes()
+        fila = execute_query(query, (message_id, dia), fetchone=True, fuera_de_unidad=True)
+    _recordar(message_id)
+    if fila is None:
+        incrementar("idempotencia.duplicados")
+        return False
+    incrementar("idempotencia.nuevos")
+    return True
+
+def liberar_mensaje(message_id: str, timestamp: Any = None) -> None:
+    """
+    Borra el registro de un mensaje cuyo turno falló, para que el reintento (la cola lo devuelve a
+    'pendiente' o Meta reenvía el evento) no se descarte como duplicado. Mientras el turno corre el
+    registro sigue en pie, así las entregas concurrentes del mismo id se descartan igual.
+    """
+    _olvidar(message_id)
+    try:
+        execute_query(
+            "DELETE FROM id_whatsapp_messages WHERE dia = %s AND id_messages = %s;",
+            (_dia_registro(timestamp), message_id),
+            fuera_de_unidad=True
+        )
+        incrementar("idempotencia.liberados")
+    except Exception as e:
+        logging.error(f"Idempotencia: error liberando {message_id}: {e}")
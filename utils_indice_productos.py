@@ -0,0 +1,295 @@
+# utils_indice_productos.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Índice local de productos por versión del menú: tokens normalizados, tabla de alias y trigramas
+# para recuperar candidatos. Resuelve localmente los productos claros de un pedido y deja al LLM
+# solo los fragmentos dudosos, con una lista corta de candidatos.
+
+import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, List, Optional, Set, Tuple
+from utils_menu import version_menu
+from utils_metricas import incrementar
+from utils_texto import distancia_edicion, normalizar_texto, tolerancia_edicion
+
+INDICE_MAX_VERSIONES: int = int(os.getenv("INDICE_MAX_VERSIONES", "16"))  # índices (versión de menú) en memoria
+INDICE_UMBRAL: float = float(os.getenv("INDICE_UMBRAL", "0.8"))  # puntaje mínimo para resolver sin LLM
+INDICE_MARGEN: float = float(os.getenv("INDICE_MARGEN", "0.1"))  # ventaja mínima sobre el segundo candidato
+INDICE_ALIAS_RUTA: str = os.getenv("INDICE_ALIAS_RUTA", "")  # JSON opcional {alias: {"contiene": ..., "precio": ...}}
+
+# Alias coloquiales -> producto del menú. "contiene" se busca en el nombre normalizado y "precio"
+# (opcional) desempata productos con el mismo nombre (ej: platanitos acompañamiento vs adición).
+ALIAS_PRODUCTOS: Dict[str, Dict[str, Any]] = {
+    "platanitos": {"contiene": "platanitos maduros", "precio": 7900},
+    "platanos": {"contiene": "platanitos maduros", "precio": 7900},
+    "platanitos maduros": {"contiene": "platanitos maduros", "precio": 7900},
+    "platanos maduros": {"contiene": "platanitos maduros", "precio": 7900},
+    "coca": {"contiene": "coca-cola"},
+    "cocacola": {"contiene": "coca-cola"},
+    "coca cola": {"contiene": "coca-cola"},
+    "papas": {"contiene": "papas a la francesa"},
+    "papas fritas": {"contiene": "papas a la francesa"},
+    "francesa": {"contiene": "papas a la francesa"},
+}
+
+# Palabras que no aportan a la identidad del producto
+PALABRAS_VACIAS = {
+    "quiero", "quisiera", "dame", "deme", "regalame", "regalas", "regala", "me", "nos", "porfa", "porfavor",
+    "por", "favor", "un", "una", "uno", "unos", "unas", "el", "la", "los", "las", "de", "del", "a", "y", "e",
+    "pedir", "pido", "hamburguesa", "hamburguesas", "bebida", "porcion"
+}
+
+NUMEROS = {
+    "un": 1, "una": 1, "uno": 1, "dos": 2, "tres": 3, "cuatro": 4, "cinco": 5,
+    "seis": 6, "siete": 7, "ocho": 8, "nueve": 9, "diez": 10
+}
+
+# Con estas palabras el mensaje modifica o depende del pedido actual: no se resuelve solo localmente
+PALABRAS_MODIFICADORAS = {
+    "sin", "extra", "adicional", "aparte", "pero", "mejor", "cambia", "cambiar", "cambiame", "quita",
+    "quitar", "quitale", "reemplaza", "vez", "solo", "ya", "tambien", "ademas", "otro", "otra", "mas"
+}
+
+_SEPARADORES = re.compile(r"[,;\n+]+")
+_Y_ANTES_DE_CANTIDAD = re.compile(r"\s+y\s+(?=(?:\d+|" + "|".join(NUMEROS) + r")\b)")
+
+def _singular(palabra: str) -> str:
+    if len(palabra) > 4 and palabra.endswith("ces"):
+        return palabra[:-3] + "z"
+    if len(palabra) > 5 and palabra.endswith("ones"):
+        return palabra[:-2]
+    if len(palabra) > 3 and palabra.endswith("s"):
+        return palabra[:-1]
+    return palabra
+
+def tokens_producto(texto: str) -> List[str]:
+    """Tokens normalizados y en singular, sin palabras vacías ("Platanitos maduros" -> platanito, maduro)."""
+    palabras = normalizar_texto(texto).replace("-", " ").split()
+    return [_singular(p) for p in palabras if p not in PALABRAS_VACIAS]
+
+def _trigramas(tokens: List[str]) -> Set[str]:
+    texto = "  " + " ".join(tokens) + " "
+    return {texto[i:i + 3] for i in range(len(texto) - 2)}
+
+def _coincide_token(token: str, objetivos: Set[str]) -> bool:
+    if token in objetivos:
+        return True
+    tolerancia = tolerancia_edicion(token)
+    return tolerancia > 0 and any(distancia_edicion(token, o, tolerancia) <= tolerancia for o in objetivos)
+
+def _cargar_alias() -> Dict[str, Dict[str, Any]]:
+    alias = dict(ALIAS_PRODUCTOS)
+    if INDICE_ALIAS_RUTA:
+        try:
+            with open(INDICE_ALIAS_RUTA, "r", encoding="utf-8") as f:
+                alias.update(json.load(f))
+        except Exception as e:
+            logging.error(f"Error cargando alias de productos desde {INDICE_ALIAS_RUTA}: {e}")
+    return {" ".join(tokens_producto(k)): v for k, v in alias.items()}
+
+class IndiceProductos:
+    """Índice de un menú (lista de obtener_menu). Se construye una vez por versión del menú."""
+
+    def __init__(self, items: List[Dict[str, Any]], alias: Optional[Dict[str, Dict[str, Any]]] = None) -> None:
+        self.productos: List[Dict[str, Any]] = []
+        self._tokens: List[List[str]] = []
+        self._tokens_con_categoria: List[Set[str]] = []
+        self._trigramas: List[Set[str]] = []
+        self._por_trigrama: Dict[str, Set[int]] = defaultdict(set)
+        self._por_nombre: Dict[str, List[int]] = defaultdict(list)
+        for item in items or []:
+            nombre = item.get("nombre") or item.get("name") or item.get("producto") or ""
+            if not nombre:
+                continue
+            posicion = len(self.productos)
+            tokens = tokens_producto(nombre)
+            self.productos.append({
+                "name": nombre,
+                "id": item.get("iditem", item.get("id")),
+                "price": float(item.get("precio") or item.get("price") or 0.0)
+            })
+            self._tokens.append(tokens)
+            # La categoría cuenta como palabra mencionada ("hamburguesa sierra bbq") pero no como nombre
+            self._tokens_con_categoria.append(set(tokens) | set(tokens_producto(item.get("tipo_comida") or "")))
+            trigramas = _trigramas(tokens)
+            self._trigramas.append(trigramas)
+            for t in trigramas:
+                self._por_trigrama[t].add(posicion)
+            self._por_nombre[" ".join(tokens)].append(posicion)
+        self._alias = self._resolver_alias(alias if alias is not None else _cargar_alias())
+
+    def _resolver_alias(self, alias: Dict[str, Dict[str, Any]]) -> Dict[str, int]:
+        resueltos = {}
+        for clave, destino in alias.items():
+            contiene = " ".join(tokens_producto(destino.get("contiene", "")))
+            precio = destino.get("precio")
+            posiciones = [
+                i for i, tokens in enumerate(self._tokens)
+                if contiene and contiene in " ".join(tokens)
+                and (precio is None or abs(self.productos[i]["price"] - float(precio)) < 0.01)
+            ]
+            # Alias que no apunta a un único producto de este menú no se usa
+            if len(posiciones) == 1:
+                resueltos[clave] = posiciones[0]
+        return resueltos
+
+    def _puntaje(self, tokens: List[str], trigramas: Set[str], posicion: int) -> float:
+        trigramas_item = self._trigramas[posicion]
+        dice = 2 * len(trigramas & trigramas_item) / (len(trigramas) + len(trigramas_item))
+        cobertura = sum(_coincide_token(t, self._tokens_con_categoria[posicion]) for t in tokens) / len(tokens)
+        nombre = self._tokens[posicion]
+        cobertura_nombre = sum(_coincide_token(t, set(tokens)) for t in nombre) / len(nombre) if nombre else 0.0
+        return round(0.4 * dice + 0.4 * cobertura + 0.2 * cobertura_nombre, 4)
+
+    def _candidatos(self, tokens: List[str], limite: int) -> List[Tuple[int, float]]:
+        clave = " ".join(tokens)
+        if clave in self._alias:
+            return [(self._alias[clave], 1.0)]
+        exactos = self._por_nombre.get(clave, [])
+        if len(exactos) == 1:
+            return [(exactos[0], 1.0)]
+        trigramas = _trigramas(tokens)
+        posiciones: Set[int] = set()
+        for t in trigramas:
+            posiciones |= self._por_trigrama.get(t, set())
+        puntajes = sorted(
+            ((p, self._puntaje(tokens, trigramas, p)) for p in posiciones),
+            key=lambda par: (-par[1], par[0])
+        )
+        return puntajes[:limite]
+
+    def _cubre(self, tokens: List[str], posicion: int) -> bool:
+        return all(_coincide_token(t, self._tokens_con_categoria[posicion]) for t in tokens)
+
+    def buscar(self, texto: str, limite: int = 5) -> List[Tuple[Dict[str, Any], float]]:
+        """Candidatos (producto, puntaje) ordenados de mayor a menor puntaje."""
+        tokens = tokens_producto(texto)
+        if not tokens:
+            return []
+        return [(self.productos[p], puntaje) for p, puntaje in self._candidatos(tokens, limite)]
+
+    def resolver(self, texto: str) -> Optional[Dict[str, Any]]:
+        """
+        Producto del menú si el texto lo nombra sin ambigüedad; None si hay que preguntarle al LLM.
+        Toda palabra del texto debe corresponder al producto (si no, puede ser un modificador), y el
+        producto debe superar al segundo candidato por INDICE_MARGEN o ser el único que las contiene
+        todas ("limonada" -> Limonada natural, pero "chicharron" es ambiguo entre hamburguesa y combo).
+        """
+        tokens = tokens_producto(texto)
+        if not tokens:
+            return None
+        candidatos = self._candidatos(tokens, limite=2)
+        if not candidatos:
+            return None
+        posicion, puntaje = candidatos[0]
+        if puntaje >= 1.0:
+            return self.productos[posicion]
+        if not self._cubre(tokens, posicion):
+            return None
+        segundo = candidatos[1] if len(candidatos) > 1 else None
+        if segundo is None or not self._cubre(tokens, segundo[0]):
+            return self.productos[posicion]
+        if puntaje >= INDICE_UMBRAL and puntaje - segundo[1] >= INDICE_MARGEN:
+            return self.productos[posicion]
+        return None
+
+def segmentar_pedido(texto: str) -> List[Tuple[int, str]]:
+    """
+    Parte un mensaje de pedido en (cantidad, fragmento): "2 sierra bbq, una coca y papas" ->
+    [(2, "sierra bbq"), (1, "coca"), (1, "papas")]. Solo toma como cantidad un número al inicio.
+    """
+    fragmentos = []
+    # Se separa antes de normalizar, porque la normalización quita comas y saltos de línea
+    for parte in _SEPARADORES.split(texto or ""):
+        for sub in _Y_ANTES_DE_CANTIDAD.split(normalizar_texto(parte)):
+            palabras = [p for p in sub.split() if p == "y" or p not in PALABRAS_VACIAS - set(NUMEROS)]
+            if not palabras:
+                continue
+            cantidad = 1
+            if palabras[0].isdigit() and 0 < int(palabras[0]) <= 20:
+                cantidad = int(palabras.pop(0))
+            elif palabras[0] in NUMEROS:
+                cantidad = NUMEROS[palabras.pop(0)]
+            if palabras:
+                fragmentos.append((cantidad, " ".join(palabras)))
+    return fragmentos
+
+def resolver_pedido_local(texto: str, indice: IndiceProductos) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    (resueltos, pendientes) del mensaje. resueltos: items con el formato de mapear_pedido_al_menu.
+    pendientes: {"fragmento", "cantidad", "candidatos"} con los mejores candidatos del índice.
+    """
+    resueltos: List[Dict[str, Any]] = []
+    pendientes: List[Dict[str, Any]] = []
+    for cantidad, fragmento in segmentar_pedido(texto):
+        producto = indice.resolver(fragmento)
+        partes = [(cantidad, fragmento)]
+        if producto is None and " y " in f" {fragmento} ":
+            # "papas y coca": se parte solo si ambas mitades se resuelven (hay nombres con "y")
+            mitades = [m.strip() for m in fragmento.split(" y ") if m.strip()]
+            if len(mitades) > 1 and all(indice.resolver(m) for m in mitades):
+                partes = [(cantidad if i == 0 else 1, m) for i, m in enumerate(mitades)]
+        for cantidad_parte, texto_parte in partes:
+            producto = indice.resolver(texto_parte)
+            if producto is None:
+                incrementar("indice_productos.delegados")
+                pendientes.append({
+                    "fragmento": texto_parte,
+                    "cantidad": cantidad_parte,
+                    "candidatos": [dict(p, score=s) for p, s in indice.buscar(texto_parte, limite=5)]
+                })
+                continue
+            incrementar("indice_productos.resueltos")
+            resueltos.append({
+                "requested": {"producto": texto_parte, "especificaciones": []},
+                "status": "found",
+                "matched": dict(producto),
+                "candidates": [],
+                "modifiers_applied": [],
+                "cantidad": cantidad_parte,
+                "note": ""
+            })
+    return resueltos, pendientes
+
+def resolver_turno_local(texto: str, indice: IndiceProductos) -> Optional[List[Dict[str, Any]]]:
+    """
+    Items del turno completo (todos los mensajes fusionados) solo si cada parte del texto se resuelve
+    sin ambigüedad y sin sobrantes; None si algo queda por fuera ("quiero una hamburguesa" no nombra
+    un producto y no puede perderse en silencio).
+    """
+    items: List[Dict[str, Any]] = []
+    for parte in _SEPARADORES.split(texto or ""):
+        for sub in _Y_ANTES_DE_CANTIDAD.split(normalizar_texto(parte)):
+            if not sub.split():
+                continue
+            resueltos, pendientes = resolver_pedido_local(sub, indice)
+            if pendientes or not resueltos:
+                return None
+            items.extend(resueltos)
+    return items or None
+
+def tiene_modificadores(texto: str) -> bool:
+    """True si el mensaje modifica, reemplaza o depende del pedido en curso ("sin cebolla", "mejor...")."""
+    return bool(PALABRAS_MODIFICADORAS.intersection(normalizar_texto(texto).split()))
+
+_indices: "OrderedDict[str, IndiceProductos]" = OrderedDict()
+_indices_lock = threading.Lock()
+
+def obtener_indice(items: List[Dict[str, Any]]) -> IndiceProductos:
+    """Índice del menú items, construido una sola vez por versión del menú."""
+    version = version_menu(items)
+    with _indices_lock:
+        indice = _indices.get(version)
+        if indice is not None:
+            _indices.move_to_end(version)
+            return indice
+    indice = IndiceProductos(items)
+    incrementar("indice_productos.construcciones")
+    with _indices_lock:
+        _indices[version] = indice
+        while len(_indices) > INDICE_MAX_VERSIONES:
+            _indices.popitem(last=False)
+    return indice
@@ -0,0 +1,231 @@
+# utils_llm.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Puerta única de las llamadas al LLM: presupuesto de tiempo por turno, timeout por llamada, cascada
+# de modelos (uno rápido primero y se escala solo si su salida no sirve) y respuesta enlatada cuando
+# se agota el presupuesto. Publica latencia, tokens y costo estimado por función en utils_metricas.
+
+import contextvars
+import json
+import logging
+import os
+import time
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from utils_database import segundos_restantes
+from utils_metricas import incrementar, observar
+from utils_openai import OPENAI_MAX_REINTENTOS, obtener_cliente_openai
+from utils_salidas import formato_salida, parsear_salida, salida_valida
+
+LLM_PRESUPUESTO_TURNO_SEGUNDOS: float = float(os.getenv("LLM_PRESUPUESTO_TURNO_SEGUNDOS", "60"))  # tiempo total de LLM por turno
+LLM_TIMEOUT_SEGUNDOS: float = float(os.getenv("LLM_TIMEOUT_SEGUNDOS", "25"))  # máximo por llamada
+LLM_TIMEOUT_MINIMO_SEGUNDOS: float = float(os.getenv("LLM_TIMEOUT_MINIMO_SEGUNDOS", "3"))  # con menos presupuesto no se llama
+LLM_ESPERA_MAXIMA_REINTENTO_SEGUNDOS: float = 8.0  # tope del backoff del SDK de OpenAI (0.5 s, 1 s, 2 s, ...)
+LLM_CONFIANZA_MINIMA: float = float(os.getenv("LLM_CONFIANZA_MINIMA", "0.75"))  # intent_confidence bajo esto escala
+
+# función -> modelos que se prueban ANTES del modelo que pide la función (que siempre es el último)
+CASCADAS_POR_DEFECTO: Dict[str, List[str]] = {
+    "mapear_pedido_al_menu": ["gpt-4.1-mini"],
+}
+LLM_CASCADAS: Dict[str, List[str]] = json.loads(os.getenv("LLM_CASCADAS", "") or json.dumps(CASCADAS_POR_DEFECTO))
+
+# USD por millón de tokens (entrada, salida); solo para estimar costo en las métricas
+PRECIOS_POR_MILLON: Dict[str, Tuple[float, float]] = {
+    "gpt-5.1": (1.25, 10.0),
+    "gpt-4.1": (2.0, 8.0),
+    "gpt-4.1-mini": (0.4, 1.6),
+    "gpt-4o": (2.5, 10.0),
+    "gpt-4o-mini": (0.15, 0.6),
+    "gpt-3.5-turbo": (0.5, 1.5),
+}
+PRECIOS_POR_MILLON.update({m: tuple(p) for m, p in json.loads(os.getenv("LLM_PRECIOS", "") or "{}").items()})
+
+RESPUESTA_ENLATADA: str = os.getenv(
+    "LLM_RESPUESTA_ENLATADA",
+    "Dame un momento 🙏 estoy con muchas solicitudes; en un minuto te respondo."
+)
+
+_presupuesto: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("presupuesto_llm", default=None)
+
+class PresupuestoLLMAgotado(Exception):
+    """No queda presupuesto de LLM en el turno y la función no definió respuesta enlatada."""
+
+def iniciar_presupuesto_llm(segundos: float = LLM_PRESUPUESTO_TURNO_SEGUNDOS) -> None:
+    """Fija (desde ahora) el tiempo total que pueden gastar las llamadas al LLM del turno actual."""
+    _presupuesto.set(time.monotonic() + segundos)
+
+def segundos_llm_restantes() -> Optional[float]:
+    """Lo que queda del presupuesto de LLM, acotado por el deadline del turno (None si no hay ninguno)."""
+    limites = [segundos_restantes()]
+    presupuesto = _presupuesto.get()
+    if presupuesto is not None:
+        limites.append(max(0.0, presupuesto - time.monotonic()))
+    limites = [s for s in limites if s is not None]
+    return min(limites) if limites else None
+
+def reparto_presupuesto(restante: Optional[float], timeout: float) -> Tuple[float, Optional[int]]:
+    """
+    (timeout por intento, max_retries del SDK) para una llamada con restante segundos de presupuesto.
+    Se busca el mayor número de intentos (hasta 1 + OPENAI_MAX_REINTENTOS) en que cada uno tenga al
+    menos LLM_TIMEOUT_MINIMO_SEGUNDOS después de descontar las esperas del SDK entre intentos, y el
+    timeout se reparte para que intentos × timeout + esperas no pase de restante.
+    Sin presupuesto (None) se deja el timeout pedido y los reintentos por defecto del cliente.
+    """
+    if restante is None:
+        return timeout, None
+    for intentos in range(1 + max(0, OPENAI_MAX_REINTENTOS), 0, -1):
+        esperas = sum(min(0.5 * 2 ** i, LLM_ESPERA_MAXIMA_REINTENTO_SEGUNDOS) for i in range(intentos - 1))
+        por_intento = (restante - esperas) / intentos
+        if intentos == 1 or por_intento >= LLM_TIMEOUT_MINIMO_SEGUNDOS:
+            return min(timeout, por_intento), intentos - 1
+    return min(timeout, restante), 0
+
+def modelos_cascada(nombre: str, modelo: str) -> List[str]:
+    """Modelos a probar en orden para la función nombre; el modelo pedido por la función va al final."""
+    previos = [m for m in LLM_CASCADAS.get(nombre, []) if m != modelo]
+    return previos + [modelo]
+
+def texto_respuesta(respuesta: Any) -> str:
+    """Texto de una respuesta de chat.completions o de responses."""
+    opciones = getattr(respuesta, "choices", None)
+    if opciones:
+        return opciones[0].message.content or ""
+    texto = getattr(respuesta, "output_text", None)
+    if isinstance(texto, str):
+        return texto
+    return respuesta.output[0].content[0].text
+
+def _campo(objeto: Any, nombre: str) -> Any:
+    if objeto is None:
+        return None
+    if isinstance(objeto, dict):
+        return objeto.get(nombre)
+    return getattr(objeto, nombre, None)
+
+def registrar_uso_llm(nombre: str, modelo: str, respuesta: Any) -> None:
+    """Suma tokens y costo estimado de la respuesta en llm.<nombre>.* y en el total llm.costo_usd."""
+    usage = _campo(respuesta, "usage")
+    if usage is None:
+        return
+    entrada = int(_campo(usage, "prompt_tokens") or _campo(usage, "input_tokens") or 0)
+    salida = int(_campo(usage, "completion_tokens") or _campo(usage, "output_tokens") or 0)
+    precio_entrada, precio_salida = PRECIOS_POR_MILLON.get(modelo, (0.0, 0.0))
+    costo = (entrada * precio_entrada + salida * precio_salida) / 1_000_000
+    incrementar(f"llm.{nombre}.tokens_entrada", entrada)
+    incrementar(f"llm.{nombre}.tokens_salida", salida)
+    incrementar(f"llm.{nombre}.costo_usd", costo)
+    incrementar("llm.costo_usd", costo)
+
+def respuesta_enlatada(texto: str, stream: bool = False) -> Any:
+    """Respuesta local con la forma de chat.completions y de responses (o un stream de un evento)."""
+    if stream:
+        return iter([SimpleNamespace(type="response.output_text.delta", delta=texto)])
+    return SimpleNamespace(
+        output_text=texto,
+        output=[SimpleNamespace(content=[SimpleNamespace(text=texto)])],
+        choices=[SimpleNamespace(message=SimpleNamespace(content=texto))],
+        usage=None
+    )
+
+class _Endpoint:
+    def __init__(self, cliente: "ClienteLLM", ruta: str) -> None:
+        self._cliente = cliente
+        self._ruta = ruta
+
+    def create(self, **kwargs: Any) -> Any:
+        return self._cliente._crear(self._ruta, kwargs)
+
+class ClienteLLM:
+    """
+    Sustituto del cliente OpenAI para una función: client.chat.completions.create(...) y
+    client.responses.create(...) pasan por el presupuesto del turno y la cascada de la función.
+    salida (dataclass de utils_salidas) agrega el schema de salida estructurada según el modelo y la
+    ruta, y parsear(texto) valida la respuesta contra ella. aceptar(texto) decide si la salida de un
+    modelo de la cascada sirve o hay que escalar (por defecto: que tenga la forma de salida sin
+    reparaciones); enlatada es el texto que se retorna si no queda presupuesto o fallan todos.
+    """
+
+    def __init__(self, nombre: str, aceptar: Optional[Callable[[str], bool]] = None,
+                 enlatada: Optional[str] = None, timeout: Optional[float] = None,
+                 salida: Optional[type] = None) -> None:
+        self.nombre = nombre
+        self.salida = salida
+        self.aceptar = aceptar or (self._forma_valida if salida is not None else None)
+        self.enlatada = enlatada
+        self.timeout = timeout or LLM_TIMEOUT_SEGUNDOS
+        self.chat = SimpleNamespace(completions=_Endpoint(self, "chat"))
+        self.responses = _Endpoint(self, "responses")
+
+    def _crear(self, ruta: str, kwargs: Dict[str, Any]) -> Any:
+        stream = bool(kwargs.get("stream"))
+        # Un stream ya empezó a enviarse al cliente: no se puede escalar a otro modelo
+        modelos = [kwargs["model"]] if stream else modelos_cascada(self.nombre, kwargs["model"])
+        ultima: Any = None
+        error: Optional[Exception] = None
+        for i, modelo in enumerate(modelos):
+            restante = segundos_llm_restantes()
+            if restante is not None and restante < LLM_TIMEOUT_MINIMO_SEGUNDOS:
+                incrementar(f"llm.{self.nombre}.presupuesto_agotado")
+                break
+            # Con los reintentos del SDK incluidos, la llamada no pasa de lo que queda del presupuesto
+            timeout, reintentos = reparto_presupuesto(restante, self.timeout)
+            endpoint = obtener_cliente_openai(timeout=timeout, max_reintentos=reintentos)
+            endpoint = endpoint.chat.completions if ruta == "chat" else endpoint.responses
+            incrementar(f"llm.{self.nombre}.llamadas")
+            incrementar(f"llm.{self.nombre}.modelo.{modelo}")
+            inicio = time.perf_counter()
+            argumentos = {**kwargs, "model": modelo}
+            if self.salida is not None:
+                argumentos.update(formato_salida(self.salida, ruta, modelo))
+            try:
+                respuesta = endpoint.create(**argumentos)
+            except Exception as e:
+                incrementar(f"llm.{self.nombre}.errores")
+                logging.error(f"LLM {self.nombre} ({modelo}) falló: {e}")
+                error = e
+                continue
+            finally:
+                observar(f"llm.{self.nombre}_ms", (time.perf_counter() - inicio) * 1000)
+            if stream:
+                return self._medir_stream(modelo, respuesta)
+            registrar_uso_llm(self.nombre, modelo, respuesta)
+            ultima = respuesta
+            if self.aceptar is None or i == len(modelos) - 1:
+                return respuesta
+            try:
+                aceptada = self.aceptar(texto_respuesta(respuesta))
+            except Exception:
+                aceptada = False
+            if aceptada:
+                return respuesta
+            incrementar(f"llm.{self.nombre}.escaladas")
+        if ultima is not None:
+            # Se acabó el presupuesto antes de escalar: mejor la salida dudosa que nada
+            return ultima
+        if self.enlatada is not None:
+            incrementar(f"llm.{self.nombre}.enlatadas")
+            return respuesta_enlatada(self.enlatada, stream=stream)
+        if error is not None:
+            raise error
+        raise PresupuestoLLMAgotado(f"Sin presupuesto de LLM para {self.nombre}")
+
+    def _forma_valida(self, texto: str) -> bool:
+        return salida_valida(texto, self.salida)
+
+    def parsear(self, texto: Optional[str]) -> Any:
+        """Respuesta cruda -> instancia de salida (ver utils_salidas.parsear_salida)."""
+        return parsear_salida(self.nombre, texto, self.salida)
+
+    def _medir_stream(self, modelo: str, stream: Any) -> Iterator[Any]:
+        # El usage llega en el último evento (response.completed o el chunk con usage)
+        for evento in stream:
+            if getattr(evento, "type", None) == "response.completed":
+                registrar_uso_llm(self.nombre, modelo, evento.response)
+            elif getattr(evento, "usage", None) is not None:
+                registrar_uso_llm(self.nombre, modelo, evento)
+            yield evento
+
+def cliente_llm(nombre: str, aceptar: Optional[Callable[[str], bool]] = None,
+                enlatada: Optional[str] = None, timeout: Optional[float] = None,
+                salida: Optional[type] = None) -> ClienteLLM:
+    """Cliente para las llamadas de la función nombre (ver ClienteLLM)."""
+    return ClienteLLM(nombre, aceptar=aceptar, enlatada=enlatada, timeout=timeout, salida=salida)
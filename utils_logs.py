@@ -0,0 +1,210 @@
+# utils_logs.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Sink asíncrono de la tabla logs: log_message encola el registro y un hilo en segundo plano
+# lo inserta por lotes (INSERT multi-fila), fuera del camino del turno.
+# También decide qué se registra: nivel mínimo por módulo, muestreo de INFO y truncado.
+
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+from utils_database import execute_query
+from utils_metricas import fijar, incrementar
+
+LOGS_ASINCRONO: bool = os.getenv("LOGS_ASINCRONO", "true").lower() == "true"  # false = INSERT síncrono como antes
+LOGS_COLA_MAX: int = int(os.getenv("LOGS_COLA_MAX", "10000"))
+LOGS_LOTE: int = int(os.getenv("LOGS_LOTE", "200"))  # registros por INSERT
+LOGS_INTERVALO_MS: int = int(os.getenv("LOGS_INTERVALO_MS", "500"))  # espera máxima antes de escribir un lote incompleto
+LOGS_UMBRAL_PRESION: float = float(os.getenv("LOGS_UMBRAL_PRESION", "0.8"))  # fracción de la cola desde la que se descarta DEBUG
+LOGS_TIMEOUT_ENCOLAR_SEGUNDOS: float = float(os.getenv("LOGS_TIMEOUT_ENCOLAR_SEGUNDOS", "0.05"))
+LOGS_NIVEL_MINIMO: str = os.getenv("LOGS_NIVEL_MINIMO", "INFO")
+LOGS_NIVELES_MODULO: str = os.getenv("LOGS_NIVELES_MODULO", "")  # ej: "utils_chatgpt=WARNING,utils=INFO"
+LOGS_MUESTREO_INFO: float = float(os.getenv("LOGS_MUESTREO_INFO", "1.0"))  # fracción de INFO que se guarda
+LOGS_MAX_CARACTERES: int = int(os.getenv("LOGS_MAX_CARACTERES", "4000"))
+LOGS_MAX_CARACTERES_CAMPO: int = int(os.getenv("LOGS_MAX_CARACTERES_CAMPO", "1000"))
+
+NIVELES: Dict[str, int] = {"DEBUG": 10, "INFO": 20, "WARN": 30, "WARNING": 30, "ERROR": 40, "CRITICAL": 50}
+
+ZONA_LOGS = ZoneInfo("America/Bogota")
+
+# (ambiente, tipo, mensaje, fecha, idusuario, archivoPy, function, lineNumber, telefono)
+RegistroLog = Tuple[str, str, str, datetime, int, str, str, int, Optional[str]]
+
+_FILA_LOG: str = "(%s, %s, %s, %s, %s, %s, %s, %s, %s)"
+_INSERT_LOGS: str = """
+    INSERT INTO logs (ambiente, tipo, mensaje, fecha, idusuario, "archivoPy", function, "lineNumber", telefono)
+    VALUES """
+
+def _leer_niveles_modulo(config: str) -> Dict[str, int]:
+    niveles: Dict[str, int] = {}
+    for parte in config.split(","):
+        if "=" not in parte:
+            continue
+        modulo, nivel = parte.split("=", 1)
+        niveles[modulo.strip().removesuffix(".py")] = NIVELES.get(nivel.strip().upper(), NIVELES["INFO"])
+    return niveles
+
+_nivel_minimo: int = NIVELES.get(LOGS_NIVEL_MINIMO.upper(), NIVELES["INFO"])
+_niveles_modulo: Dict[str, int] = _leer_niveles_modulo(LOGS_NIVELES_MODULO)
+
+def log_habilitado(tipo: str, archivo_py: str = "") -> bool:
+    """
+    Indica si un registro de este tipo, emitido desde archivo_py, debe ir a la tabla logs.
+    Aplica el nivel mínimo del módulo (o el global) y el muestreo de INFO.
+    """
+    nivel = NIVELES.get(tipo.upper(), NIVELES["INFO"])
+    minimo = _niveles_modulo.get(archivo_py.removesuffix(".py"), _nivel_minimo)
+    if nivel < minimo:
+        return False
+    if nivel == NIVELES["INFO"] and LOGS_MUESTREO_INFO < 1.0:
+        if random.random() >= LOGS_MUESTREO_INFO:
+            incrementar("logs.descartados_muestreo")
+            return False
+    return True
+
+def truncar(texto: str, limite: int = LOGS_MAX_CARACTERES) -> str:
+    if len(texto) <= limite:
+        return texto
+    return texto[:limite] + f"... [truncado {len(texto) - limite} caracteres]"
+
+def formatear_campos(campos: Dict[str, Any]) -> str:
+    """
+    Serializa los campos estructurados (solo se llama si el nivel está habilitado).
+    Un valor callable se evalúa aquí, para diferir cálculos costosos.
+    """
+    partes: List[str] = []
+    for nombre, valor in campos.items():
+        try:
+            if callable(valor):
+                valor = valor()
+            texto = valor if isinstance(valor, str) else json.dumps(valor, ensure_ascii=False, default=str)
+        except Exception as e:
+            texto = f"<no serializable: {e}>"
+        partes.append(f"{nombre}={truncar(texto, LOGS_MAX_CARACTERES_CAMPO)}")
+    return " | " + " | ".join(partes)
+
+def _insertar_lote(registros: List[RegistroLog]) -> None:
+    """Un solo INSERT multi-fila para todo el lote."""
+    query = _INSERT_LOGS + ", ".join([_FILA_LOG] * len(registros)) + ";"
+    params = tuple(valor for registro in registros for valor in registro)
+    # Los logs no dependen del commit/rollback de una unidad de trabajo
+    execute_query(query, params, fuera_de_unidad=True)
+
+class SinkLogs:
+    """
+    Cola acotada en memoria + hilo que la vacía cada LOGS_INTERVALO_MS o cada LOGS_LOTE registros.
+    Bajo presión (cola por encima de LOGS_UMBRAL_PRESION) se descartan los DEBUG; si la cola
+    está llena se descarta el registro en lugar de bloquear el turno.
+    """
+
+    def __init__(self, max_registros: int = LOGS_COLA_MAX, lote: int = LOGS_LOTE,
+                 intervalo_ms: int = LOGS_INTERVALO_MS) -> None:
+        self._cola: "queue.Queue[RegistroLog]" = queue.Queue(maxsize=max_registros)
+        self._max = max_registros
+        self._lote = max(1, lote)
+        self._intervalo = intervalo_ms / 1000
+        self._lock_escritura = threading.Lock()
+        self._hilo: Optional[threading.Thread] = None
+        self._lock_hilo = threading.Lock()
+        self._detenido = threading.Event()
+
+    def _asegurar_hilo(self) -> None:
+        if self._hilo is not None and self._hilo.is_alive():
+            return
+        with self._lock_hilo:
+            if self._hilo is None or not self._hilo.is_alive():
+                self._detenido.clear()
+                self._hilo = threading.Thread(target=self._bucle, name="sink_logs", daemon=True)
+                self._hilo.start()
+
+    def encolar(self, registro: RegistroLog) -> None:
+        self._asegurar_hilo()
+        if registro[1] == "DEBUG" and self._cola.qsize() >= self._max * LOGS_UMBRAL_PRESION:
+            incrementar("logs.descartados_debug")
+            return
+        try:
+            self._cola.put(registro, timeout=LOGS_TIMEOUT_ENCOLAR_SEGUNDOS)
+        except queue.Full:
+            incrementar("logs.descartados_cola_llena")
+            return
+        fijar("logs.profundidad_cola", self._cola.qsize())
+
+    def _tomar_lote(self, espera: float) -> List[RegistroLog]:
+        registros: List[RegistroLog] = []
+        limite = time.monotonic() + espera
+        while len(registros) < self._lote:
+            restante = limite - time.monotonic()
+            try:
+                if restante <= 0:
+                    registros.append(self._cola.get_nowait())
+                else:
+                    registros.append(self._cola.get(timeout=restante))
+            except queue.Empty:
+                break
+        return registros
+
+    def _escribir(self, registros: List[RegistroLog]) -> None:
+        if not registros:
+            return
+        try:
+            _insertar_lote(registros)
+            incrementar("logs.escritos", len(registros))
+            incrementar("logs.lotes")
+        except Exception as e:
+            incrementar("logs.perdidos", len(registros))
+            logging.error(f"Error escribiendo lote de {len(registros)} logs: {e}")
+
+    def _bucle(self) -> None:
+        while not self._detenido.is_set():
+            registros = self._tomar_lote(self._intervalo)
+            with self._lock_escritura:
+                self._escribir(registros)
+
+    def vaciar(self) -> None:
+        """Escribe de inmediato todo lo pendiente (cierre de la función, fin de un worker)."""
+        with self._lock_escritura:
+            while True:
+                registros = self._tomar_lote(0)
+                if not registros:
+                    break
+                self._escribir(registros)
+        fijar("logs.profundidad_cola", self._cola.qsize())
+
+    def detener(self) -> None:
+        self._detenido.set()
+        self.vaciar()
+
+_sink: Optional[SinkLogs] = None
+_sink_lock = threading.Lock()
+
+def obtener_sink_logs() -> SinkLogs:
+    """Retorna el sink del proceso (instancia única)."""
+    global _sink
+    with _sink_lock:
+        if _sink is None:
+            _sink = SinkLogs()
+        return _sink
+
+def registrar_log(ambiente: str, tipo: str, mensaje: str, idusuario: int, archivo_py: str,
+                  function_name: str, line_number: int, telefono: Optional[str]) -> None:
+    """Registra una fila de logs; la fecha se toma ahora aunque el INSERT ocurra después."""
+    fecha = datetime.now(ZONA_LOGS).replace(tzinfo=None)
+    registro: RegistroLog = (ambiente, tipo, truncar(mensaje), fecha, idusuario, archivo_py, function_name, line_number, telefono)
+    if LOGS_ASINCRONO:
+        obtener_sink_logs().encolar(registro)
+    else:
+        _insertar_lote([registro])
+
+def vaciar_logs() -> None:
+    """Final flush: escribe los logs pendientes del proceso."""
+    if _sink is not None:
+        _sink.vaciar()
+
+atexit.register(lambda: _sink.detener() if _sink is not None else None)
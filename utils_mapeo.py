@@ -0,0 +1,107 @@
+# utils_mapeo.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Mapeadores locales deterministas para método de pago y sede: tablas de sinónimos, distancia de
+# edición y clave fonética. Solo cuando no hay una coincidencia única se recurre al LLM.
+
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+from utils_database import execute_query
+from utils_metricas import incrementar
+from utils_texto import clave_fonetica, distancia_edicion, normalizar_texto, tolerancia_edicion
+
+MAPEO_TTL_SEDES_SEGUNDOS: int = int(os.getenv("MAPEO_TTL_SEDES_SEGUNDOS", "300"))
+
+SINONIMOS_PAGO: Dict[str, List[str]] = {
+    "efectivo": ["efectivo", "cash", "billete", "billetes"],
+    "datafono": [
+        "datafono", "datafon", "tarjeta", "tc", "td", "credito", "debito",
+        "visa", "mastercard", "master", "amex"
+    ],
+}
+
+# Con estas palabras el mensaje puede negar el método ("no tengo efectivo"): se deja al LLM
+PALABRAS_NEGACION = {"no", "sin", "tampoco", "ni"}
+
+# Palabras de relleno alrededor del nombre de una sede ("en la sede de caobos porfa")
+RELLENO_SEDE = {
+    "en", "la", "el", "de", "del", "sede", "a", "para", "recoger", "quiero", "prefiero",
+    "mejor", "por", "favor", "porfa", "porfavor", "esa", "esta", "ahi", "alla", "me", "queda"
+}
+
+_sedes: List[Dict[str, Any]] = []
+_sedes_cargadas: float = 0.0
+_sedes_lock = threading.Lock()
+
+def obtener_sedes_activas() -> List[Dict[str, Any]]:
+    """Sedes activas (nombre, direccion, id_sede, latitud, longitud); se recargan cada MAPEO_TTL_SEDES_SEGUNDOS."""
+    global _sedes, _sedes_cargadas
+    with _sedes_lock:
+        if not _sedes_cargadas or time.monotonic() - _sedes_cargadas > MAPEO_TTL_SEDES_SEGUNDOS:
+            try:
+                filas = execute_query("""
+                    SELECT nombre, direccion, id_sede, latitud, longitud
+                    FROM sedes
+                    where estado = true
+                """) or []
+                _sedes = [
+                    {"nombre": s[0], "direccion": s[1], "id_sede": s[2], "latitud": s[3], "longitud": s[4]}
+                    for s in filas
+                ]
+                _sedes_cargadas = time.monotonic()
+            except Exception as e:
+                logging.error(f"Error cargando sedes activas: {e}")
+        return list(_sedes)
+
+def _coincide(palabra: str, objetivo: str) -> bool:
+    if palabra == objetivo:
+        return True
+    tolerancia = tolerancia_edicion(objetivo)
+    return tolerancia > 0 and distancia_edicion(palabra, objetivo, tolerancia) <= tolerancia
+
+def mapear_modo_pago_local(texto: str) -> Optional[str]:
+    """
+    "efectivo" | "datafono" si el texto nombra exactamente uno de los dos (con errores de digitación
+    tolerados); None si no nombra ninguno, nombra ambos o contiene una negación.
+    """
+    palabras = normalizar_texto(texto).split()
+    if not palabras or PALABRAS_NEGACION.intersection(palabras):
+        return None
+    encontrados = {
+        metodo
+        for metodo, sinonimos in SINONIMOS_PAGO.items()
+        for palabra in palabras
+        for sinonimo in sinonimos
+        if _coincide(palabra, sinonimo)
+    }
+    if len(encontrados) != 1:
+        incrementar("mapeo_local.pago_fallos")
+        return None
+    incrementar("mapeo_local.pago_aciertos")
+    return encontrados.pop()
+
+def mapear_sede_local(texto: str, sedes: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    Retorna la sede (fila de obtener_sedes_activas) que el texto nombra, comparando el texto sin
+    palabras de relleno contra cada nombre por igualdad, distancia de edición o clave fonética.
+    None si no coincide ninguna o coincide más de una.
+    """
+    palabras = [p for p in normalizar_texto(texto).split() if p not in RELLENO_SEDE]
+    if not palabras:
+        return None
+    candidato = "".join(palabras)
+    fonetica = clave_fonetica(candidato)
+    coincidencias = []
+    for sede in sedes:
+        nombre = "".join(p for p in normalizar_texto(sede["nombre"]).split() if p != "sede")
+        if not nombre:
+            continue
+        if _coincide(candidato, nombre) or fonetica == clave_fonetica(nombre):
+            coincidencias.append(sede)
+    if len(coincidencias) != 1:
+        incrementar("mapeo_local.sede_fallos")
+        return None
+    incrementar("mapeo_local.sede_aciertos")
+    return coincidencias[0]
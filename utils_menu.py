@@ -0,0 +1,264 @@
+# utils_menu.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Compilador del menú para prompts: codificación de texto compacta y estable (id|nombre|precio por
+# categoría) en lugar de json.dumps de la lista completa. Cada prompt elige el nivel de detalle y el
+# resultado se cachea bajo el hash del contenido del menú (cambia solo si cambia el menú de la sede).
+# También mantiene el caché en proceso del menú por sede, invalidado por TTL y por LISTEN/NOTIFY.
+
+import hashlib
+import json
+import logging
+import os
+import select
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from utils_database import conexion_dedicada, execute_query
+from utils_metricas import fijar, incrementar
+
+MENU_MAX_COMPILADOS: int = int(os.getenv("MENU_MAX_COMPILADOS", "64"))  # (versión, nivel) guardados en memoria
+MENU_CACHE_TTL_SEGUNDOS: float = float(os.getenv("MENU_CACHE_TTL_SEGUNDOS", "60"))  # 0 desactiva el caché por sede
+MENU_ESCUCHAR_CAMBIOS: bool = os.getenv("MENU_ESCUCHAR_CAMBIOS", "true").lower() == "true"  # LISTEN menu_cambios
+MENU_CANAL_CAMBIOS: str = "menu_cambios"
+
+# nombres: solo nombres por categoría (clasificadores que solo necesitan saber qué existe)
+# basico: id|nombre|precio por categoría (mensajes al cliente, resúmenes de pedido)
+# completo: además descripción y observaciones (mapeo de pedidos, preguntas sobre ingredientes)
+NIVELES_MENU: Tuple[str, ...] = ("nombres", "basico", "completo")
+
+_ENCABEZADOS: Dict[str, str] = {
+    "nombres": "Productos disponibles por categoría (# categoría):",
+    "basico": "Formato: id|nombre|precio, agrupado por categoría (# categoría):",
+    "completo": "Formato: id|nombre|precio|descripción|observaciones, agrupado por categoría (# categoría):",
+}
+
+_compilados: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+_lock = threading.Lock()
+
+def version_menu(items: List[Dict[str, Any]]) -> str:
+    """Hash corto del contenido del menú; sirve como versión para cachés que dependen del menú."""
+    contenido = json.dumps(items or [], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(contenido.encode("utf-8")).hexdigest()[:16]
+
+def _texto(valor: Any) -> str:
+    # Sin saltos de línea ni separadores dentro de un campo
+    return " ".join(str(valor or "").replace("|", "/").split())
+
+def _precio(valor: Any) -> str:
+    try:
+        precio = float(valor or 0)
+    except (TypeError, ValueError):
+        return _texto(valor)
+    return str(int(precio)) if precio.is_integer() else f"{precio:.2f}"
+
+def _codificar(items: List[Dict[str, Any]], nivel: str) -> str:
+    lineas = [_ENCABEZADOS[nivel]]
+    categoria_actual = None
+    for item in sorted(items, key=lambda i: (_texto(i.get("tipo_comida")), _texto(i.get("nombre")))):
+        categoria = _texto(item.get("tipo_comida")) or "otros"
+        if categoria != categoria_actual:
+            lineas.append(f"# {categoria}")
+            categoria_actual = categoria
+        if nivel == "nombres":
+            lineas.append(_texto(item.get("nombre")))
+            continue
+        campos = [_texto(item.get("iditem", item.get("id"))), _texto(item.get("nombre")), _precio(item.get("precio"))]
+        if nivel == "completo":
+            campos += [_texto(item.get("descripcion")), _texto(item.get("observaciones"))]
+        lineas.append("|".join(campos).rstrip("|"))
+    return "\n".join(lineas)
+
+def compilar_menu(items: List[Dict[str, Any]], nivel: str = "basico") -> str:
+    """
+    Codificación compacta del menú (lista de obtener_menu) para incluir en un prompt.
+    El texto es estable para un mismo contenido, así que no rompe el prefijo cacheado del proveedor.
+    """
+    if nivel not in NIVELES_MENU:
+        raise ValueError(f"Nivel de menú inválido: {nivel}")
+    if not items:
+        return "Menú no disponible."
+    clave = (version_menu(items), nivel)
+    with _lock:
+        texto = _compilados.get(clave)
+        if texto is not None:
+            _compilados.move_to_end(clave)
+            incrementar("menu.compilado_aciertos")
+            return texto
+    texto = _codificar(items, nivel)
+    incrementar("menu.compilaciones")
+    with _lock:
+        _compilados[clave] = texto
+        while len(_compilados) > MENU_MAX_COMPILADOS:
+            _compilados.popitem(last=False)
+    return texto
+
+# Triggers que avisan por NOTIFY cuando cambia la disponibilidad de una sede (payload = id_sede)
+# o el catálogo de items (payload vacío = todas las sedes). Idempotente.
+DDL_NOTIFICAR_MENU: str = """
+    CREATE OR REPLACE FUNCTION notificar_cambio_menu() RETURNS trigger AS $$
+    BEGIN
+        IF TG_TABLE_NAME = 'disponibilidad_items' AND TG_LEVEL = 'ROW' THEN
+            IF TG_OP = 'DELETE' THEN
+                PERFORM pg_notify('menu_cambios', COALESCE(OLD.id_sede::text, ''));
+            ELSE
+                PERFORM pg_notify('menu_cambios', COALESCE(NEW.id_sede::text, ''));
+            END IF;
+        ELSE
+            PERFORM pg_notify('menu_cambios', '');
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS trg_menu_disponibilidad ON public.disponibilidad_items;
+    CREATE TRIGGER trg_menu_disponibilidad
+        AFTER INSERT OR UPDATE OR DELETE ON public.disponibilidad_items
+        FOR EACH ROW EXECUTE FUNCTION notificar_cambio_menu();
+
+    DROP TRIGGER IF EXISTS trg_menu_items ON public.items;
+    CREATE TRIGGER trg_menu_items
+        AFTER INSERT OR UPDATE OR DELETE ON public.items
+        FOR EACH STATEMENT EXECUTE FUNCTION notificar_cambio_menu();
+"""
+
+def instalar_notificaciones_menu() -> bool:
+    """Crea la función y los triggers de DDL_NOTIFICAR_MENU. Se corre una vez por despliegue."""
+    try:
+        execute_query(DDL_NOTIFICAR_MENU, fuera_de_unidad=True)
+        return True
+    except Exception as e:
+        logging.error(f"Error instalando triggers de notificación del menú: {e}")
+        return False
+
+class CacheMenu:
+    """
+    Menú por id_sede en memoria del proceso. Una entrada vale MENU_CACHE_TTL_SEGUNDOS o hasta que
+    llegue un NOTIFY para su sede (o uno sin sede, que invalida todas). Entrega copias de los items
+    para que quien llama pueda modificarlos sin tocar el caché.
+    """
+
+    def __init__(self, ttl: float = MENU_CACHE_TTL_SEGUNDOS, reloj: Callable[[], float] = time.monotonic) -> None:
+        self.ttl = ttl
+        self._reloj = reloj
+        self._lock = threading.Lock()
+        self._entradas: Dict[str, Tuple[float, List[Dict[str, Any]]]] = {}
+        self._generacion: Dict[str, int] = {}
+        self._generacion_todas = 0
+        self._aciertos = 0
+        self._fallos = 0
+        self._invalidaciones = 0
+
+    def obtener(self, id_sede: Any, cargar: Callable[[], List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        clave = str(id_sede)
+        ahora = self._reloj()
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is not None and ahora - entrada[0] < self.ttl:
+                self._aciertos += 1
+                incrementar("menu.cache_aciertos")
+                return [dict(item) for item in entrada[1]]
+            self._fallos += 1
+            generacion = (self._generacion.get(clave, 0), self._generacion_todas)
+        incrementar("menu.cache_fallos")
+        items = cargar()
+        with self._lock:
+            # Si llegó una invalidación mientras se cargaba, lo cargado puede estar viejo: no se guarda
+            if items and self.ttl > 0 and (self._generacion.get(clave, 0), self._generacion_todas) == generacion:
+                self._entradas[clave] = (ahora, [dict(item) for item in items])
+        return items
+
+    def invalidar(self, id_sede: Any = None) -> None:
+        """Descarta el menú de id_sede, o el de todas las sedes si id_sede es None o vacío."""
+        with self._lock:
+            if id_sede in (None, ""):
+                self._entradas.clear()
+                self._generacion_todas += 1
+            else:
+                clave = str(id_sede)
+                self._entradas.pop(clave, None)
+                self._generacion[clave] = self._generacion.get(clave, 0) + 1
+            self._invalidaciones += 1
+        incrementar("menu.invalidaciones")
+
+    def estadisticas(self) -> Dict[str, Any]:
+        """Edad en segundos del menú de cada sede, aciertos, fallos y tasa de aciertos."""
+        ahora = self._reloj()
+        with self._lock:
+            total = self._aciertos + self._fallos
+            tasa = round(self._aciertos / total, 4) if total else 0.0
+            estadisticas = {
+                "edad_segundos": {clave: round(ahora - cargado, 1) for clave, (cargado, _) in self._entradas.items()},
+                "aciertos": self._aciertos,
+                "fallos": self._fallos,
+                "tasa_aciertos": tasa,
+                "invalidaciones": self._invalidaciones,
+                "ttl_segundos": self.ttl
+            }
+        fijar("menu.cache_tasa_aciertos", tasa)
+        return estadisticas
+
+class EscuchaCambiosMenu(threading.Thread):
+    """
+    Hilo daemon con una conexión propia (fuera del pool) en LISTEN menu_cambios. Cada NOTIFY invalida
+    la sede del payload. Si la conexión cae, reconecta con backoff e invalida todo, porque pudo
+    perder avisos mientras estuvo desconectado; el TTL cubre el tiempo sin conexión.
+    """
+
+    def __init__(self, cache: CacheMenu, canal: str = MENU_CANAL_CAMBIOS) -> None:
+        super().__init__(name="escucha_cambios_menu", daemon=True)
+        self.cache = cache
+        self.canal = canal
+        self._detener = threading.Event()
+
+    def detener(self) -> None:
+        self._detener.set()
+
+    def run(self) -> None:
+        espera = 1.0
+        while not self._detener.is_set():
+            conn = None
+            try:
+                conn = conexion_dedicada(autocommit=True)
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {self.canal};")
+                self.cache.invalidar()
+                espera = 1.0
+                while not self._detener.is_set():
+                    if select.select([conn], [], [], 5.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        aviso = conn.notifies.pop(0)
+                        self.cache.invalidar(aviso.payload or None)
+            except Exception as e:
+                incrementar("menu.escucha_errores")
+                logging.error(f"Error escuchando cambios del menú, reintento en {espera:.0f}s: {e}")
+                self._detener.wait(espera)
+                espera = min(espera * 2, 60.0)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+_cache_menu: Optional[CacheMenu] = None
+_escucha: Optional[EscuchaCambiosMenu] = None
+_cache_menu_lock = threading.Lock()
+
+def obtener_cache_menu() -> CacheMenu:
+    """Caché de menú del proceso; la primera llamada arranca el hilo de LISTEN si está habilitado."""
+    global _cache_menu, _escucha
+    with _cache_menu_lock:
+        if _cache_menu is None:
+            _cache_menu = CacheMenu()
+        if MENU_ESCUCHAR_CAMBIOS and _cache_menu.ttl > 0 and _escucha is None:
+            _escucha = EscuchaCambiosMenu(_cache_menu)
+            _escucha.start()
+        return _cache_menu
+
+def estadisticas_cache_menu() -> Dict[str, Any]:
+    with _cache_menu_lock:
+        cache = _cache_menu
+    return cache.estadisticas() if cache is not None else {}
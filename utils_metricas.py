@@ -0,0 +1,72 @@
+# utils_metricas.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Métricas en memoria del proceso (contadores, valores actuales e histogramas de latencia).
+
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Any, Dict, List
+
+# Límites superiores de los buckets de los histogramas, en milisegundos
+BUCKETS_MS: List[float] = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float("inf")]
+
+_lock = threading.Lock()
+_contadores: Dict[str, float] = defaultdict(float)
+_valores: Dict[str, float] = {}
+_histogramas: Dict[str, Dict[str, Any]] = {}
+
+def incrementar(nombre: str, valor: float = 1) -> None:
+    """Suma valor al contador nombre."""
+    with _lock:
+        _contadores[nombre] += valor
+
+def fijar(nombre: str, valor: float) -> None:
+    """Registra el valor actual de una medida (ej: profundidad de una cola)."""
+    with _lock:
+        _valores[nombre] = valor
+
+def observar(nombre: str, valor_ms: float) -> None:
+    """Agrega una observación en milisegundos al histograma nombre."""
+    with _lock:
+        h = _histogramas.get(nombre)
+        if h is None:
+            h = {"conteo": 0, "suma": 0.0, "max": 0.0, "buckets": [0] * len(BUCKETS_MS)}
+            _histogramas[nombre] = h
+        h["conteo"] += 1
+        h["suma"] += valor_ms
+        h["max"] = max(h["max"], valor_ms)
+        h["buckets"][bisect_left(BUCKETS_MS, valor_ms)] += 1
+
+def _percentil(h: Dict[str, Any], p: float) -> float:
+    objetivo = h["conteo"] * p
+    acumulado = 0
+    for limite, cantidad in zip(BUCKETS_MS, h["buckets"]):
+        acumulado += cantidad
+        if acumulado >= objetivo:
+            return h["max"] if limite == float("inf") else limite
+    return h["max"]
+
+def obtener_metricas() -> Dict[str, Any]:
+    """Retorna una copia de todas las métricas con resumen de cada histograma."""
+    with _lock:
+        histogramas = {
+            nombre: {
+                "conteo": h["conteo"],
+                "promedio_ms": round(h["suma"] / h["conteo"], 2) if h["conteo"] else 0.0,
+                "p50_ms": _percentil(h, 0.5),
+                "p95_ms": _percentil(h, 0.95),
+                "max_ms": round(h["max"], 2)
+            }
+            for nombre, h in _histogramas.items()
+        }
+        return {
+            "contadores": dict(_contadores),
+            "valores": dict(_valores),
+            "histogramas": histogramas
+        }
+
+def reiniciar_metricas() -> None:
+    with _lock:
+        _contadores.clear()
+        _valores.clear()
+        _histogramas.clear()
@@ -0,0 +1,69 @@
+# utils_openai.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Cliente OpenAI compartido por todo el proceso: un solo pool httpx con keep-alive,
+# timeouts por llamada y política de reintentos. Evita un handshake TLS por cada llamada.
+
+import os
+import threading
+from typing import Optional
+import httpx
+from openai import OpenAI
+
+OPENAI_TIMEOUT_SEGUNDOS: float = float(os.getenv("OPENAI_TIMEOUT_SEGUNDOS", "30"))
+OPENAI_TIMEOUT_CONEXION_SEGUNDOS: float = float(os.getenv("OPENAI_TIMEOUT_CONEXION_SEGUNDOS", "5"))
+OPENAI_MAX_REINTENTOS: int = int(os.getenv("OPENAI_MAX_REINTENTOS", "2"))
+OPENAI_MAX_CONEXIONES: int = int(os.getenv("OPENAI_MAX_CONEXIONES", "20"))
+OPENAI_KEEPALIVE_SEGUNDOS: float = float(os.getenv("OPENAI_KEEPALIVE_SEGUNDOS", "60"))
+
+_cliente: Optional[OpenAI] = None
+_transporte: Optional[httpx.BaseTransport] = None
+_lock = threading.Lock()
+
+def _crear_cliente() -> OpenAI:
+    http_client = httpx.Client(
+        transport=_transporte,
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONEXIONES,
+            max_keepalive_connections=OPENAI_MAX_CONEXIONES,
+            keepalive_expiry=OPENAI_KEEPALIVE_SEGUNDOS
+        ),
+        timeout=httpx.Timeout(OPENAI_TIMEOUT_SEGUNDOS, connect=OPENAI_TIMEOUT_CONEXION_SEGUNDOS)
+    )
+    return OpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        base_url=os.getenv("OPENAI_BASE_URL") or None,
+        http_client=http_client,
+        max_retries=OPENAI_MAX_REINTENTOS,
+        timeout=httpx.Timeout(OPENAI_TIMEOUT_SEGUNDOS, connect=OPENAI_TIMEOUT_CONEXION_SEGUNDOS)
+    )
+
+def obtener_cliente_openai(timeout: Optional[float] = None, max_reintentos: Optional[int] = None) -> OpenAI:
+    """
+    Retorna el cliente OpenAI del proceso (se crea la primera vez).
+    timeout/max_reintentos ajustan solo esta llamada; el pool de conexiones es el mismo.
+    """
+    global _cliente
+    if _cliente is None:
+        with _lock:
+            if _cliente is None:
+                _cliente = _crear_cliente()
+    if timeout is None and max_reintentos is None:
+        return _cliente
+    opciones = {}
+    if timeout is not None:
+        opciones["timeout"] = httpx.Timeout(timeout, connect=min(timeout, OPENAI_TIMEOUT_CONEXION_SEGUNDOS))
+    if max_reintentos is not None:
+        opciones["max_retries"] = max_reintentos
+    return _cliente.with_options(**opciones)
+
+def configurar_transporte(transporte: Optional[httpx.BaseTransport]) -> None:
+    """
+    Reemplaza el transporte HTTP del cliente compartido (ej: httpx.MockTransport en pruebas)
+    y descarta el cliente actual. Con None vuelve al transporte real.
+    """
+    global _cliente, _transporte
+    with _lock:
+        if _cliente is not None:
+            _cliente.close()
+        _transporte = transporte
+        _cliente = None
@@ -6,6 +6,7 @@ import os
 import traceback
 from utils import log_message
 from utils_database import execute_query
+from utils_contexto import obtener_perfil_cliente
 
 def generar_link_pago(amount: int, sender: str):
     try:
@@ -141,16 +142,9 @@ def guardar_id_pago_en_db(order_id: str, codigo_unico: str) -> bool:
 
 def obtener_datos_cliente_para_pago(sender: str):
     try:
-        query = """
-            SELECT direccion_google,  "Tipo_Doc", "N_Doc", telefono, email 
-            FROM public.clientes_whatsapp 
-            WHERE telefono = %s;
-        """
-        params = (sender,)
-        result = execute_query(query, params)
-        if result and len(result) > 0:
-            direccion,  tipo_documento, numero_documento, telefono, email = result[0]
-            return direccion,  tipo_documento, numero_documento, telefono, email
+        perfil = obtener_perfil_cliente(sender)
+        if perfil:
+            return perfil.get("direccion_google"), perfil.get("Tipo_Doc"), perfil.get("N_Doc"), perfil.get("telefono"), perfil.get("email")
         else:
             log_message(f"No se encontraron datos del cliente para el teléfono: {sender}", "WARNING")
             return None
@@ -0,0 +1,100 @@
+# utils_preclasificador.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Preclasificador local por reglas: resuelve mensajes triviales ("si", "ok", "efectivo", una sede,
+# una dirección) sin llamar a get_classifier. Si no hay una regla con confianza alta, retorna None.
+
+import os
+import re
+from typing import Any, Dict, List, Optional, Pattern, Tuple
+from utils_mapeo import mapear_sede_local, obtener_sedes_activas
+from utils_metricas import incrementar
+from utils_texto import normalizar_texto
+
+PRECLASIFICADOR_ACTIVO: bool = os.getenv("PRECLASIFICADOR_ACTIVO", "true").lower() == "true"
+PRECLASIFICADOR_MAX_PALABRAS: int = int(os.getenv("PRECLASIFICADOR_MAX_PALABRAS", "6"))  # textos más largos van al LLM
+
+# (intent, patrones sobre el texto normalizado completo, pasos de estado_pedido donde aplica; None = cualquiera)
+GRAMATICA: List[Tuple[str, List[str], Optional[Tuple[str, ...]]]] = [
+    ("confirmacion_general", [
+        r"(si|sii|sip|sipi|see|claro( que si)?|dale|ok|okay|oki|listo|de una|perfecto|correcto|"
+        r"esta bien|asi es|confirmo|confirmado|vale|exacto|afirmativo)( (gracias|por favor|senor|senora))?"
+    ], None),
+    ("negacion_general", [
+        r"(no|noo|nop|nope|nel|negativo|para nada|ninguno|ninguna)( gracias)?"
+    ], None),
+    ("saludo", [
+        r"(hola|holi|holaa|buenas|buen dia|buenos dias|buenas tardes|buenas noches|hey|que tal)"
+        r"( (como estas|como va|que tal))?"
+    ], None),
+    ("despedida", [
+        r"(gracias|muchas gracias|mil gracias|chao|adios|hasta luego|bye|nos vemos)"
+    ], None),
+    ("consulta_menu", [
+        r"(el |la )?(menu|carta)( por favor)?",
+        r"(quiero |puedo )?(ver|enviame|mandame|muestrame|me (envias|mandas|muestras)) (el |la )?(menu|carta)( por favor)?"
+    ], None),
+    ("transferencia", [
+        r"(quiero |necesito |puedo )?(hablar|comunicarme) con (un |una )?(asesor|asesora|humano|persona|gerente|administrador)"
+    ], None),
+    ("recoger_restaurante", [
+        r"(para |voy a |paso a |lo paso a |lo voy a )?recoger( en (el restaurante|la sede|tienda))?",
+        r"recojo( en (el restaurante|la sede|tienda))?"
+    ], ("metodo_recogida",)),
+    ("domicilio", [
+        r"(a |para |por )?domicilio",
+        r"(que me lo (lleven|traigan)|envio a (domicilio|la casa))"
+    ], ("metodo_recogida",)),
+    ("validacion_pago", [
+        r"(en |con |pago en |pago con |voy a pagar (en|con) )?(efectivo|cash|datafono|tarjeta|tarjeta de credito|tarjeta debito)"
+    ], ("medio_pago",)),
+]
+
+# Dirección colombiana sola ("calle 10 # 20-30", "cra 15 80-21 apto 301", "mi direccion es ...")
+PATRON_DIRECCION: str = (
+    r"((mi|la) (direccion|dir) (es|seria|correcta es) )?"
+    r"(calle|cll|cl|carrera|cra|kra|kr|cr|avenida|av|ak|ac|diagonal|dg|transversal|tv|trans)\.? ?"
+    r"\d{1,3} ?[a-z]?( bis)? ?[a-z]?( (sur|este))? ?(#|no|n|numero)? ?\d{1,3} ?[a-z]? ?- ?\d{1,3}( .*)?"
+)
+
+# Pasos en los que una intención resuelta por regla sigue siendo ambigua y se deja al LLM
+AMBIGUAS_POR_PASO: Dict[str, Tuple[str, ...]] = {
+    "esperando_confirmacion_pago": ("confirmacion_general", "despedida"),
+    "eleccion_sede": ("confirmacion_general", "negacion_general"),
+}
+
+_reglas: List[Tuple[str, Pattern[str], Optional[Tuple[str, ...]]]] = [
+    (intent, re.compile("(?:" + "|".join(patrones) + ")"), pasos)
+    for intent, patrones, pasos in GRAMATICA
+]
+_direccion: Pattern[str] = re.compile(PATRON_DIRECCION)
+
+def preclasificar(texto: str, paso: Optional[str] = None,
+                  sedes: Optional[List[Dict[str, Any]]] = None) -> Optional[Tuple[str, str, Dict[str, Any]]]:
+    """
+    Clasifica localmente el mensaje del turno con la gramática y el paso actual de estado_pedido.
+    Retorna (intent, type, entities) con la misma forma que get_classifier, o None si el mensaje
+    no es trivial o es ambiguo en este paso (debe ir al LLM).
+    sedes: filas de sedes ({"nombre": ...}); None usa obtener_sedes_activas() solo en el paso eleccion_sede.
+    """
+    if not PRECLASIFICADOR_ACTIVO:
+        return None
+    normalizado = normalizar_texto(texto)
+    if not normalizado:
+        return None
+    intent: Optional[str] = None
+    if _direccion.fullmatch(normalizado) and paso != "eleccion_sede":
+        intent = "direccion"
+    elif len(normalizado.split()) <= PRECLASIFICADOR_MAX_PALABRAS:
+        if paso == "eleccion_sede" and mapear_sede_local(normalizado, obtener_sedes_activas() if sedes is None else sedes):
+            intent = "eleccion_sede"
+        else:
+            for nombre, regla, pasos in _reglas:
+                if (pasos is None or paso in pasos) and regla.fullmatch(normalizado):
+                    intent = nombre
+                    break
+    if intent is None or intent in AMBIGUAS_POR_PASO.get(paso or "", ()):
+        incrementar("preclasificador.delegados")
+        return None
+    incrementar("preclasificador.resueltos")
+    incrementar(f"preclasificador.resueltos.{intent}")
+    return intent, "text", {}
@@ -0,0 +1,107 @@
+# utils_prompts.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Registro de plantillas de prompt: cada prompt grande se arma como prefijo estático (reglas + menú)
+# seguido de un sufijo dinámico (pregunta, resumen, pedido), para aprovechar el caché de prompts
+# del proveedor. Versiona cada plantilla y reporta la fracción de tokens de entrada cacheados.
+
+import hashlib
+import threading
+from typing import Any, Dict, Optional, Tuple
+from utils_metricas import fijar, incrementar
+
+def _campo(objeto: Any, nombre: str) -> Any:
+    if objeto is None:
+        return None
+    if isinstance(objeto, dict):
+        return objeto.get(nombre)
+    return getattr(objeto, nombre, None)
+
+def tokens_de_uso(respuesta: Any) -> Tuple[int, int]:
+    """
+    (tokens de entrada, tokens de entrada cacheados) del campo usage de una respuesta OpenAI.
+    Soporta chat.completions (prompt_tokens / prompt_tokens_details) y responses
+    (input_tokens / input_tokens_details), como objeto o dict.
+    """
+    try:
+        usage = _campo(respuesta, "usage")
+        if usage is None:
+            return 0, 0
+        entrada = _campo(usage, "prompt_tokens") or _campo(usage, "input_tokens") or 0
+        detalles = _campo(usage, "prompt_tokens_details") or _campo(usage, "input_tokens_details")
+        cacheados = _campo(detalles, "cached_tokens") or 0
+        return int(entrada), int(cacheados)
+    except Exception:
+        return 0, 0
+
+class PlantillaPrompt:
+    """
+    Plantilla registrada con nombre y versión. armar() une prefijo y sufijo y detecta cuándo cambia
+    el prefijo (ej: cambió el menú), porque eso invalida el caché del proveedor.
+    """
+
+    def __init__(self, nombre: str, version: str) -> None:
+        self.nombre = nombre
+        self.version = version
+        self._lock = threading.Lock()
+        self._hash_prefijo: Optional[str] = None
+        self._llamadas = 0
+        self._tokens_entrada = 0
+        self._tokens_cacheados = 0
+
+    @property
+    def clave_cache(self) -> str:
+        """Clave estable para enrutar al mismo caché las llamadas con este prefijo (prompt_cache_key)."""
+        return f"{self.nombre}-v{self.version}"
+
+    def opciones(self) -> Dict[str, Any]:
+        """Argumentos extra para client.*.create(**plantilla.opciones())."""
+        return {"extra_body": {"prompt_cache_key": self.clave_cache}}
+
+    def armar(self, prefijo: str, sufijo: str) -> str:
+        hash_prefijo = hashlib.sha256(prefijo.encode("utf-8")).hexdigest()[:12]
+        with self._lock:
+            if self._hash_prefijo is not None and hash_prefijo != self._hash_prefijo:
+                incrementar(f"prompts.{self.nombre}.cambios_prefijo")
+            self._hash_prefijo = hash_prefijo
+        return prefijo + sufijo
+
+    def registrar_uso(self, respuesta: Any) -> None:
+        """Acumula tokens de entrada y cacheados de la respuesta y publica la fracción cacheada."""
+        entrada, cacheados = tokens_de_uso(respuesta)
+        with self._lock:
+            self._llamadas += 1
+            self._tokens_entrada += entrada
+            self._tokens_cacheados += cacheados
+            ratio = self._tokens_cacheados / self._tokens_entrada if self._tokens_entrada else 0.0
+        incrementar(f"prompts.{self.nombre}.tokens_entrada", entrada)
+        incrementar(f"prompts.{self.nombre}.tokens_cacheados", cacheados)
+        fijar(f"prompts.{self.nombre}.ratio_cacheado", round(ratio, 4))
+
+    def reporte(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "version": self.version,
+                "prefijo": self._hash_prefijo,
+                "llamadas": self._llamadas,
+                "tokens_entrada": self._tokens_entrada,
+                "tokens_cacheados": self._tokens_cacheados,
+                "ratio_cacheado": round(self._tokens_cacheados / self._tokens_entrada, 4) if self._tokens_entrada else 0.0
+            }
+
+_plantillas: Dict[str, PlantillaPrompt] = {}
+_plantillas_lock = threading.Lock()
+
+def registrar_plantilla(nombre: str, version: str) -> PlantillaPrompt:
+    """Registra (o retorna) la plantilla nombre. Subir la versión al cambiar el texto del prefijo."""
+    with _plantillas_lock:
+        plantilla = _plantillas.get(nombre)
+        if plantilla is None or plantilla.version != version:
+            plantilla = PlantillaPrompt(nombre, version)
+            _plantillas[nombre] = plantilla
+        return plantilla
+
+def reporte_prompts() -> Dict[str, Dict[str, Any]]:
+    """Versión, prefijo actual y tokens cacheados de cada plantilla registrada."""
+    with _plantillas_lock:
+        plantillas = list(_plantillas.values())
+    return {p.nombre: p.reporte() for p in plantillas}
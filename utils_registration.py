@@ -1,6 +1,7 @@
 import logging
 from utils_database import execute_query
 from utils import log_message
+from utils_contexto import actualizar_perfil_cliente, obtener_perfil_cliente
 
 def update_nombre_bool(sender: str, id_restaurante: str, valor: bool) -> None:
     try:
@@ -11,6 +12,7 @@ def update_nombre_bool(sender: str, id_restaurante: str, valor: bool) -> None:
         """
         params = (valor, sender, id_restaurante)
         execute_query(query, params)
+        actualizar_perfil_cliente(sender, {"nombre_bool": valor})
     except Exception as e:
         log_message(f"update_nombre_bool error: {e}", "ERROR")
         logging.error(f"update_nombre_bool error: {e}")
@@ -25,6 +27,7 @@ def update_dir_primera_vez(sender: str, id_restaurante: str, valor: bool) -> Non
         """
         params = (valor, sender, id_restaurante)
         execute_query(query, params)
+        actualizar_perfil_cliente(sender, {"dir_primera_vez": valor})
     except Exception as e:
         log_message(f"update_dir_primera_vez error: {e}", "ERROR")
         logging.error(f"update_dir_primera_vez error: {e}")
@@ -37,15 +40,19 @@ def save_personal_data_partial(sender: str, id_restaurante: str, tipo_doc: str,
     try:
         sets = []
         params = []
+        cambios = {}
         if tipo_doc and tipo_doc != "No proporcionado":
             sets.append('"Tipo_Doc" = %s')
             params.append(tipo_doc.strip())
+            cambios["Tipo_Doc"] = tipo_doc.strip()
         if n_doc and n_doc != "No proporcionado":
             sets.append('"N_Doc" = %s')
             params.append(n_doc.strip())
+            cambios["N_Doc"] = n_doc.strip()
         if email and email != "No proporcionado":
             sets.append('email = %s')
             params.append(email.strip())
+            cambios["email"] = email.strip()
 
         if not sets:
             # nada que actualizar
@@ -58,6 +65,7 @@ def save_personal_data_partial(sender: str, id_restaurante: str, tipo_doc: str,
         """
         params.extend([sender, id_restaurante])
         execute_query(query, tuple(params))
+        actualizar_perfil_cliente(sender, cambios)
     except Exception as e:
         log_message(f"save_personal_data_partial error: {e}", "ERROR")
         logging.error(f"save_personal_data_partial error: {e}")
@@ -70,14 +78,8 @@ def check_and_mark_datos_personales(sender: str, id_restaurante: str) -> list:
     - Devuelve lista de columnas faltantes (ej: ["Tipo_Doc","email"]) — vacía si ya está completo.
     """
     try:
-        query = """
-            SELECT "Tipo_Doc", "N_Doc", email 
-            FROM public.clientes_whatsapp
-            WHERE telefono = %s AND id_restaurante = %s;
-        """
-        params = (sender, id_restaurante)
-        result = execute_query(query, params)
-        row = result[0] if result and result[0] else (None, None, None)
+        perfil = obtener_perfil_cliente(sender, id_restaurante) or {}
+        row = (perfil.get("Tipo_Doc"), perfil.get("N_Doc"), perfil.get("email"))
         missing = []
         if not row[0] or str(row[0]).strip() == "":
             missing.append("Tipo_Doc")
@@ -95,6 +97,7 @@ def check_and_mark_datos_personales(sender: str, id_restaurante: str) -> list:
                 WHERE telefono = %s AND id_restaurante = %s;
             """
             execute_query(update_query, (sender, id_restaurante))
+            actualizar_perfil_cliente(sender, {"datos_personales": True})
         return missing
     except Exception as e:
         log_message(f"check_and_mark_datos_personales error: {e}", "ERROR")
@@ -104,15 +107,9 @@ def check_and_mark_datos_personales(sender: str, id_restaurante: str) -> list:
 
 def validate_personal_data(sender: str, id_restaurante: str) -> bool:
     try:
-        query = """
-            SELECT datos_personales
-            FROM public.clientes_whatsapp
-            WHERE telefono = %s AND id_restaurante = %s;
-        """
-        params = (sender, id_restaurante)
-        result = execute_query(query, params)
-        if result and result[0]:
-            datos_personales = result[0][0]
+        perfil = obtener_perfil_cliente(sender, id_restaurante)
+        if perfil:
+            datos_personales = perfil.get("datos_personales")
             if datos_personales is None:
                 return False
             return bool(datos_personales)
@@ -124,15 +121,9 @@ def validate_personal_data(sender: str, id_restaurante: str) -> bool:
 
 def validate_direction_first_time(sender: str, id_restaurante: str) -> bool:
     try:
-        query = """
-            SELECT dir_primera_vez
-            FROM public.clientes_whatsapp
-            WHERE telefono = %s AND id_restaurante = %s;
-        """
-        params = (sender, id_restaurante)
-        result = execute_query(query, params)
-        if result and result[0]:
-            dir_primera_vez = result[0][0]
+        perfil = obtener_perfil_cliente(sender, id_restaurante)
+        if perfil:
+            dir_primera_vez = perfil.get("dir_primera_vez")
             return bool(dir_primera_vez)
         return False
     except Exception as e:
@@ -142,15 +133,9 @@ def validate_direction_first_time(sender: str, id_restaurante: str) -> bool:
 
 def validate_nombre_bool(sender: str, id_restaurante: str) -> bool:
     try:
-        query = """
-            SELECT nombre_bool
-            FROM public.clientes_whatsapp
-            WHERE telefono = %s AND id_restaurante = %s;
-        """
-        params = (sender, id_restaurante)
-        result = execute_query(query, params)
-        if result and result[0]:
-            tratamiento_datos = result[0][0]
+        perfil = obtener_perfil_cliente(sender, id_restaurante)
+        if perfil:
+            tratamiento_datos = perfil.get("nombre_bool")
             return bool(tratamiento_datos)
         return False
     except Exception as e:
@@ -0,0 +1,402 @@
+# utils_salidas.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Salidas estructuradas del LLM: cada prompt que devuelve JSON declara su forma como dataclass. De ahí
+# sale el JSON schema que va en response_format / text.format (strict) y el validador que convierte la
+# respuesta al dataclass. Lo que aún llega fuera de forma se repara y se cuenta en salidas.<nombre>.*
+
+import ast
+import json
+import logging
+import os
+import re
+import threading
+from dataclasses import MISSING, asdict, dataclass, field, fields, is_dataclass
+from functools import lru_cache
+from typing import Any, Dict, List, Literal, Optional, Tuple, Type, TypeVar, Union, get_args, get_origin, get_type_hints
+from utils_metricas import fijar, incrementar
+
+# Modelos (prefijos) que no soportan json_schema: se les pide json_object y se valida igual
+SALIDAS_MODELOS_SIN_ESQUEMA: Tuple[str, ...] = tuple(
+    m.strip() for m in os.getenv("SALIDAS_MODELOS_SIN_ESQUEMA", "gpt-3.5").split(",") if m.strip()
+)
+
+T = TypeVar("T")
+
+class SalidaInvalida(ValueError):
+    """La respuesta del LLM no se pudo convertir a la forma declarada, ni reparándola."""
+
+# ---------------------------------------------------------------------------
+# Formas de salida por prompt (el orden de los campos es el orden en que el modelo los escribe)
+# ---------------------------------------------------------------------------
+
+@dataclass
+class ItemSolicitado:
+    producto: str
+    especificaciones: List[str] = field(default_factory=list)
+    cantidad: float = 1
+
+@dataclass
+class Entidades:
+    items: List[ItemSolicitado] = field(default_factory=list)
+
+@dataclass
+class Clasificacion:
+    """get_classifier"""
+    intent: str
+    type: str
+    entities: Entidades = field(default_factory=Entidades)
+
+@dataclass
+class ClasificacionPregunta:
+    """clasificar_pregunta_menu_chatgpt"""
+    clasificacion: Literal["relacionada", "no_relacionada"]
+    intencion: Literal["informacion_menu", "informacion_servicios", "informacion_pedido"] = "informacion_menu"
+
+@dataclass
+class RespuestaMenu:
+    """responder_pregunta_menu_chatgpt"""
+    respuesta: str
+    recomendacion: bool = False
+    productos: List[str] = field(default_factory=list)
+
+@dataclass
+class ProductoPedido:
+    producto: str
+    especificaciones: List[str] = field(default_factory=list)
+
+@dataclass
+class Coincidencia:
+    name: str
+    id: str
+    price: float
+
+@dataclass
+class ItemMapeado:
+    requested: ProductoPedido
+    status: Literal["found", "not_found", "multiple_matches"]
+    matched: Coincidencia
+    candidates: List[Coincidencia] = field(default_factory=list)
+    modifiers_applied: List[str] = field(default_factory=list)
+    cantidad: float = 1
+    note: str = ""
+
+@dataclass
+class MapeoPedido:
+    """mapear_pedido_al_menu"""
+    intent: str
+    intent_confidence: float
+    target_items: List[ProductoPedido] = field(default_factory=list)
+    order_complete: bool = False
+    items: List[ItemMapeado] = field(default_factory=list)
+
+@dataclass
+class Mensaje:
+    """Textos al cliente de un solo campo (medio de pago, menú digital, recogida, dirección...)."""
+    mensaje: str
+
+@dataclass
+class MensajeIntencion:
+    """saludo_dynamic"""
+    mensaje: str
+    intencion: str = "consulta_menu"
+
+@dataclass
+class MensajeRecomendaciones:
+    """pedido_incompleto_dynamic y pedido_incompleto_dynamic_promocion"""
+    mensaje: str
+    recomendaciones: List[str] = field(default_factory=list)
+    intencion: str = "consulta_menu"
+
+@dataclass
+class MensajePromocion:
+    """responder_sobre_promociones"""
+    mensaje: str
+    futura_intencion: str = "continuacion_promocion"
+
+@dataclass
+class ConfirmacionPedido:
+    """generar_mensaje_confirmacion_modificacion_pedido"""
+    mensaje: str
+    intencion_siguiente: str = "preguntar_modificacion"
+
+@dataclass
+class RespuestaQueja:
+    """respuesta_quejas_ia"""
+    respuesta_cordial: str
+    resumen_queja: str = ""
+    intencion: str = "queja_leve"
+
+@dataclass
+class RespuestaQuejaGrave:
+    """respuesta_quejas_graves_ia y respuesta_transferencia"""
+    respuesta_cordial: str
+    resumen_queja: str = ""
+    accion_recomendada: str = ""
+    resumen_ejecutivo: str = ""
+    intencion: str = "queja_grave"
+
+@dataclass
+class EleccionPromocion:
+    """interpretar_eleccion_promocion"""
+    valida_promocion: bool
+    idpromocion: str
+    total_final: float
+    nombre_promocion: str = ""
+    motivo: str = ""
+
+@dataclass
+class MetodoPago:
+    """mapear_modo_pago"""
+    metodo: Literal["datafono", "efectivo", "desconocido"]
+
+@dataclass
+class DatosPersonales:
+    """extraer_info_personal ("No proporcionado" si el cliente no lo dio)"""
+    tipo_documento: str = "No proporcionado"
+    numero_documento: str = "No proporcionado"
+    email: str = "No proporcionado"
+    nombre: str = "No proporcionado"
+
+@dataclass
+class Direccion:
+    """get_direction"""
+    direccion: str
+    observaciones: str = ""
+
+@dataclass
+class Intencion:
+    """clasificar_confirmación_general y clasificar_negacion_general"""
+    intencion: str
+
+@dataclass
+class PerfilCliente:
+    """extraer_resumen"""
+    le_gusta: List[str] = field(default_factory=list)
+    no_le_gusta: List[str] = field(default_factory=list)
+    preferencias: List[str] = field(default_factory=list)
+    puntos_importantes: List[str] = field(default_factory=list)
+    resumen: str = ""
+
+@dataclass
+class CambiosResumen:
+    """extraer_resumen_corto: null = el campo no cambió"""
+    pedido_en_proceso: Optional[str] = None
+    metodo_pago_seleccionado: Optional[str] = None
+    direccion_confirmada: Optional[bool] = None
+    resumen_contextual: Optional[str] = None
+    Importante: Optional[str] = None
+    gusta: Optional[List[str]] = None
+    no_le_gusta: Optional[List[str]] = None
+
+# ---------------------------------------------------------------------------
+# JSON schema
+# ---------------------------------------------------------------------------
+
+_TIPOS_JSON: Dict[Any, str] = {str: "string", bool: "boolean", int: "integer", float: "number"}
+
+def _esquema_tipo(tipo: Any) -> Tuple[Dict[str, Any], bool]:
+    """(schema, admite strict) de una anotación de tipo."""
+    if is_dataclass(tipo):
+        return _esquema_clase(tipo)
+    origen, argumentos = get_origin(tipo), get_args(tipo)
+    if origen is Union:
+        no_nulos = [a for a in argumentos if a is not type(None)]
+        interno, estricto = _esquema_tipo(no_nulos[0])
+        return {"anyOf": [interno, {"type": "null"}]}, estricto
+    if origen in (list, List):
+        interno, estricto = _esquema_tipo(argumentos[0] if argumentos else Any)
+        return {"type": "array", "items": interno}, estricto
+    if origen is Literal:
+        return {"type": "string", "enum": list(argumentos)}, True
+    if tipo in _TIPOS_JSON:
+        return {"type": _TIPOS_JSON[tipo]}, True
+    # Dict / Any: objeto libre, incompatible con strict
+    return {"type": "object"}, False
+
+def _esquema_clase(clase: type) -> Tuple[Dict[str, Any], bool]:
+    tipos = get_type_hints(clase)
+    propiedades: Dict[str, Any] = {}
+    estricto = True
+    for campo in fields(clase):
+        propiedades[campo.name], estricto_campo = _esquema_tipo(tipos[campo.name])
+        estricto = estricto and estricto_campo
+    return {
+        "type": "object",
+        "properties": propiedades,
+        "required": list(propiedades),
+        "additionalProperties": False
+    }, estricto
+
+@lru_cache(maxsize=None)
+def _esquema_cacheado(clase: type) -> Tuple[str, bool]:
+    esquema, estricto = _esquema_clase(clase)
+    return json.dumps(esquema), estricto
+
+def esquema(clase: type) -> Tuple[Dict[str, Any], bool]:
+    """JSON schema de la forma clase y si se puede pedir en modo strict."""
+    texto, estricto = _esquema_cacheado(clase)
+    return json.loads(texto), estricto
+
+def formato_salida(clase: type, ruta: str, modelo: str) -> Dict[str, Any]:
+    """
+    Argumentos para create(): response_format (ruta "chat") o text.format (ruta "responses") con el
+    schema de clase. Los modelos sin json_schema reciben json_object (el prompt debe decir "JSON").
+    """
+    if modelo.startswith(SALIDAS_MODELOS_SIN_ESQUEMA):
+        formato: Dict[str, Any] = {"type": "json_object"}
+        return {"response_format": formato} if ruta == "chat" else {"text": {"format": formato}}
+    schema, estricto = esquema(clase)
+    if ruta == "chat":
+        return {"response_format": {"type": "json_schema", "json_schema": {"name": clase.__name__, "schema": schema, "strict": estricto}}}
+    return {"text": {"format": {"type": "json_schema", "name": clase.__name__, "schema": schema, "strict": estricto}}}
+
+# ---------------------------------------------------------------------------
+# Validación y reparación
+# ---------------------------------------------------------------------------
+
+def reparar_json(raw: str) -> str:
+    """
+    Convierte texto casi-JSON en JSON válido: tupla de Python (intent, type, entities) del
+    clasificador, bloque ```json, texto antes de la primera llave, comas finales y cierres faltantes.
+    Lanza ValueError si no se logra.
+    """
+    text: str = raw.strip()
+    if text.startswith("(") and text.endswith(")"):
+        try:
+            intent, type_, entities = ast.literal_eval(text)
+            return json.dumps({"intent": intent, "type": type_, "entities": entities if isinstance(entities, dict) else {}})
+        except Exception:
+            pass
+    s: str = re.sub(r"^```(?:json)?\s*", "", text, flags=re.IGNORECASE)
+    s = re.sub(r"\s*```$", "", s)
+    idx: int = s.find("{")
+    if idx != -1:
+        s = s[idx:]
+    s = re.sub(r',\s*([\]}])', r"\1", s)
+    s += "]" * (s.count("[") - s.count("]"))
+    s += "}" * (s.count("{") - s.count("}"))
+    json.loads(s)
+    return s
+
+def _convertir(tipo: Any, valor: Any, ruta: str, reparaciones: List[str]) -> Any:
+    if is_dataclass(tipo):
+        if not isinstance(valor, dict):
+            raise SalidaInvalida(f"{ruta or 'raíz'}: se esperaba objeto")
+        return _construir(tipo, valor, ruta, reparaciones)
+    origen, argumentos = get_origin(tipo), get_args(tipo)
+    if origen is Union:
+        if valor is None:
+            return None
+        return _convertir(next(a for a in argumentos if a is not type(None)), valor, ruta, reparaciones)
+    if origen in (list, List):
+        if valor is None:
+            reparaciones.append(ruta)
+            return []
+        if not isinstance(valor, list):
+            reparaciones.append(ruta)
+            valor = [valor]
+        interno = argumentos[0] if argumentos else Any
+        return [_convertir(interno, v, f"{ruta}[{i}]", reparaciones) for i, v in enumerate(valor)]
+    if origen is Literal:
+        # El enum lo garantiza el schema; con json_object se acepta el texto tal cual
+        return valor if isinstance(valor, str) else str(valor)
+    if tipo is bool:
+        if isinstance(valor, bool):
+            return valor
+        if isinstance(valor, str) and valor.strip().lower() in ("true", "false"):
+            reparaciones.append(ruta)
+            return valor.strip().lower() == "true"
+        raise SalidaInvalida(f"{ruta}: se esperaba booleano")
+    if tipo in (int, float):
+        if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+            return valor
+        try:
+            numero = float(str(valor).replace(",", ""))
+        except ValueError:
+            raise SalidaInvalida(f"{ruta}: se esperaba número")
+        reparaciones.append(ruta)
+        return int(numero) if tipo is int and numero.is_integer() else numero
+    if tipo is str:
+        if isinstance(valor, str):
+            return valor
+        if valor is None:
+            reparaciones.append(ruta)
+            return ""
+        reparaciones.append(ruta)
+        return str(valor)
+    return valor
+
+def _construir(clase: Type[T], datos: Dict[str, Any], ruta: str, reparaciones: List[str]) -> T:
+    tipos = get_type_hints(clase)
+    valores: Dict[str, Any] = {}
+    for campo in fields(clase):
+        ruta_campo = f"{ruta}.{campo.name}" if ruta else campo.name
+        if campo.name in datos:
+            valores[campo.name] = _convertir(tipos[campo.name], datos[campo.name], ruta_campo, reparaciones)
+        elif campo.default is not MISSING or campo.default_factory is not MISSING:
+            reparaciones.append(ruta_campo)
+        else:
+            raise SalidaInvalida(f"falta el campo {ruta_campo}")
+    return clase(**valores)
+
+_conteos: Dict[str, Dict[str, int]] = {}
+_conteos_lock = threading.Lock()
+
+def _contar(nombre: str, resultado: str) -> None:
+    incrementar(f"salidas.{nombre}.{resultado}")
+    with _conteos_lock:
+        conteo = _conteos.setdefault(nombre, {"directas": 0, "reparadas": 0, "invalidas": 0})
+        conteo[resultado] += 1
+        total = sum(conteo.values())
+        tasa = (conteo["reparadas"] + conteo["invalidas"]) / total
+    fijar(f"salidas.{nombre}.tasa_reparacion", round(tasa, 4))
+
+def convertir_salida(raw: Optional[str], clase: Type[T]) -> Tuple[T, List[str]]:
+    """(instancia de clase, rutas reparadas) sin registrar métricas; lanza SalidaInvalida."""
+    texto = (raw or "").strip()
+    reparaciones: List[str] = []
+    try:
+        datos = json.loads(texto)
+    except ValueError:
+        try:
+            datos = json.loads(reparar_json(texto))
+        except ValueError as e:
+            raise SalidaInvalida(f"JSON inválido: {e}") from e
+        reparaciones.append("texto")
+    if not isinstance(datos, dict):
+        raise SalidaInvalida("se esperaba un objeto JSON")
+    return _construir(clase, datos, "", reparaciones), reparaciones
+
+def parsear_salida(nombre: str, raw: Optional[str], clase: Type[T]) -> T:
+    """
+    Convierte la respuesta cruda de la función nombre en clase. Cuenta en salidas.<nombre>.directas,
+    .reparadas (hubo que limpiar texto o completar campos) o .invalidas, y publica
+    salidas.<nombre>.tasa_reparacion. Lanza SalidaInvalida si no hay forma de convertirla.
+    """
+    try:
+        resultado, reparaciones = convertir_salida(raw, clase)
+    except SalidaInvalida as e:
+        _contar(nombre, "invalidas")
+        logging.error(f"Salida inválida de {nombre}: {e} | {str(raw)[:300]!r}")
+        raise
+    if reparaciones:
+        _contar(nombre, "reparadas")
+        logging.info(f"Salida de {nombre} reparada en: {', '.join(reparaciones[:10])}")
+    else:
+        _contar(nombre, "directas")
+    return resultado
+
+def salida_valida(raw: Optional[str], clase: type) -> bool:
+    """True si raw ya tiene la forma de clase sin reparaciones (criterio de escalamiento en cascadas)."""
+    try:
+        return not convertir_salida(raw, clase)[1]
+    except SalidaInvalida:
+        return False
+
+def a_dict(salida: Any) -> Dict[str, Any]:
+    """Dict de una salida (las funciones de utils_chatgpt siguen retornando dicts a los subflujos)."""
+    return asdict(salida)
+
+def reporte_salidas() -> Dict[str, Dict[str, int]]:
+    with _conteos_lock:
+        return {nombre: dict(conteo) for nombre, conteo in _conteos.items()}
@@ -0,0 +1,151 @@
+# utils_streaming.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Respuestas del LLM en streaming para textos al cliente: se lee el JSON a medida que llega y el
+# mensaje sale por WhatsApp apenas cierra el campo "mensaje"/"respuesta", mientras el resto del JSON
+# (recomendacion, intencion_siguiente, ...) se termina de recibir después del envío.
+
+import json
+import logging
+import os
+import time
+from typing import Any, Callable, Iterable, Optional, Tuple
+from utils_metricas import incrementar, observar
+
+STREAMING_ACTIVO: bool = os.getenv("STREAMING_ACTIVO", "true").lower() == "true"
+
+CAMPOS_MENSAJE: Tuple[str, ...] = ("mensaje", "respuesta")
+
+class ExtractorCampoJSON:
+    """
+    Lector incremental de un objeto JSON: alimentar() recibe fragmentos y retorna (campo, valor) la
+    primera vez que se cierra un string de primer nivel cuya llave está en campos. No valida el JSON;
+    el texto completo se parsea igual al final.
+    """
+
+    def __init__(self, campos: Iterable[str] = CAMPOS_MENSAJE) -> None:
+        self.campos = set(campos)
+        self.texto = ""
+        self.encontrado: Optional[Tuple[str, str]] = None
+        self._profundidad = 0
+        self._en_cadena = False
+        self._escape = False
+        self._inicio_cadena = 0
+        self._clave: Optional[str] = None
+        self._esperando_valor = False
+
+    def alimentar(self, fragmento: str) -> Optional[Tuple[str, str]]:
+        inicio = len(self.texto)
+        self.texto += fragmento
+        for i in range(inicio, len(self.texto)):
+            c = self.texto[i]
+            if self._en_cadena:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._en_cadena = False
+                    if self._profundidad == 1:
+                        resultado = self._cerrar_cadena(self.texto[self._inicio_cadena:i + 1])
+                        if resultado is not None:
+                            return resultado
+                continue
+            if c == '"':
+                self._en_cadena = True
+                self._inicio_cadena = i
+            elif c in "{[":
+                self._profundidad += 1
+            elif c in "}]":
+                self._profundidad -= 1
+            elif c == ":" and self._profundidad == 1:
+                self._esperando_valor = True
+            elif c == "," and self._profundidad == 1:
+                self._esperando_valor = False
+                self._clave = None
+        return None
+
+    def _cerrar_cadena(self, literal: str) -> Optional[Tuple[str, str]]:
+        try:
+            valor = json.loads(literal)
+        except ValueError:
+            return None
+        if not self._esperando_valor:
+            self._clave = valor
+            return None
+        self._esperando_valor = False
+        if self.encontrado is None and self._clave in self.campos:
+            self.encontrado = (self._clave, valor)
+            return self.encontrado
+        return None
+
+class EnvioRastreado:
+    """
+    Envuelve al_mensaje y recuerda si el envío salió. Quien llama consulta .enviado también en su
+    except: si el stream falla después de enviar el mensaje, no debe mandar un segundo texto.
+    """
+
+    def __init__(self, al_mensaje: Callable[[str], None]) -> None:
+        self.al_mensaje = al_mensaje
+        self.enviado = False
+
+    def __call__(self, texto: str) -> None:
+        self.al_mensaje(texto)
+        self.enviado = True
+
+def fragmentos_de_stream(stream: Any, final: list) -> Iterable[str]:
+    """
+    Texto incremental de un stream de OpenAI, sea responses (eventos response.output_text.delta) o
+    chat.completions (chunks con choices[0].delta.content). La respuesta final o el último chunk
+    con usage se deja en final[0] para registrar tokens.
+    """
+    for evento in stream:
+        tipo = getattr(evento, "type", None)
+        if tipo is not None:
+            if tipo == "response.output_text.delta":
+                yield evento.delta or ""
+            elif tipo == "response.completed":
+                final[0] = evento.response
+            continue
+        if getattr(evento, "usage", None) is not None:
+            final[0] = evento
+        opciones = getattr(evento, "choices", None) or []
+        if opciones and opciones[0].delta and opciones[0].delta.content:
+            yield opciones[0].delta.content
+
+def consumir_stream(
+    stream: Any,
+    nombre: str,
+    al_mensaje: Callable[[str], None],
+    campos: Iterable[str] = CAMPOS_MENSAJE,
+    transformar: Optional[Callable[[str], str]] = None
+) -> Tuple[str, bool, Any]:
+    """
+    Lee el stream completo y llama al_mensaje(texto) una sola vez, en cuanto cierra el campo de
+    mensaje (pasado por transformar si se da). Retorna (texto completo, si se envió, respuesta final
+    con usage o None). Métricas: streaming.<nombre>.primer_envio_ms y streaming.<nombre>.total_ms.
+    """
+    inicio = time.perf_counter()
+    extractor = ExtractorCampoJSON(campos)
+    final: list = [None]
+    enviado = False
+    for fragmento in fragmentos_de_stream(stream, final):
+        if enviado:
+            extractor.texto += fragmento
+            continue
+        campo = extractor.alimentar(fragmento)
+        if campo is None:
+            continue
+        texto = transformar(campo[1]) if transformar else campo[1]
+        try:
+            al_mensaje(texto)
+            enviado = True
+            observar(f"streaming.{nombre}.primer_envio_ms", (time.perf_counter() - inicio) * 1000)
+        except Exception as e:
+            incrementar(f"streaming.{nombre}.errores_envio")
+            logging.error(f"Error enviando mensaje en streaming ({nombre}): {e}")
+            # Se deja de buscar el campo: quien llama envía con el resultado completo
+            enviado = False
+            extractor.encontrado = campo
+    observar(f"streaming.{nombre}.total_ms", (time.perf_counter() - inicio) * 1000)
+    incrementar(f"streaming.{nombre}.{'envios_tempranos' if enviado else 'sin_envio_temprano'}")
+    return extractor.texto, enviado, final[0]
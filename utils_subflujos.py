@@ -7,7 +7,7 @@ import random
 import logging
 from typing import Any, Dict
 import re
-from utils_contexto import actualizar_estado_pedido, borrar_estado_pedido, crear_estado_inicial, obtener_x_respuestas, set_id_sede,get_id_sede,obtener_estado_pedido, tiene_estado_activo
+from utils_contexto import actualizar_estado_pedido, actualizar_perfil_cliente, borrar_estado_pedido, crear_estado_inicial, obtener_x_respuestas, set_id_sede,get_id_sede,obtener_estado_pedido, tiene_estado_activo, set_sender
 from utils_registration import validate_direction_first_time
 
 # --- IMPORTS INTERNOS --- #
@@ -43,12 +43,22 @@ from utils import (
     verify_hour_atettion_v2
 )
 from utils_chatgpt import clasificador_consulta_menu, extraer_resumen_corto, generar_mensaje_sin_intencion,get_direction, clasificar_pregunta_menu_chatgpt, enviar_menu_digital, generar_mensaje_confirmacion_modificacion_pedido, generar_mensaje_recogida_invitar_pago, interpretar_eleccion_promocion, mapear_pedido_al_menu, mapear_sede_cliente, obtener_respuestas_mismo_dia, pedido_incompleto_dynamic, pedido_incompleto_dynamic_promocion, responder_pregunta_menu_chatgpt, responder_sobre_promociones, respuesta_quejas_graves_ia, respuesta_quejas_ia, saludo_dynamic, solicitar_medio_pago, solicitar_metodo_recogida,direccion_bd,mapear_modo_pago,extraer_info_personal,clasificar_confirmación_general,get_tiempo_recogida,clasificar_negacion_general,respuesta_transferencia,generar_mensaje_seleccion_sede
-from utils_database import execute_query
+from utils_concurrencia import TareaDiferida
+from utils_database import execute_query, unidad_de_trabajo
 from utils_google import calcular_distancia_entre_sede_y_cliente, calcular_tiempo_pedido, formatear_tiempo_entrega, geocode_and_assign, orquestador_tiempo_y_valor_envio
 from utils_pagos import generar_link_pago, guardar_id_pago_en_db, validar_pago
 from utils_registration import validate_personal_data,save_personal_data_partial,check_and_mark_datos_personales
 
 ID_RESTAURANTE: str = os.getenv("ID_RESTAURANTE", "5")
+RESUMEN_CADA_MENSAJES: int = int(os.getenv("RESUMEN_CADA_MENSAJES", "3"))  # actualizar el resumen corto cada N mensajes...
+RESUMEN_CADA_SEGUNDOS: float = float(os.getenv("RESUMEN_CADA_SEGUNDOS", "120"))  # ...o cada tantos segundos, lo primero
+
+def _actualizar_resumen_corto(sender: str) -> None:
+    """Actualiza el resumen corto del perfil con los mensajes del día; corre diferida, fuera del turno."""
+    set_sender(sender)
+    extraer_resumen_corto(obtener_respuestas_mismo_dia(sender), sender, ID_RESTAURANTE)
+
+RESUMEN_CORTO = TareaDiferida("resumen_corto", _actualizar_resumen_corto, RESUMEN_CADA_MENSAJES, RESUMEN_CADA_SEGUNDOS)
 # --- BANCOS DE MENSAJES PREDETERMINADOS --- #
 respuestas_no_relacionadas = [
     {
@@ -94,7 +104,7 @@ def subflujo_saludo_bienvenida(nombre: str, nombre_local: str, sender: str, mens
     """Genera un mensaje de bienvenida personalizado."""
     try:
         #respuesta_gpt: dict = saludo_dynamic(mensaje_usuario, nombre, nombre_local)
-        mensaje = f"Hola {nombre}, te damos la bienvenida a {nombre_local}; recuerda enviar un solo mensaje 😊"
+        mensaje = f"Hola {nombre}, te damos la bienvenida a {nombre_local} 😊"
         #mensaje = respuesta_gpt.get("mensaje")
         intencion = "saludo"
         guardar_intencion_futura(sender, intencion)
@@ -132,7 +142,7 @@ def subflujo_solicitud_pedido(sender: str, pregunta_usuario: str, entidades_text
                         single_item = {
                             "requested": {"producto": prod_text},
                             "status": "found",
-                            "matched": {"name": match["name"], "price": match["price"], "id": None},
+                            "matched": {"name": match["name"], "price": match["price"], "id": match.get("id")},
                             "candidates": [],
                             "modifiers_applied": [],
                         }
@@ -168,8 +178,12 @@ def subflujo_solicitud_pedido(sender: str, pregunta_usuario: str, entidades_text
                 no_completo: dict = pedido_incompleto_dynamic_promocion(pregunta_usuario, items_menu, str(pedido_dict))
                 send_text_response(sender, no_completo.get("mensaje"))
                 return
-        confirmacion_modificacion_pedido: dict = generar_mensaje_confirmacion_modificacion_pedido(pedido_dict,items_menu, bandera_promocion, info_promociones, eleccion_promocion)
-        send_text_response(sender, confirmacion_modificacion_pedido.get("mensaje"))
+        confirmacion_modificacion_pedido: dict = generar_mensaje_confirmacion_modificacion_pedido(
+            pedido_dict, items_menu, bandera_promocion, info_promociones, eleccion_promocion,
+            al_mensaje=lambda texto: send_text_response(sender, texto)
+        )
+        if not confirmacion_modificacion_pedido.get("enviado"):
+            send_text_response(sender, confirmacion_modificacion_pedido.get("mensaje"))
         datos_promocion = {
             "info_promociones": info_promociones,
             "eleccion_promocion": eleccion_promocion,
@@ -248,8 +262,9 @@ def subflujo_preguntas_generales(sender: str, pregunta_usuario: str, nombre_clie
         if clasificacion_tipo == "relacionada":   
             clasificacion_intencion = clasificacion.get("intencion", "consulta_menu")
             if clasificacion_intencion == "informacion_menu" or clasificacion_intencion == "informacion_servicios":
-                respuesta_llm: dict = responder_pregunta_menu_chatgpt(pregunta_usuario, items,sender)
-                send_text_response(sender, respuesta_llm.get("respuesta"))
+                respuesta_llm: dict = responder_pregunta_menu_chatgpt(pregunta_usuario, items, sender, al_mensaje=lambda texto: send_text_response(sender, texto))
+                if not respuesta_llm.get("enviado"):
+                    send_text_response(sender, respuesta_llm.get("respuesta"))
                 #send_text_response(sender, respuesta_llm.get("productos", ""))
                 if respuesta_llm.get("recomendacion"):
                     guardar_intencion_futura(sender, "solicitud_pedido")
@@ -398,14 +413,16 @@ def subflujo_consulta_menu(sender: str, nombre_cliente: str, pregunta_usuario: s
         clasificacion=clasificador_consulta_menu(pregunta_usuario)
         log_message(f'Clasificación de consulta de menú: {clasificacion}', 'INFO')
         if clasificacion=="consulta_menu":
-            mensaje_menu: dict = enviar_menu_digital(nombre_cliente, "Sierra Nevada", menu, promociones_list)
-            send_text_response(sender, mensaje_menu.get("mensaje"))
+            mensaje_menu: dict = enviar_menu_digital(nombre_cliente, "Sierra Nevada", menu, promociones_list, al_mensaje=lambda texto: send_text_response(sender, texto))
+            if not mensaje_menu.get("enviado"):
+                send_text_response(sender, mensaje_menu.get("mensaje"))
             send_pdf_response(sender)
             log_message(f'Menú enviado correctamente a {sender}.', 'INFO')
         elif clasificacion=="aclaracion_producto":
-            mensaje=responder_pregunta_menu_chatgpt(pregunta_usuario, menu,sender)
+            mensaje=responder_pregunta_menu_chatgpt(pregunta_usuario, menu, sender, al_mensaje=lambda texto: send_text_response(sender, texto))
             log_message(f'Respuesta generada para consulta de producto: {mensaje}', 'INFO')
-            send_text_response(sender, mensaje.get("respuesta"))
+            if not mensaje.get("enviado"):
+                send_text_response(sender, mensaje.get("respuesta"))
             log_message(f'Consulta de producto respondida correctamente a {sender}.', 'INFO')
             guardar_intencion_futura(sender, "pregunta_pedido",str(entidades),"",pregunta_usuario,"")
     except Exception as e:
@@ -602,69 +619,24 @@ def subflujo_modificacion_pedido(sender: str, nombre_cliente: str, pregunta_usua
                 return
             else:
                 intent = productos["intent"]
-                log_message(f'Modificación de pedido detectada: {productos} con la intención {intent}' , 'INFO')
+                log_message(f'Modificación de pedido detectada con la intención {intent}', 'INFO', productos=productos)
+                if intent == "ACLARACION":
+                    items = obtener_menu()
+                    mensaje = generar_mensaje_sin_intencion(pregunta_usuario, items)
+                    send_text_response(sender, mensaje)
+                    return
                 # Procesar modificaciones según la intención detectada  
-                match intent:
-                    case "ADD_ITEM":
-                        for item in productos.get("items", []):
-                            query = """SELECT id_detalle, cantidad
-                                        FROM detalle_pedido
-                                        WHERE id_pedido = %s AND id_producto = %s"""
-                            params = ( id_pedido, item.get("matched").get("id"))
-                            res_detalle = execute_query(query, params, fetchone=True)
-                            if res_detalle:
-                                especificaciones_txt = normalizar_especificaciones(item)
-                                id_detalle, cantidad_actual = res_detalle
-                                nueva_cantidad = cantidad_actual + item.get("cantidad", 1)
-                                query = """ UPDATE detalle_pedido SET cantidad = %s, total = %s ,especificaciones = CASE
-                                            WHEN %s IS NULL OR %s = '' THEN especificaciones
-                                            ELSE %s 
-                                            END
-                                            WHERE id_detalle = %s"""
-                                params = ( nueva_cantidad, (item.get("matched").get("price") * nueva_cantidad), especificaciones_txt,especificaciones_txt,especificaciones_txt, id_detalle )
-                                res_detalle = execute_query(query, params)
-                            else:     
-                                especificaciones_txt = normalizar_especificaciones(item)           
-                                query = """ INSERT INTO detalle_pedido ( id_producto,id_pedido, cantidad, total, especificaciones) VALUES (%s, %s, %s, %s, %s)"""
-                                params = (item.get("matched").get("id"), id_pedido, item.get("cantidad"), (item.get("matched").get("price") * item.get("cantidad", 1)), especificaciones_txt )
-                                res_detalle = execute_query(query, params)
-                    case "REMOVE_ITEM":
-                        for item in productos.get("items", []):
-                            cambio = item.get("note")
-                            if cambio == "delete" or item.get("cantidad") == 0:
-                                query = """ DELETE FROM detalle_pedido WHERE id_pedido = %s AND id_producto = %s"""
-                                params = ( id_pedido, item.get("matched").get("id"))
-                                res_detalle = execute_query(query, params)
-                            else:
+                # Todas las escrituras del pedido se confirman juntas (un solo commit)
+                reescribir_pedido = False
+                with unidad_de_trabajo():
+                    match intent:
+                        case "ADD_ITEM":
+                            for item in productos.get("items", []):
                                 query = """SELECT id_detalle, cantidad
                                             FROM detalle_pedido
                                             WHERE id_pedido = %s AND id_producto = %s"""
                                 params = ( id_pedido, item.get("matched").get("id"))
                                 res_detalle = execute_query(query, params, fetchone=True)
-                                if res_detalle:
-                                    id_detalle, cantidad_actual = res_detalle
-                                    nueva_cantidad = cantidad_actual - item.get("cantidad", 1)
-                                    especificaciones_txt = normalizar_especificaciones(item) 
-                                    if nueva_cantidad > 0:
-                                        query = """ UPDATE detalle_pedido SET cantidad = %s, total = %s, especificaciones = CASE
-                                                    WHEN %s IS NULL OR %s = '' THEN especificaciones
-                                                    ELSE %s END
-                                                    WHERE id_detalle = %s"""
-                                        params = ( nueva_cantidad, (item.get("matched").get("price") * nueva_cantidad),especificaciones_txt,especificaciones_txt,especificaciones_txt, id_detalle)
-                                        res_detalle = execute_query(query, params)
-                                    else:
-                                        query = """ DELETE FROM detalle_pedido WHERE id_pedido = %s AND id_producto = %s"""
-                                        params = ( id_pedido, item.get("matched").get("id"))
-                                        res_detalle = execute_query(query, params)
-                    case "REPLACE_ITEM":
-                        for item in productos.get("items", []):            
-                            cambio = item.get("note")
-                            query = """SELECT id_detalle, cantidad
-                                        FROM detalle_pedido
-                                        WHERE id_pedido = %s AND id_producto = %s"""
-                            params = ( id_pedido, item.get("matched").get("id"))
-                            res_detalle = execute_query(query, params, fetchone=True)  
-                            if cambio == "Producto de reemplazo":
                                 if res_detalle:
                                     especificaciones_txt = normalizar_especificaciones(item)
                                     id_detalle, cantidad_actual = res_detalle
@@ -681,77 +653,129 @@ def subflujo_modificacion_pedido(sender: str, nombre_cliente: str, pregunta_usua
                                     query = """ INSERT INTO detalle_pedido ( id_producto,id_pedido, cantidad, total, especificaciones) VALUES (%s, %s, %s, %s, %s)"""
                                     params = (item.get("matched").get("id"), id_pedido, item.get("cantidad"), (item.get("matched").get("price") * item.get("cantidad", 1)), especificaciones_txt )
                                     res_detalle = execute_query(query, params)
-                            elif cambio == "Producto a reemplazar":
-                                if res_detalle:
-                                    id_detalle, cantidad_actual = res_detalle
-                                    nueva_cantidad = cantidad_actual - item.get("cantidad", 1)
-                                    especificaciones_txt = normalizar_especificaciones(item) 
-                                    if nueva_cantidad > 0:
-                                        query = """ UPDATE detalle_pedido SET cantidad = %s, total = %s, especificaciones = CASE
-                                                    WHEN %s IS NULL OR %s = '' THEN especificaciones
-                                                    ELSE %s END
-                                                    WHERE id_detalle = %s"""
-                                        params = ( nueva_cantidad, (item.get("matched").get("price") * nueva_cantidad),especificaciones_txt,especificaciones_txt,especificaciones_txt, id_detalle)
-                                        res_detalle = execute_query(query, params)
-                                    else:
-                                        query = """ DELETE FROM detalle_pedido WHERE id_pedido = %s AND id_producto = %s"""
-                                        params = ( id_pedido, item.get("matched").get("id"))
-                                        res_detalle = execute_query(query, params)
-                    case "UPDATE_ITEM":
-                        for item in productos.get("items", []):
-                            if item.get("cantidad") == 0:
-                                query = """ DELETE FROM detalle_pedido WHERE id_pedido = %s AND id_producto = %s"""
-                                params = ( id_pedido, item.get("matched").get("id"))
-                                res_detalle = execute_query(query, params)
-                            else:
+                        case "REMOVE_ITEM":
+                            for item in productos.get("items", []):
+                                cambio = item.get("note")
+                                if cambio == "delete" or item.get("cantidad") == 0:
+                                    query = """ DELETE FROM detalle_pedido WHERE id_pedido = %s AND id_producto = %s"""
+                                    params = ( id_pedido, item.get("matched").get("id"))
+                                    res_detalle = execute_query(query, params)
+                                else:
+                                    query = """SELECT id_detalle, cantidad
+                                                FROM detalle_pedido
+                                                WHERE id_pedido = %s AND id_producto = %s"""
+                                    params = ( id_pedido, item.get("matched").get("id"))
+                                    res_detalle = execute_query(query, params, fetchone=True)
+                                    if res_detalle:
+                                        id_detalle, cantidad_actual = res_detalle
+                                        nueva_cantidad = cantidad_actual - item.get("cantidad", 1)
+                                        especificaciones_txt = normalizar_especificaciones(item) 
+                                        if nueva_cantidad > 0:
+                                            query = """ UPDATE detalle_pedido SET cantidad = %s, total = %s, especificaciones = CASE
+                                                        WHEN %s IS NULL OR %s = '' THEN especificaciones
+                                                        ELSE %s END
+                                                        WHERE id_detalle = %s"""
+                                            params = ( nueva_cantidad, (item.get("matched").get("price") * nueva_cantidad),especificaciones_txt,especificaciones_txt,especificaciones_txt, id_detalle)
+                                            res_detalle = execute_query(query, params)
+                                        else:
+                                            query = """ DELETE FROM detalle_pedido WHERE id_pedido = %s AND id_producto = %s"""
+                                            params = ( id_pedido, item.get("matched").get("id"))
+                                            res_detalle = execute_query(query, params)
+                        case "REPLACE_ITEM":
+                            for item in productos.get("items", []):            
+                                cambio = item.get("note")
                                 query = """SELECT id_detalle, cantidad
                                             FROM detalle_pedido
                                             WHERE id_pedido = %s AND id_producto = %s"""
                                 params = ( id_pedido, item.get("matched").get("id"))
-                                res_detalle = execute_query(query, params, fetchone=True)
-                                especificaciones_txt = normalizar_especificaciones(item)
-                                if res_detalle:
-                                    id_detalle, cantidad_actual = res_detalle
-                                    query = """ UPDATE detalle_pedido SET cantidad = %s, total = %s, especificaciones = CASE
+                                res_detalle = execute_query(query, params, fetchone=True)  
+                                if cambio == "Producto de reemplazo":
+                                    if res_detalle:
+                                        especificaciones_txt = normalizar_especificaciones(item)
+                                        id_detalle, cantidad_actual = res_detalle
+                                        nueva_cantidad = cantidad_actual + item.get("cantidad", 1)
+                                        query = """ UPDATE detalle_pedido SET cantidad = %s, total = %s ,especificaciones = CASE
+                                                    WHEN %s IS NULL OR %s = '' THEN especificaciones
+                                                    ELSE %s 
+                                                    END
+                                                    WHERE id_detalle = %s"""
+                                        params = ( nueva_cantidad, (item.get("matched").get("price") * nueva_cantidad), especificaciones_txt,especificaciones_txt,especificaciones_txt, id_detalle )
+                                        res_detalle = execute_query(query, params)
+                                    else:     
+                                        especificaciones_txt = normalizar_especificaciones(item)           
+                                        query = """ INSERT INTO detalle_pedido ( id_producto,id_pedido, cantidad, total, especificaciones) VALUES (%s, %s, %s, %s, %s)"""
+                                        params = (item.get("matched").get("id"), id_pedido, item.get("cantidad"), (item.get("matched").get("price") * item.get("cantidad", 1)), especificaciones_txt )
+                                        res_detalle = execute_query(query, params)
+                                elif cambio == "Producto a reemplazar":
+                                    if res_detalle:
+                                        id_detalle, cantidad_actual = res_detalle
+                                        nueva_cantidad = cantidad_actual - item.get("cantidad", 1)
+                                        especificaciones_txt = normalizar_especificaciones(item) 
+                                        if nueva_cantidad > 0:
+                                            query = """ UPDATE detalle_pedido SET cantidad = %s, total = %s, especificaciones = CASE
                                                         WHEN %s IS NULL OR %s = '' THEN especificaciones
                                                         ELSE %s END
                                                         WHERE id_detalle = %s"""
-                                    params = ( item.get("cantidad", 1), (item.get("matched").get("price") * item.get("cantidad", 1)),especificaciones_txt,especificaciones_txt,especificaciones_txt, id_detalle)
+                                            params = ( nueva_cantidad, (item.get("matched").get("price") * nueva_cantidad),especificaciones_txt,especificaciones_txt,especificaciones_txt, id_detalle)
+                                            res_detalle = execute_query(query, params)
+                                        else:
+                                            query = """ DELETE FROM detalle_pedido WHERE id_pedido = %s AND id_producto = %s"""
+                                            params = ( id_pedido, item.get("matched").get("id"))
+                                            res_detalle = execute_query(query, params)
+                        case "UPDATE_ITEM":
+                            for item in productos.get("items", []):
+                                if item.get("cantidad") == 0:
+                                    query = """ DELETE FROM detalle_pedido WHERE id_pedido = %s AND id_producto = %s"""
+                                    params = ( id_pedido, item.get("matched").get("id"))
                                     res_detalle = execute_query(query, params)
                                 else:
-                                    query = """ INSERT INTO detalle_pedido ( id_producto,id_pedido, cantidad, total, especificaciones) VALUES (%s, %s, %s, %s, %s)"""
-                                    params = (item.get("matched").get("id"), id_pedido, item.get("cantidad"), (item.get("matched").get("price") * item.get("cantidad", 1)), especificaciones_txt )
-                                    res_detalle = execute_query(query, params)
-                    case "REESCRIBIR_PEDIDO":
-                        query = """SELECT idpedido FROM pedidos WHERE codigo_unico = %s"""
-                        params = (codigo_unico,)
-                        res_pedido = execute_query(query, params, fetchone=True)
-                        if res_pedido:
-                            id_pedido = res_pedido[0]
-                            query = """DELETE FROM detalle_pedido WHERE id_pedido = %s"""
-                            params = (id_pedido,)
-                            execute_query(query, params)
-                            query = """DELETE FROM pedidos WHERE idpedido = %s"""
-                            params = (id_pedido,)
-                            execute_query(query, params)
-                            subflujo_solicitud_pedido(sender, pregunta_usuario, entidades_text, codigo_unico)
-                            return
-                    case "ACLARACION":
-                        items = obtener_menu()
-                        mensaje = generar_mensaje_sin_intencion(pregunta_usuario, items)
-                        send_text_response(sender, mensaje)
-                        return
-                log_message(f'Pedido modificado correctamente: {id_pedido} para {sender}.', 'INFO')
-                query_actualizar_total = """update pedidos set total_productos = 
-                                            (select sum(total) from detalle_pedido		
-                                            where id_pedido = %s)
-                                            where idpedido = %s """
-                execute_query(query_actualizar_total, (id_pedido, id_pedido))
-                result = execute_query(query_pendientes, (sender,))
+                                    query = """SELECT id_detalle, cantidad
+                                                FROM detalle_pedido
+                                                WHERE id_pedido = %s AND id_producto = %s"""
+                                    params = ( id_pedido, item.get("matched").get("id"))
+                                    res_detalle = execute_query(query, params, fetchone=True)
+                                    especificaciones_txt = normalizar_especificaciones(item)
+                                    if res_detalle:
+                                        id_detalle, cantidad_actual = res_detalle
+                                        query = """ UPDATE detalle_pedido SET cantidad = %s, total = %s, especificaciones = CASE
+                                                            WHEN %s IS NULL OR %s = '' THEN especificaciones
+                                                            ELSE %s END
+                                                            WHERE id_detalle = %s"""
+                                        params = ( item.get("cantidad", 1), (item.get("matched").get("price") * item.get("cantidad", 1)),especificaciones_txt,especificaciones_txt,especificaciones_txt, id_detalle)
+                                        res_detalle = execute_query(query, params)
+                                    else:
+                                        query = """ INSERT INTO detalle_pedido ( id_producto,id_pedido, cantidad, total, especificaciones) VALUES (%s, %s, %s, %s, %s)"""
+                                        params = (item.get("matched").get("id"), id_pedido, item.get("cantidad"), (item.get("matched").get("price") * item.get("cantidad", 1)), especificaciones_txt )
+                                        res_detalle = execute_query(query, params)
+                        case "REESCRIBIR_PEDIDO":
+                            query = """SELECT idpedido FROM pedidos WHERE codigo_unico = %s"""
+                            params = (codigo_unico,)
+                            res_pedido = execute_query(query, params, fetchone=True)
+                            if res_pedido:
+                                id_pedido = res_pedido[0]
+                                query = """DELETE FROM detalle_pedido WHERE id_pedido = %s"""
+                                params = (id_pedido,)
+                                execute_query(query, params)
+                                query = """DELETE FROM pedidos WHERE idpedido = %s"""
+                                params = (id_pedido,)
+                                execute_query(query, params)
+                                reescribir_pedido = True
+                    if not reescribir_pedido:
+                        log_message(f'Pedido modificado correctamente: {id_pedido} para {sender}.', 'INFO')
+                        query_actualizar_total = """update pedidos set total_productos = 
+                                                    (select sum(total) from detalle_pedido		
+                                                    where id_pedido = %s)
+                                                    where idpedido = %s """
+                        execute_query(query_actualizar_total, (id_pedido, id_pedido))
+                        result = execute_query(query_pendientes, (sender,))
+                if reescribir_pedido:
+                    subflujo_solicitud_pedido(sender, pregunta_usuario, entidades_text, codigo_unico)
+                    return
                 items_menu: list = obtener_menu()
-                texto = generar_mensaje_confirmacion_modificacion_pedido(result,items_menu)
+                texto = generar_mensaje_confirmacion_modificacion_pedido(result, items_menu, al_mensaje=lambda t: send_text_response(sender, t))
                 guardar_intencion_futura(sender, "confirmar_pedido", codigo_unico)
-                send_text_response(sender,texto.get("mensaje"))
+                if not texto.get("enviado"):
+                    send_text_response(sender,texto.get("mensaje"))
                 return
         else:
             send_text_response(sender, "los sentimos, Tu pedido ya fue creado, se envía al administrador para que verifique si se puede modificar o no, en un momento el admin se comunicara contigo.")
@@ -891,7 +915,7 @@ def subflujo_eleccion_sede(sender: str, nombre_cliente: str, texto_cliente):
                         );
             """
         result = execute_query(query_pendientes, (sender,))
-        log_message(f"[SubflujoEleccionSede] Resultado consulta pedidos pendientes para {sender}: {result}", "INFO")
+        log_message(f"[SubflujoEleccionSede] Resultado consulta pedidos pendientes para {sender}", "INFO", result=result)
         codigo_unico = result[0][6] if result else 0
         #MODIFICACION TEMPORAL SOLO UNA SEDE
         datos_mapeo_sede: dict = mapear_sede_cliente(texto_cliente)
@@ -1152,19 +1176,19 @@ def orquestador_subflujos(
     type_text: str = "text"
 ) -> Any:
     """Activa el subflujo correspondiente según la intención detectada."""
+    atendido = False
     try:
         if not verify_hour_atettion_v2(sender):
             return None
+        atendido = True
         log_message(f"Empieza <OrquestadorSubflujos> con sender {sender} y tipo {clasificacion_mensaje}", "INFO")
         set_id_sede(sender)
-        msj_mismo_dia = obtener_respuestas_mismo_dia(sender)
-        extraer_resumen_corto(msj_mismo_dia, sender, ID_RESTAURANTE)
         clasificacion_mensaje = clasificacion_mensaje.strip().lower()
         if manejar_paso_activo_simple(sender, nombre_cliente, pregunta_usuario, clasificacion_mensaje):
             return True
         if clasificacion_mensaje == "saludo":
             #respuesta_bot = subflujo_saludo_bienvenida(nombre_cliente, nombre_local, sender, pregunta_usuario)
-            respuesta_bot = f"Hola {nombre_cliente}, Bienvenido a Sierra Nevada, Recuerda contestar con un mensaje a la vez"
+            respuesta_bot = f"Hola {nombre_cliente}, Bienvenido a Sierra Nevada"
             send_text_response(sender, respuesta_bot)
             send_pdf_response(sender)
         elif (clasificacion_mensaje == "solicitud_pedido" or clasificacion_mensaje == "continuacion_promocion"):
@@ -1318,6 +1342,7 @@ def orquestador_subflujos(
                                                 SET direccion_google = %s
                                                 WHERE telefono = %s AND id_restaurante = %s;
                                                 """, (None, sender, ID_RESTAURANTE))
+                        actualizar_perfil_cliente(sender, {"direccion_google": None})
                         return
                 if observaciones != "":
                     execute_query("""
@@ -1325,6 +1350,7 @@ def orquestador_subflujos(
                                     SET observaciones_dir = %s
                                     WHERE telefono = %s AND id_restaurante = %s;
                                     """, (observaciones, sender, ID_RESTAURANTE))
+                    actualizar_perfil_cliente(sender, {"observaciones_dir": observaciones})
                     log_message(f'observacones creadas en la base .{observaciones}', 'INFO')
                 mensaje = direccion_bd(nombre_cliente, direccion,sender)
                 send_text_response(sender, mensaje)
@@ -1343,6 +1369,10 @@ def orquestador_subflujos(
     except Exception as e:
         log_message(f"Ocurrió un problema en <OrquestadorSubflujos>: {e}", "ERROR")
         raise e
+    finally:
+        # El resumen del perfil se actualiza después de responder, con antirrebote por remitente
+        if atendido:
+            RESUMEN_CORTO.avisar(sender)
 # --- MANEJADOR PRINCIPAL DE DIÁLOGO (ITERATIVO, NO RECURSIVO) --- #
 def manejar_dialogo(
     sender: str,
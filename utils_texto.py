@@ -0,0 +1,70 @@
+# utils_texto.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Normalización de texto de WhatsApp para reglas locales (sin tildes, sin emojis, minúsculas),
+# distancia de edición y clave fonética para comparar palabras mal escritas.
+
+import re
+from typing import Optional
+from unidecode import unidecode
+
+_NO_PERMITIDOS = re.compile(r"[^a-z0-9#\- ]+")
+_ESPACIOS = re.compile(r"\s+")
+_REPETIDAS = re.compile(r"([a-z])\1{2,}")
+
+def normalizar_texto(texto: str) -> str:
+    """
+    Forma canónica de un mensaje corto: minúsculas, sin tildes (unidecode), sin emojis ni signos
+    (se conservan # y - por las direcciones), letras repetidas reducidas ("siii" -> "sii")
+    y espacios colapsados.
+    """
+    if not texto:
+        return ""
+    limpio = unidecode(str(texto)).lower()
+    limpio = _NO_PERMITIDOS.sub(" ", limpio)
+    limpio = _REPETIDAS.sub(r"\1\1", limpio)
+    return _ESPACIOS.sub(" ", limpio).strip()
+
+def distancia_edicion(a: str, b: str, maximo: Optional[int] = None) -> int:
+    """
+    Distancia de Levenshtein entre a y b. Con maximo, corta en cuanto la distancia
+    lo supera y retorna maximo + 1.
+    """
+    if a == b:
+        return 0
+    if maximo is not None and abs(len(a) - len(b)) > maximo:
+        return maximo + 1
+    anterior = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        actual = [i]
+        for j, cb in enumerate(b, 1):
+            actual.append(min(anterior[j] + 1, actual[j - 1] + 1, anterior[j - 1] + (ca != cb)))
+        if maximo is not None and min(actual) > maximo:
+            return maximo + 1
+        anterior = actual
+    return anterior[-1]
+
+def tolerancia_edicion(palabra: str) -> int:
+    """Errores de digitación aceptados según el largo: 0 hasta 4 letras, 1 hasta 7, 2 en adelante."""
+    if len(palabra) <= 4:
+        return 0
+    return 1 if len(palabra) <= 7 else 2
+
+_FONETICA = [
+    (re.compile(r"h"), ""),
+    (re.compile(r"qu"), "k"),
+    (re.compile(r"c(?=[eiy])"), "s"),
+    (re.compile(r"[cq]"), "k"),
+    (re.compile(r"z"), "s"),
+    (re.compile(r"v"), "b"),
+    (re.compile(r"ll"), "y"),
+    (re.compile(r"g(?=[ei])"), "j"),
+    (re.compile(r"x"), "ks"),
+    (re.compile(r"([a-z])\1+"), r"\1"),
+]
+
+def clave_fonetica(texto: str) -> str:
+    """Clave fonética aproximada para español ("Galerías" y "galerias" / "Virrey" y "birey" coinciden)."""
+    clave = normalizar_texto(texto).replace(" ", "")
+    for patron, reemplazo in _FONETICA:
+        clave = patron.sub(reemplazo, clave)
+    return clave
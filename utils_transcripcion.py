@@ -0,0 +1,212 @@
+# utils_transcripcion.py
+# Last modified: 2026-10-17 Juan Agudelo
+# Transcripción de las notas de voz de WhatsApp: descarga en streaming desde Meta con una sesión HTTP
+# compartida, límites de tamaño y duración, caché por audio_id (Meta reenvía eventos) y backend
+# intercambiable: Whisper por API (por defecto) o faster-whisper local en CPU.
+
+import io
+import logging
+import os
+import struct
+import threading
+import time
+from typing import Any, Optional, Tuple
+import requests
+from requests.adapters import HTTPAdapter
+from utils_cache_llm import respuesta_llm_cacheada
+from utils_metricas import incrementar, observar
+
+TRANSCRIPCION_BACKEND: str = os.getenv("TRANSCRIPCION_BACKEND", "openai")  # "openai" | "faster_whisper"
+TRANSCRIPCION_MODELO: str = os.getenv("TRANSCRIPCION_MODELO", "whisper-1")
+OPENAI_TIMEOUT_TRANSCRIPCION_SEGUNDOS: float = float(os.getenv("OPENAI_TIMEOUT_TRANSCRIPCION_SEGUNDOS", "60"))
+TRANSCRIPCION_MAX_BYTES: int = int(os.getenv("TRANSCRIPCION_MAX_BYTES", str(16 * 1024 * 1024)))  # límite de audio de WhatsApp
+TRANSCRIPCION_MAX_SEGUNDOS: float = float(os.getenv("TRANSCRIPCION_MAX_SEGUNDOS", "300"))
+TRANSCRIPCION_IDIOMA: str = os.getenv("TRANSCRIPCION_IDIOMA", "es")
+TRANSCRIPCION_TIMEOUT_DESCARGA_SEGUNDOS: float = float(os.getenv("TRANSCRIPCION_TIMEOUT_DESCARGA_SEGUNDOS", "20"))
+TRANSCRIPCION_BLOQUE_BYTES: int = 64 * 1024
+META_GRAPH_VERSION: str = os.getenv("META_GRAPH_VERSION", "v17.0")
+FASTER_WHISPER_MODELO: str = os.getenv("FASTER_WHISPER_MODELO", "small")
+FASTER_WHISPER_COMPUTE: str = os.getenv("FASTER_WHISPER_COMPUTE", "int8")  # cuantización en CPU
+FASTER_WHISPER_HILOS: int = int(os.getenv("FASTER_WHISPER_HILOS", "0"))  # 0 = los que decida ctranslate2
+HTTP_MAX_CONEXIONES: int = int(os.getenv("HTTP_MAX_CONEXIONES", "10"))
+
+EXTENSIONES_AUDIO = {"ogg": "ogg", "opus": "ogg", "mpeg": "mp3", "mp3": "mp3", "mp4": "m4a", "aac": "m4a", "amr": "amr", "wav": "wav"}
+
+class AudioRechazado(Exception):
+    """El audio supera TRANSCRIPCION_MAX_BYTES o TRANSCRIPCION_MAX_SEGUNDOS; motivo: "tamano" | "duracion"."""
+
+    def __init__(self, motivo: str, detalle: str) -> None:
+        super().__init__(detalle)
+        self.motivo = motivo
+
+_sesion: Optional[requests.Session] = None
+_sesion_lock = threading.Lock()
+
+def obtener_sesion_http() -> requests.Session:
+    """Sesión requests del proceso con pool de conexiones keep-alive (graph.facebook.com y el CDN de medios)."""
+    global _sesion
+    if _sesion is None:
+        with _sesion_lock:
+            if _sesion is None:
+                sesion = requests.Session()
+                adaptador = HTTPAdapter(pool_connections=HTTP_MAX_CONEXIONES, pool_maxsize=HTTP_MAX_CONEXIONES)
+                sesion.mount("https://", adaptador)
+                _sesion = sesion
+    return _sesion
+
+def duracion_ogg(datos: bytes) -> Optional[float]:
+    """
+    Duración en segundos de un Ogg Opus/Vorbis leyendo el granule position de la última página
+    (no decodifica el audio). None si no es Ogg o el códec no se reconoce.
+    """
+    if not datos.startswith(b"OggS"):
+        return None
+    if b"OpusHead" in datos[:512]:
+        tasa = 48000  # Opus siempre cuenta granules a 48 kHz
+    else:
+        i = datos.find(b"\x01vorbis", 0, 512)
+        if i < 0:
+            return None
+        tasa = struct.unpack_from("<I", datos, i + 12)[0]
+    ultima = datos.rfind(b"OggS", max(0, len(datos) - 65536))
+    if ultima < 0 or ultima + 14 > len(datos) or not tasa:
+        return None
+    granule = struct.unpack_from("<q", datos, ultima + 6)[0]
+    return granule / tasa if granule > 0 else None
+
+def _validar_duracion(datos: bytes, mime_type: str) -> None:
+    duracion = duracion_ogg(datos) if "ogg" in mime_type or "opus" in mime_type else None
+    if duracion is not None:
+        observar("transcripcion.duracion_s", duracion)
+        if duracion > TRANSCRIPCION_MAX_SEGUNDOS:
+            raise AudioRechazado("duracion", f"Audio de {duracion:.0f}s supera {TRANSCRIPCION_MAX_SEGUNDOS:.0f}s")
+
+def descargar_audio_meta(audio_id: str, token: str) -> Optional[Tuple[bytes, str]]:
+    """
+    Descarga el audio de Meta en bloques: corta apenas supera TRANSCRIPCION_MAX_BYTES (por file_size,
+    Content-Length o lo recibido). Retorna (bytes, mime_type) o None si Meta no da la URL.
+    """
+    sesion = obtener_sesion_http()
+    headers = {"Authorization": f"Bearer {token}"}
+    inicio = time.perf_counter()
+    info = sesion.get(
+        f"https://graph.facebook.com/{META_GRAPH_VERSION}/{audio_id}",
+        headers=headers,
+        timeout=TRANSCRIPCION_TIMEOUT_DESCARGA_SEGUNDOS
+    ).json()
+    if "url" not in info:
+        logging.error(f"No se encontró la URL del audio: {info}")
+        return None
+    if int(info.get("file_size") or 0) > TRANSCRIPCION_MAX_BYTES:
+        raise AudioRechazado("tamano", f"Audio de {info['file_size']} bytes supera {TRANSCRIPCION_MAX_BYTES}")
+    buffer = bytearray()
+    with sesion.get(info["url"], headers=headers, stream=True, timeout=TRANSCRIPCION_TIMEOUT_DESCARGA_SEGUNDOS) as respuesta:
+        respuesta.raise_for_status()
+        if int(respuesta.headers.get("Content-Length") or 0) > TRANSCRIPCION_MAX_BYTES:
+            raise AudioRechazado("tamano", f"Audio de {respuesta.headers['Content-Length']} bytes supera {TRANSCRIPCION_MAX_BYTES}")
+        for bloque in respuesta.iter_content(chunk_size=TRANSCRIPCION_BLOQUE_BYTES):
+            buffer.extend(bloque)
+            if len(buffer) > TRANSCRIPCION_MAX_BYTES:
+                raise AudioRechazado("tamano", f"Audio supera {TRANSCRIPCION_MAX_BYTES} bytes")
+    observar("transcripcion.descarga_ms", (time.perf_counter() - inicio) * 1000)
+    observar("transcripcion.bytes", len(buffer))
+    return bytes(buffer), info.get("mime_type") or ""
+
+def _nombre_archivo(mime_type: str) -> str:
+    subtipo = mime_type.split(";")[0].split("/")[-1].strip().lower()
+    return f"audio.{EXTENSIONES_AUDIO.get(subtipo, 'ogg')}"
+
+class TranscriptorOpenAI:
+    """Whisper por API con el cliente OpenAI compartido (utils_openai)."""
+
+    def __init__(self, modelo: str = TRANSCRIPCION_MODELO, timeout: float = OPENAI_TIMEOUT_TRANSCRIPCION_SEGUNDOS) -> None:
+        self.modelo = modelo
+        self.timeout = timeout
+
+    def transcribir(self, datos: bytes, mime_type: str) -> str:
+        from utils_openai import obtener_cliente_openai
+        client = obtener_cliente_openai(timeout=self.timeout)
+        transcript = client.audio.transcriptions.create(
+            model=self.modelo,
+            file=(_nombre_archivo(mime_type), io.BytesIO(datos), mime_type),
+            language=TRANSCRIPCION_IDIOMA or None
+        )
+        return transcript.text
+
+class TranscriptorFasterWhisper:
+    """
+    faster-whisper local en CPU (pip install faster-whisper): sin llamada de red ni costo por minuto.
+    El modelo se carga una vez por proceso, en la primera transcripción.
+    """
+
+    def __init__(self, modelo: str = FASTER_WHISPER_MODELO, compute_type: str = FASTER_WHISPER_COMPUTE) -> None:
+        self.modelo = f"faster-whisper-{modelo}"
+        self._nombre_modelo = modelo
+        self._compute_type = compute_type
+        self._whisper: Any = None
+        self._lock = threading.Lock()
+
+    def _cargar(self) -> Any:
+        with self._lock:
+            if self._whisper is None:
+                from faster_whisper import WhisperModel
+                inicio = time.perf_counter()
+                self._whisper = WhisperModel(
+                    self._nombre_modelo, device="cpu", compute_type=self._compute_type, cpu_threads=FASTER_WHISPER_HILOS
+                )
+                observar("transcripcion.carga_modelo_ms", (time.perf_counter() - inicio) * 1000)
+            return self._whisper
+
+    def transcribir(self, datos: bytes, mime_type: str) -> str:
+        segmentos, _ = self._cargar().transcribe(io.BytesIO(datos), language=TRANSCRIPCION_IDIOMA or None, vad_filter=True)
+        return " ".join(s.text.strip() for s in segmentos).strip()
+
+_transcriptor = None
+_transcriptor_lock = threading.Lock()
+
+def obtener_transcriptor():
+    """Retorna el backend configurado en TRANSCRIPCION_BACKEND (instancia única)."""
+    global _transcriptor
+    with _transcriptor_lock:
+        if _transcriptor is None:
+            _transcriptor = TranscriptorFasterWhisper() if TRANSCRIPCION_BACKEND == "faster_whisper" else TranscriptorOpenAI()
+        return _transcriptor
+
+def configurar_transcriptor(transcriptor) -> None:
+    """Reemplaza el backend del proceso (cualquier objeto con .modelo y .transcribir(datos, mime_type))."""
+    global _transcriptor
+    with _transcriptor_lock:
+        _transcriptor = transcriptor
+
+def transcribir_audio(audio_id: str, mime_type: str, token: str) -> Optional[str]:
+    """
+    Texto del audio audio_id. Un reenvío del mismo evento sale de la caché (cache_llm, clave
+    audio_id + modelo) sin descargar ni transcribir otra vez. None si Meta no entrega el audio;
+    lanza AudioRechazado si supera los límites.
+    """
+    transcriptor = obtener_transcriptor()
+
+    def _transcribir() -> str:
+        descarga = descargar_audio_meta(audio_id, token)
+        if descarga is None:
+            return ""
+        datos, mime_descarga = descarga
+        mime = mime_type or mime_descarga
+        _validar_duracion(datos, mime)
+        inicio = time.perf_counter()
+        try:
+            texto = transcriptor.transcribir(datos, mime)
+        except Exception:
+            incrementar("transcripcion.errores")
+            raise
+        finally:
+            observar("transcripcion.transcribir_ms", (time.perf_counter() - inicio) * 1000)
+        incrementar("transcripcion.transcritos")
+        return texto
+
+    try:
+        texto = respuesta_llm_cacheada("transcripcion", transcriptor.modelo, audio_id, _transcribir)
+    except AudioRechazado as e:
+        incrementar(f"transcripcion.rechazados.{e.motivo}")
+        raise
+    return texto or None